@@ -1,12 +1,17 @@
 from flask import Flask
 from flask_login import LoginManager
 import os
+import tempfile
 from app.models import db, User
 from app.auth import auth
 from app.profile import profile
 from app.library import library
 from app.stories import stories
 from app.search import search
+from app.metrics import metrics
+from app.uploads import uploads
+from app.covers import covers_cli
+from app.chapters import chapters_cli
 
 def create_app():
     app = Flask(__name__, 
@@ -19,6 +24,26 @@ def create_app():
     app.config['UPLOAD_FOLDER'] = 'static/uploads'
     app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
     app.config['COVER_SIZE'] = (512, 800)  # Width, Height
+    app.config['COVER_RENDITIONS'] = (('thumb', 128), ('card', 256), ('full', 512))  # Widths saved per cover, smallest first
+    app.config['COVER_PRINT_SIZE'] = (1056, 1650)  # 300 dpi at the size PDF exports print the cover
+    app.config['COVER_MAX_PIXELS'] = 50 * 1000 * 1000  # Larger uploads are refused before being decoded
+    app.config['COVER_WORKERS'] = int(os.environ.get('COVER_WORKERS', 2))  # Processes resizing cover uploads
+    app.config['COVER_CACHE_MAX_AGE'] = 365 * 24 * 60 * 60  # Cover files are immutable, see app/uploads.py
+    app.config['COVER_SENDFILE'] = os.environ.get('COVER_SENDFILE')  # None, 'x-accel-redirect' or 'x-sendfile'
+    app.config['COVER_ACCEL_PREFIX'] = os.environ.get('COVER_ACCEL_PREFIX', '/protected/uploads/')  # nginx internal location
+    app.config['COVER_INCOMING_FOLDER'] = os.environ.get('COVER_INCOMING_FOLDER', os.path.join(tempfile.gettempdir(), 'scribe-covers'))
+    app.config['CACHE_METRICS'] = os.environ.get('CACHE_METRICS') == '1'  # Serve /metrics/cache to logged in users
+    app.config['CHAPTER_COMPRESSION'] = os.environ.get('CHAPTER_COMPRESSION')  # None, 'zlib' or 'zstd', see app/chapter_text.py
+    app.config['CHAPTER_DICTIONARY'] = os.environ.get('CHAPTER_DICTIONARY')  # Shared compression dictionary file
+    app.config['EXPORT_CACHE_FOLDER'] = os.environ.get('EXPORT_CACHE_FOLDER', os.path.join(tempfile.gettempdir(), 'scribe-exports'))
+    app.config['EXPORT_CACHE_MAX_BYTES'] = 512 * 1024 * 1024  # Generated PDFs and EPUBs kept on disk
+    app.config['EXPORT_WORKERS'] = int(os.environ.get('EXPORT_WORKERS', 2))  # Processes rendering exports
+    app.config['EXPORT_QUEUE_DEPTH'] = int(os.environ.get('EXPORT_QUEUE_DEPTH', 32))  # Exports queued or running at once
+    app.config['EXPORT_WAIT_SECONDS'] = 20  # How long a download waits for its export before answering 202
+    app.config['LIBRARY_EXPORTS_PER_USER'] = 1  # Library downloads one reader may run at once, per server process
+    app.config['LIBRARY_EXPORT_PARALLEL'] = 2  # Exports one library download may have rendering at once
+    app.config['LIBRARY_QUEUE_WAIT_SECONDS'] = 30  # How long a library download waits for room on the export pool
+    app.config['LIBRARY_RENDER_WAIT_SECONDS'] = 300  # How long a library download waits for one book to render
 
     # Initialize extensions
     db.init_app(app)
@@ -36,6 +61,12 @@ def create_app():
     app.register_blueprint(library)
     app.register_blueprint(stories)
     app.register_blueprint(search)
+    app.register_blueprint(metrics)
+    app.register_blueprint(uploads)
+
+    # Command line tools
+    app.cli.add_command(covers_cli)
+    app.cli.add_command(chapters_cli)
 
     # Create database tables
     with app.app_context():
@@ -0,0 +1,49 @@
+from app.models import db, Story, Tag, story_tags
+from app.cache import VersionedCache, author_generation
+
+# Profile statistics for one author, computed with two aggregate queries over
+# the counters cached on Story and kept per author until that author's
+# stories, ratings or tags change.
+
+STATS_CACHE_SIZE = 1024
+STATS_CACHE_TTL = 300  # seconds
+
+stats_cache = VersionedCache(STATS_CACHE_SIZE, STATS_CACHE_TTL)
+
+
+def _compute_author_stats(user_id):
+    total_stories, total_words, rating_sum, rating_count = db.session.query(
+        db.func.count(Story.id),
+        db.func.coalesce(db.func.sum(Story.word_count), 0),
+        db.func.coalesce(db.func.sum(Story.rating_sum), 0),
+        db.func.coalesce(db.func.sum(Story.rating_count), 0),
+    ).filter(Story.user_id == user_id).one()
+
+    # Most used tag across the author's stories
+    tag_count = db.func.count(story_tags.c.story_id)
+    top_tag = db.session.query(Tag.name, tag_count) \
+        .join(story_tags, story_tags.c.tag_id == Tag.id) \
+        .join(Story, Story.id == story_tags.c.story_id) \
+        .filter(Story.user_id == user_id) \
+        .group_by(Tag.id, Tag.name) \
+        .order_by(tag_count.desc(), Tag.name.asc()) \
+        .first()
+
+    return {
+        'total_stories': total_stories,
+        'total_words': total_words,
+        'avg_words': round(total_words / total_stories) if total_stories else 0,
+        'avg_rating': round(rating_sum / rating_count, 1) if rating_count else 0,
+        'rating_count': rating_count,
+        'most_used_tag': {'name': top_tag[0], 'count': top_tag[1]} if top_tag else None,
+    }
+
+
+def author_stats(user_id):
+    """Return the profile statistics for an author, from cache when still valid."""
+    generation = author_generation(user_id)
+    stats = stats_cache.get(user_id, generation)
+    if stats is None:
+        stats = _compute_author_stats(user_id)
+        stats_cache.set(user_id, generation, stats)
+    return stats
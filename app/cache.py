@@ -0,0 +1,193 @@
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from app.models import db, User, Story, Chapter, Rating, Tag
+
+# Generation counters for in-process caches.
+#
+# Every committed transaction that touches users, stories, chapters, ratings or
+# tags bumps a process-wide catalogue generation, plus a per-author generation
+# for each author whose profile or stories were affected. Caches store the
+# generation they were filled under, so anything cached before a change simply
+# stops matching.
+# Entries also expire on a short TTL because other worker processes can't see
+# this process's counters.
+
+CATALOGUE_MODELS = (User, Story, Chapter, Rating, Tag)
+
+_lock = threading.Lock()
+_generation = 0
+_generation_changed_at = datetime.utcnow()
+_author_generations = {}
+
+
+def catalogue_generation():
+    """Current catalogue generation; changes whenever catalogue data is committed."""
+    return _generation
+
+
+def catalogue_changed_at():
+    """When this process last saw the catalogue change (UTC)."""
+    return _generation_changed_at
+
+
+def author_generation(user_id):
+    """Current generation of one author's profile, stories, ratings and tags."""
+    return _author_generations.get(user_id, 0)
+
+
+def bump_catalogue_generation(author_ids=()):
+    global _generation, _generation_changed_at
+    with _lock:
+        _generation += 1
+        _generation_changed_at = datetime.utcnow()
+        for user_id in author_ids:
+            _author_generations[user_id] = _author_generations.get(user_id, 0) + 1
+
+
+class VersionedCache:
+    """Bounded LRU whose entries are only valid for the version they were stored under."""
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, version):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                stored_version, stored_at, value = entry
+                if stored_version == version and time.monotonic() - stored_at <= self.ttl:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self.entries[key]
+            self.misses += 1
+            return None
+
+    def set(self, key, version, value):
+        with self.lock:
+            self.entries[key] = (version, time.monotonic(), value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        """Hit/miss counters and occupancy, for sizing the cache."""
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self.entries),
+                'max_entries': self.max_entries,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else None,
+            }
+
+
+
+class SizedCache:
+    """LRU bounded by the memory its values use rather than by entry count.
+
+    Like VersionedCache, an entry is only returned for the version it was stored
+    under; there is no TTL because callers derive versions from the data itself.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, version):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] == version:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            return None
+
+    def set(self, key, version, value, size):
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.bytes -= old[2]
+            if size > self.max_bytes:
+                return
+            self.entries[key] = (version, value, size)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, (_, _, evicted_size) = self.entries.popitem(last=False)
+                self.bytes -= evicted_size
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+
+    def stats(self):
+        """Hit/miss counters and memory use, for sizing the cache."""
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self.entries),
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else None,
+            }
+
+@event.listens_for(Session, 'after_flush')
+def _note_catalogue_changes(session, flush_context):
+    author_ids = set()
+    story_ids = set()
+    for instance in list(session.new) + list(session.dirty) + list(session.deleted):
+        if not isinstance(instance, CATALOGUE_MODELS):
+            continue
+        session.info['catalogue_changed'] = True
+        if isinstance(instance, User):
+            # Author pages show the user's bio
+            author_ids.add(instance.id)
+        elif isinstance(instance, Story):
+            author_ids.add(instance.user_id)
+        elif isinstance(instance, (Chapter, Rating)):
+            story_ids.add(instance.story_id)
+    story_ids.discard(None)
+    if story_ids:
+        # Chapters and ratings only know their story; look up whose it is
+        rows = session.connection().execute(db.select(Story.user_id).where(Story.id.in_(story_ids)))
+        author_ids.update(user_id for user_id, in rows)
+    author_ids.discard(None)
+    session.info.setdefault('changed_authors', set()).update(author_ids)
+
+
+@event.listens_for(Session, 'after_commit')
+def _bump_on_commit(session):
+    author_ids = session.info.pop('changed_authors', set())
+    if session.info.pop('catalogue_changed', False):
+        bump_catalogue_generation(author_ids)
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _forget_on_rollback(session, previous_transaction):
+    session.info.pop('catalogue_changed', None)
+    session.info.pop('changed_authors', None)
@@ -0,0 +1,160 @@
+import hashlib
+import struct
+import zlib
+from collections import Counter
+from flask import current_app, has_app_context
+
+try:
+    import zstandard
+except ImportError:  # Optional; zlib is always available
+    zstandard = None
+
+# Compressed storage for chapter text.
+#
+# Chapter text is most of the database (and of every backup), and prose
+# compresses three to four times. With CHAPTER_COMPRESSION set to 'zlib' or
+# 'zstd' (the latter needs the zstandard package), chapters are stored
+# compressed in chapter.content_compressed and chapter.content is left NULL;
+# otherwise they are stored as plain text as before. Chapter.content reads
+# either transparently, so the setting can be changed at any time: existing
+# rows keep working and `flask chapters recompress` converts them.
+#
+# CHAPTER_DICTIONARY names a file of shared compression dictionary, built
+# from the stories themselves by `flask chapters train-dictionary`. Chapters
+# are compressed separately, so without one every chapter starts from
+# nothing; with one, common words and phrases are already known, which
+# matters most for short chapters.
+#
+# A stored value is a codec byte, the id of the dictionary used (0 for
+# none; the first four bytes of its SHA-256) and the compressed UTF-8 text.
+# Reading a chapter needs the dictionary it was written with, so keep the old
+# file in CHAPTER_DICTIONARY until recompress has moved every chapter to a
+# new one.
+
+CODECS = {'zlib': b'z', 'zstd': b's'}
+HEADER = struct.Struct('>cI')
+ZLIB_LEVEL = 9
+ZSTD_LEVEL = 19
+# Shorter chapters are stored as text: a few bytes saved aren't worth a decode
+MIN_COMPRESS_BYTES = 256
+ZLIB_DICTIONARY_BYTES = 32 * 1024  # zlib only looks back this far
+
+_dictionaries = {}  # path -> (id, bytes)
+
+
+class ChapterTextError(Exception):
+    """Raised when stored chapter text can't be encoded or decoded with this configuration."""
+
+
+def _require_zstandard():
+    if zstandard is None:
+        raise ChapterTextError("Chapter text compressed with zstd needs the 'zstandard' package")
+
+
+def dictionary_id(data):
+    return struct.unpack('>I', hashlib.sha256(data).digest()[:4])[0]
+
+
+def _load_dictionary(path):
+    if path not in _dictionaries:
+        with open(path, 'rb') as f:
+            data = f.read()
+        _dictionaries[path] = (dictionary_id(data), data)
+    return _dictionaries[path]
+
+
+def storage_settings():
+    """(codec or None, dictionary id, dictionary bytes) for the current app."""
+    if not has_app_context():
+        return None, 0, None
+    codec = current_app.config.get('CHAPTER_COMPRESSION')
+    if codec and codec not in CODECS:
+        raise ChapterTextError(f'Unknown CHAPTER_COMPRESSION {codec!r}; use one of {", ".join(CODECS)}')
+    path = current_app.config.get('CHAPTER_DICTIONARY')
+    if not codec or not path:
+        return codec, 0, None
+    return (codec, *_load_dictionary(path))
+
+
+def compress(text, codec, dict_id=0, dictionary=None):
+    """Compress ``text`` into the stored form."""
+    data = text.encode('utf-8')
+    if codec == 'zlib':
+        compressor = zlib.compressobj(ZLIB_LEVEL, zdict=dictionary) if dictionary else zlib.compressobj(ZLIB_LEVEL)
+        payload = compressor.compress(data) + compressor.flush()
+    else:
+        _require_zstandard()
+        dict_data = zstandard.ZstdCompressionDict(dictionary) if dictionary else None
+        payload = zstandard.ZstdCompressor(level=ZSTD_LEVEL, dict_data=dict_data).compress(data)
+    return HEADER.pack(CODECS[codec], dict_id) + payload
+
+
+def decompress(blob):
+    """The text of a stored compressed value."""
+    codec, dict_id = HEADER.unpack_from(blob)
+    payload = bytes(blob[HEADER.size:])
+    dictionary = None
+    if dict_id:
+        path = current_app.config.get('CHAPTER_DICTIONARY') if has_app_context() else None
+        if not path or _load_dictionary(path)[0] != dict_id:
+            raise ChapterTextError(f'Chapter text needs compression dictionary {dict_id:08x}, '
+                                   'which is not the configured CHAPTER_DICTIONARY')
+        dictionary = _load_dictionary(path)[1]
+    if codec == CODECS['zlib']:
+        decompressor = zlib.decompressobj(zdict=dictionary) if dictionary else zlib.decompressobj()
+        data = decompressor.decompress(payload) + decompressor.flush()
+    elif codec == CODECS['zstd']:
+        _require_zstandard()
+        dict_data = zstandard.ZstdCompressionDict(dictionary) if dictionary else None
+        data = zstandard.ZstdDecompressor(dict_data=dict_data).decompress(payload)
+    else:
+        raise ChapterTextError(f'Unknown chapter text codec {codec!r}')
+    return data.decode('utf-8')
+
+
+def encode(text):
+    """(content, content_compressed) column values storing ``text``; one of them is None."""
+    if text is None:
+        return None, None
+    codec, dict_id, dictionary = storage_settings()
+    if not codec or len(text.encode('utf-8')) < MIN_COMPRESS_BYTES:
+        return text, None
+    blob = compress(text, codec, dict_id, dictionary)
+    if len(blob) >= len(text.encode('utf-8')):
+        return text, None
+    return None, blob
+
+
+def decode(content, content_compressed):
+    """The text stored in a chapter's content and content_compressed columns."""
+    if content_compressed is not None:
+        return decompress(content_compressed)
+    return content
+
+
+def is_current(content, content_compressed):
+    """Whether a chapter is already stored the way encode() would store it now."""
+    codec, dict_id, _ = storage_settings()
+    if content_compressed is None:
+        return not codec or len(content.encode('utf-8')) < MIN_COMPRESS_BYTES
+    return codec is not None and HEADER.unpack_from(content_compressed) == (CODECS[codec], dict_id)
+
+
+def train_dictionary(codec, samples, size):
+    """A compression dictionary of at most ``size`` bytes built from sample texts."""
+    if codec == 'zstd':
+        _require_zstandard()
+        return zstandard.train_dictionary(size, [sample.encode('utf-8') for sample in samples]).as_bytes()
+    # zlib takes any bytes as a dictionary and only uses its last 32 KiB. The
+    # most common words go last, where they are cheapest to refer back to
+    size = min(size, ZLIB_DICTIONARY_BYTES)
+    counts = Counter(word for sample in samples for word in sample.split())
+    words = []
+    length = 0
+    for word, _ in counts.most_common():
+        word = word.encode('utf-8') + b' '
+        if length + len(word) > size:
+            break
+        words.append(word)
+        length += len(word)
+    return b''.join(reversed(words))
@@ -0,0 +1,218 @@
+from collections import namedtuple
+import click
+from flask import current_app
+from flask.cli import AppGroup, with_appcontext
+from sqlalchemy import bindparam, case, func, select
+from sqlalchemy.orm import undefer_group
+from app.models import db, Chapter, CHAPTER_EXCERPT_LENGTH
+from app import chapter_text
+from app.utils import count_words
+
+# Chapter listings and saving.
+#
+# Story pages list chapters from chapter_index(), which reads only the columns
+# a table of contents needs; chapter text is loaded one chapter at a time by
+# the reader (stories.read_chapter), so a very long story's overview doesn't
+# fetch or send the whole book. Chapter.content is deferred, so loading
+# Chapter objects doesn't read the text either; what needs it (the reader,
+# the edit form and exports) asks for it with undefer_group('text'). The
+# text may be stored compressed; see app/chapter_text.py.
+#
+# The story edit form posts every chapter, with the id of the row it was loaded from
+# (empty for chapters added in the browser). Saving applies the difference
+# to the existing rows rather than deleting and re-inserting the lot, so a
+# typo fixed in one chapter of a long story writes one row, chapter ids stay
+# stable, and PostgreSQL isn't left with a dead tuple per chapter. Each kind
+# of change is a single statement however many chapters it touches:
+#
+#   DELETE ... WHERE id IN (...)                      chapters removed
+#   UPDATE ... (executemany)                          titles or text changed
+#   UPDATE ... SET chapter_number = CASE id ... END   chapters moved
+#   INSERT ... (executemany)                          chapters added
+#
+# Statements are only issued for kinds of change that happened.
+
+ChapterEntry = namedtuple('ChapterEntry', ['id', 'chapter_number', 'title', 'word_count', 'excerpt'])
+SavedChapter = namedtuple('SavedChapter', ['id', 'chapter_number', 'title', 'content', 'word_count'])
+
+chapter_table = Chapter.__table__
+
+RECOMPRESS_BATCH_SIZE = 500
+DICTIONARY_SIZE = 112 * 1024
+DICTIONARY_SAMPLES = 2000
+
+
+def chapter_index(story_id):
+    """The story's chapters in order, as ChapterEntry tuples, without their text."""
+    return [
+        ChapterEntry(*row) for row in db.session.execute(
+            select(chapter_table.c.id, chapter_table.c.chapter_number,
+                   chapter_table.c.title, chapter_table.c.word_count, chapter_table.c.excerpt)
+            .where(chapter_table.c.story_id == story_id)
+            .order_by(chapter_table.c.chapter_number, chapter_table.c.id)
+        )
+    ]
+
+
+def chapters_with_text(story_id, batch_size=None):
+    """The story's Chapter objects in order, with their text loaded.
+
+    Given ``batch_size``, returns an iterator that loads that many chapters at
+    a time instead of a list of them all.
+    """
+    query = (Chapter.query.options(undefer_group('text'))
+             .filter_by(story_id=story_id)
+             .order_by(Chapter.chapter_number, Chapter.id))
+    return query.yield_per(batch_size) if batch_size else query.all()
+
+
+def _text_values(content):
+    """Column values storing ``content``, as the Chapter.content setter would set them."""
+    plain, compressed = chapter_text.encode(content)
+    return {'content': plain, 'content_compressed': compressed,
+            'word_count': count_words(content), 'excerpt': content[:CHAPTER_EXCERPT_LENGTH]}
+
+
+def parse_chapter_form(ids, titles, contents):
+    """(id or None, title, content) for each non-empty chapter posted, in order."""
+    # Forms from before ids were posted, or built by hand, may not send them
+    ids = list(ids) + [''] * (len(titles) - len(ids))
+    chapters = []
+    for chapter_id, title, content in zip(ids, titles, contents):
+        if title and content:  # Only keep non-empty chapters
+            chapters.append((int(chapter_id) if chapter_id.isdigit() else None, title, content))
+    return chapters
+
+
+def save_chapters(story, posted):
+    """Make the story's chapter rows match ``posted`` (see parse_chapter_form).
+
+    Returns the saved chapters in order, as SavedChapter tuples.
+    """
+    existing = {
+        row.id: row for row in db.session.execute(
+            select(chapter_table.c.id, chapter_table.c.chapter_number,
+                   chapter_table.c.title, chapter_table.c.content, chapter_table.c.content_compressed)
+            .where(chapter_table.c.story_id == story.id)
+        )
+    }
+
+    saved = []
+    changed = []
+    moved = {}
+    added = []
+    kept = set()
+    for number, (chapter_id, title, content) in enumerate(posted, 1):
+        row = existing.get(chapter_id)
+        if row is None or chapter_id in kept:
+            # New, or an id that isn't one of this story's chapters
+            added.append({'story_id': story.id, 'chapter_number': number, 'title': title, **_text_values(content)})
+            saved.append(SavedChapter(None, number, title, content, added[-1]['word_count']))
+            continue
+        kept.add(chapter_id)
+        if row.title != title or chapter_text.decode(row.content, row.content_compressed) != content:
+            changed.append({'chapter_id': chapter_id, 'title': title, **_text_values(content)})
+        if row.chapter_number != number:
+            moved[chapter_id] = number
+        saved.append(SavedChapter(chapter_id, number, title, content, count_words(content)))
+
+    removed = set(existing) - kept
+    if removed:
+        db.session.execute(chapter_table.delete().where(chapter_table.c.id.in_(removed)))
+    if changed:
+        db.session.execute(
+            chapter_table.update()
+            .where(chapter_table.c.id == bindparam('chapter_id'))
+            .values({column: bindparam(column) for column in changed[0] if column != 'chapter_id'}),
+            changed,
+        )
+    if moved:
+        db.session.execute(
+            chapter_table.update()
+            .where(chapter_table.c.id.in_(moved))
+            .values(chapter_number=case(moved, value=chapter_table.c.id))
+        )
+    if added:
+        db.session.execute(chapter_table.insert(), added)
+
+    # Chapter objects already loaded into the session are out of date now
+    db.session.expire(story, ['chapters'])
+    return saved
+
+
+chapters_cli = AppGroup('chapters', help='Manage chapter text storage.')
+
+
+@chapters_cli.command('recompress')
+@click.option('--batch-size', type=int, default=RECOMPRESS_BATCH_SIZE, show_default=True,
+              help='Chapters read and written per transaction.')
+@with_appcontext
+def recompress(batch_size):
+    """Store every chapter the way CHAPTER_COMPRESSION and CHAPTER_DICTIONARY say.
+
+    Compresses plain chapters, re-compresses those stored with another codec
+    or dictionary, or with compression turned off, stores them all as text.
+    """
+    last_id = 0
+    converted = before = after = 0
+    while True:
+        # In id order, a batch at a time, so only one batch of text is in memory
+        rows = db.session.execute(
+            select(chapter_table.c.id, chapter_table.c.content, chapter_table.c.content_compressed)
+            .where(chapter_table.c.id > last_id)
+            .order_by(chapter_table.c.id)
+            .limit(batch_size)
+        ).all()
+        if not rows:
+            break
+        updates = []
+        for row in rows:
+            if chapter_text.is_current(row.content, row.content_compressed):
+                continue
+            plain, compressed = chapter_text.encode(chapter_text.decode(row.content, row.content_compressed))
+            updates.append({'chapter_id': row.id, 'content': plain, 'content_compressed': compressed})
+            before += _stored_size(row.content, row.content_compressed)
+            after += _stored_size(plain, compressed)
+        if updates:
+            db.session.execute(
+                chapter_table.update()
+                .where(chapter_table.c.id == bindparam('chapter_id'))
+                .values(content=bindparam('content'), content_compressed=bindparam('content_compressed')),
+                updates,
+            )
+        db.session.commit()
+        converted += len(updates)
+        last_id = rows[-1].id
+    click.echo(f'Converted {converted} chapters: {before / 1024:.0f} KiB stored as {after / 1024:.0f} KiB.')
+
+
+def _stored_size(content, content_compressed):
+    if content_compressed is not None:
+        return len(content_compressed)
+    return len(content.encode('utf-8'))
+
+
+@chapters_cli.command('train-dictionary')
+@click.argument('path', type=click.Path(dir_okay=False, writable=True))
+@click.option('--size', type=int, default=DICTIONARY_SIZE, show_default=True,
+              help='Largest dictionary to build, in bytes (zlib uses at most 32 KiB).')
+@click.option('--samples', type=int, default=DICTIONARY_SAMPLES, show_default=True,
+              help='Chapters to learn from.')
+@with_appcontext
+def train_dictionary(path, size, samples):
+    """Build a compression dictionary from existing chapters and write it to PATH.
+
+    Set CHAPTER_DICTIONARY to PATH, then run recompress to use it.
+    """
+    codec = current_app.config.get('CHAPTER_COMPRESSION')
+    if not codec:
+        raise click.UsageError('Set CHAPTER_COMPRESSION to the codec the dictionary is for.')
+    texts = [chapter.content for chapter in
+             Chapter.query.options(undefer_group('text')).order_by(func.random()).limit(samples)]
+    if not texts:
+        raise click.UsageError('There are no chapters to learn from.')
+    dictionary = chapter_text.train_dictionary(codec, texts, size)
+    with open(path, 'wb') as f:
+        f.write(dictionary)
+    click.echo(f'Wrote a {len(dictionary) / 1024:.0f} KiB {codec} dictionary '
+               f'({chapter_text.dictionary_id(dictionary):08x}) learnt from {len(texts)} chapters.')
@@ -0,0 +1,60 @@
+import json
+from collections import namedtuple
+from app.models import db
+from app.cache import VersionedCache, catalogue_generation
+
+# Result counts for paginated listings, in three tiers:
+#
+# 1. Unfiltered listings of a large catalogue use the PostgreSQL planner's
+#    row estimate (pg_class.reltuples, or an EXPLAIN estimate when the table
+#    has never been analyzed) and are shown as "more than N".
+# 2. Everything else gets an exact COUNT, cached per normalized filter until
+#    the catalogue generation changes or the entry expires.
+# 3. A cache miss runs the COUNT.
+
+StoryCount = namedtuple('StoryCount', ['total', 'approximate'])
+
+COUNT_CACHE_SIZE = 1024
+COUNT_CACHE_TTL = 60  # seconds
+APPROXIMATE_THRESHOLD = 10000  # Below this an exact count is cheap enough
+
+
+count_cache = VersionedCache(COUNT_CACHE_SIZE, COUNT_CACHE_TTL)
+
+
+def estimate_rows(query):
+    """Planner row estimate for a single-entity query, or None where the database can't provide one."""
+    if db.engine.dialect.name != 'postgresql':
+        return None
+    table_name = query.column_descriptions[0]['entity'].__tablename__
+    reltuples = db.session.execute(
+        db.text('SELECT reltuples FROM pg_class WHERE relname = :name'), {'name': table_name}
+    ).scalar()
+    if reltuples is not None and reltuples >= 0:
+        return int(reltuples)
+    # Never analyzed (reltuples = -1), so ask the planner about the query itself
+    compiled = query.statement.compile(db.engine, compile_kwargs={'literal_binds': True})
+    plan = db.session.execute(db.text(f'EXPLAIN (FORMAT JSON) {compiled}')).scalar()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]['Plan']['Plan Rows'])
+
+
+def count_stories(query, key, filtered=True):
+    """Return a StoryCount for a listing query.
+
+    ``key`` identifies the listing and its normalized filter for caching.
+    Pass ``filtered=False`` for a listing of the whole catalogue, which may be
+    answered with an approximate planner estimate.
+    """
+    if not filtered:
+        estimate = estimate_rows(query)
+        if estimate is not None and estimate >= APPROXIMATE_THRESHOLD:
+            return StoryCount(estimate, True)
+
+    generation = catalogue_generation()
+    total = count_cache.get(key, generation)
+    if total is None:
+        total = query.count()
+        count_cache.set(key, generation, total)
+    return StoryCount(total, False)
@@ -0,0 +1,112 @@
+import os
+import secrets
+import threading
+from collections import namedtuple
+from flask import current_app
+from app.utils import spawn_pool
+from app.models import db, Story
+from app.covers import (check_upload, process_cover_image, cover_files, cover_files_of, remove_files,
+                        remove_after_commit, remove_after_rollback, InvalidCover)
+
+# Cover uploads, processed by a pool of worker processes.
+#
+# Decoding and resizing a camera-sized upload is hundreds of milliseconds of
+# CPU and tens of megabytes of memory, which used to happen inside the request
+# with the story's transaction open. Now the request only saves the upload to
+# COVER_INCOMING_FOLDER, checks its header and marks the story with a pending
+# tag (templates show a placeholder meanwhile), then commits and hands the
+# file to a worker once the story is saved. When the renditions are ready the
+# story is updated from the pool's callback thread, unless a newer upload or
+# a removal has replaced the cover since, in which case its files are dropped.
+# The previous cover's files go once the new one is committed.
+
+CoverUpload = namedtuple('CoverUpload', ['story_id', 'tag', 'path'])
+
+_lock = threading.Lock()
+_executor = None
+_jobs = {}  # story id -> event set once its latest upload has been dealt with
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        _executor = spawn_pool(current_app.config['COVER_WORKERS'])
+    return _executor
+
+
+def stage_cover(story, file):
+    """Save an uploaded cover for processing and mark ``story`` as waiting for it.
+
+    Raises InvalidCover if the upload isn't an image we take. Pass the
+    returned CoverUpload to submit_cover() once the story is committed.
+    """
+    folder = current_app.config['COVER_INCOMING_FOLDER']
+    os.makedirs(folder, exist_ok=True)
+    tag = secrets.token_hex(8)
+    path = os.path.join(folder, f'{story.id}-{tag}')
+    file.save(path)
+    try:
+        check_upload(path, current_app.config['COVER_MAX_PIXELS'])
+    except InvalidCover:
+        os.remove(path)
+        raise
+    story.cover_pending = tag
+    return CoverUpload(story.id, tag, path)
+
+
+def _finish(app, upload, done, future):
+    """Record a processed cover on its story; runs in the pool's callback thread."""
+    renditions = None
+    if not future.cancelled():
+        if future.exception() is None:
+            renditions = future.result()
+        else:
+            app.logger.error('Processing the cover of story %s failed: %s', upload.story_id, future.exception())
+    new = cover_files_of(renditions)
+    try:
+        with app.app_context():
+            try:
+                story = Story.query.get(upload.story_id)
+                if story is None or story.cover_pending != upload.tag:
+                    # Deleted, or the cover was replaced or removed meanwhile. Files
+                    # are named by content, so the current cover may share some
+                    current = cover_files(story) if story is not None else []
+                    remove_files(os.path.join(app.static_folder, path) for path in set(new) - set(current))
+                    return
+                if renditions:
+                    old = cover_files(story)
+                    remove_after_rollback(set(new) - set(old))
+                    remove_after_commit(set(old) - set(new))
+                    story.cover_image = renditions[app.config['COVER_RENDITIONS'][-1][0]]['jpeg']
+                    story.cover_renditions = renditions
+                story.cover_pending = None
+                db.session.commit()
+            finally:
+                db.session.remove()
+    finally:
+        try:
+            os.remove(upload.path)
+        except OSError:
+            pass
+        with _lock:
+            if _jobs.get(upload.story_id) is done:
+                del _jobs[upload.story_id]
+        done.set()
+
+
+def submit_cover(upload):
+    """Process a staged cover upload in the worker pool."""
+    app = current_app._get_current_object()
+    config = {key: app.config[key] for key in ('COVER_SIZE', 'COVER_RENDITIONS', 'COVER_PRINT_SIZE', 'COVER_MAX_PIXELS', 'UPLOAD_FOLDER')}
+    done = threading.Event()
+    with _lock:
+        _jobs[upload.story_id] = done
+    future = _get_executor().submit(process_cover_image, upload.path, upload.story_id, config)
+    future.add_done_callback(lambda future: _finish(app, upload, done, future))
+
+
+def wait_for_cover(story_id, timeout=None):
+    """Wait for the story's latest cover upload; return True if it has been dealt with."""
+    with _lock:
+        done = _jobs.get(story_id)
+    return done is None or done.wait(timeout)
@@ -0,0 +1,303 @@
+import hashlib
+import io
+import math
+import os
+from concurrent.futures import ProcessPoolExecutor
+import click
+from flask import current_app
+from flask.cli import AppGroup, with_appcontext
+from PIL import Image, UnidentifiedImageError
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from app.models import db, Story
+
+# Cover images.
+#
+# Every upload is cropped to the COVER_SIZE aspect ratio once and saved as a
+# set of renditions, one per COVER_RENDITIONS width, each as JPEG and WebP.
+# Story cards are 128 CSS pixels wide, so the home feed can send a thumbnail
+# of a few kilobytes (the card rendition on high-density screens) instead of
+# the full 512x800 cover. The renditions are recorded on the story as
+#
+#     {'thumb': {'width': 128, 'height': 200, 'jpeg': 'uploads/1-thumb-<hash>.jpg',
+#                'webp': 'uploads/1-thumb-<hash>.webp'}, ...}
+#
+# which templates/cover.html turns into srcset/sizes. The full JPEG is also
+# Story.cover_image, which exports use.
+#
+# Files are named after a hash of their content and never rewritten, so
+# app/uploads.py can let browsers and proxies cache them for good. A new
+# cover gets new names; the old files are deleted only once the change of
+# cover is committed, and files written for a transaction that rolls back are
+# deleted with it (remove_after_commit, remove_after_rollback).
+#
+# Uploads are processed off the request by app/cover_jobs.py. Only their
+# header is read in the request; the worker decodes JPEGs at the smallest
+# 1/2, 1/4 or 1/8 scale that still covers the full rendition (Image.draft),
+# and refuses anything over COVER_MAX_PIXELS before decoding it at all.
+
+COVER_FORMATS = (
+    # (key, Pillow format, extension, save options)
+    ('webp', 'WEBP', 'webp', {'quality': 80, 'method': 6}),
+    ('jpeg', 'JPEG', 'jpg', {'quality': 85, 'optimize': True, 'progressive': True}),
+)
+
+# PDF exports embed this one as it is: reportlab copies baseline JPEG data
+# straight into the PDF without decoding it
+PRINT_RENDITION = 'print'
+PRINT_OPTIONS = {'quality': 90, 'optimize': True}
+
+UPLOAD_FORMATS = {'JPEG', 'PNG', 'GIF'}
+RESIZE_REDUCING_GAP = 3.0
+DIGEST_LENGTH = 16  # Hex digits of the content hash in rendition file names
+BACKFILL_BATCH_SIZE = 100
+
+
+class InvalidCover(Exception):
+    """Raised for uploads that aren't images we take, or are too large to decode."""
+
+
+def crop_to_ratio(img, size):
+    """Crop ``img`` around its centre to the aspect ratio of ``size``."""
+    target_ratio = size[0] / size[1]
+    img_ratio = img.width / img.height
+
+    if img_ratio > target_ratio:
+        # Image is wider than target ratio
+        new_width = int(img.height * target_ratio)
+        left = (img.width - new_width) // 2
+        return img.crop((left, 0, left + new_width, img.height))
+    # Image is taller than target ratio
+    new_height = int(img.width / target_ratio)
+    top = (img.height - new_height) // 2
+    return img.crop((0, top, img.width, top + new_height))
+
+
+def rendition_filename(story_id, name, extension, data):
+    """Name a rendition by its content, so a name never has to change what it serves."""
+    digest = hashlib.sha256(data).hexdigest()[:DIGEST_LENGTH]
+    return f'{story_id}-{name}-{digest}.{extension}'
+
+
+def _write_file(path, data):
+    if os.path.exists(path):
+        # Content-addressed, so it already holds these bytes
+        return
+    temp_path = f'{path}.{os.getpid()}.tmp'
+    with open(temp_path, 'wb') as f:
+        f.write(data)
+    os.replace(temp_path, path)
+
+
+def _save(img, folder, story_id, name, format, extension, options):
+    buffer = io.BytesIO()
+    img.save(buffer, format, **options)
+    data = buffer.getvalue()
+    filename = rendition_filename(story_id, name, extension, data)
+    _write_file(os.path.join(folder, filename), data)
+    return f'uploads/{filename}'
+
+
+def render_cover(img, folder, story_id, widths, size, print_size=None, keep=None):
+    """Save the renditions of an image already cropped to ``size``'s ratio.
+
+    ``widths`` is COVER_RENDITIONS, smallest first. With ``print_size``, a
+    baseline JPEG for PDF exports is saved too, as large as the image allows
+    up to that size but never smaller than the full rendition. ``keep`` names
+    an existing full-size JPEG, relative to the static folder, to record
+    instead of a re-encoded copy (the backfill renders from it). Returns the
+    renditions as recorded on the story.
+    """
+    os.makedirs(folder, exist_ok=True)
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+    full_name, full_width = widths[-1]
+    renditions = {}
+    if print_size is not None:
+        width = max(min(img.width, print_size[0]), full_width)
+        height = round(width * size[1] / size[0])
+        if img.size != (width, height):
+            img = img.resize((width, height), Image.Resampling.LANCZOS, reducing_gap=RESIZE_REDUCING_GAP)
+        renditions[PRINT_RENDITION] = {
+            'width': width, 'height': height,
+            'jpeg': _save(img, folder, story_id, PRINT_RENDITION, 'JPEG', 'jpg', PRINT_OPTIONS),
+        }
+    # Largest first, each downscaled from the one before
+    for name, width in reversed(widths):
+        height = round(width * size[1] / size[0])
+        if img.size != (width, height):
+            # Shrinks by a whole factor with a box filter first, like thumbnail()
+            img = img.resize((width, height), Image.Resampling.LANCZOS, reducing_gap=RESIZE_REDUCING_GAP)
+        rendition = {'width': width, 'height': height}
+        for key, format, extension, options in COVER_FORMATS:
+            if keep is not None and name == full_name and key == 'jpeg':
+                rendition[key] = keep
+            else:
+                rendition[key] = _save(img, folder, story_id, name, format, extension, options)
+        renditions[name] = rendition
+    return dict(reversed(renditions.items()))
+
+
+def check_upload(path, max_pixels):
+    """Read just the header of an uploaded image and make sure it is one we take.
+
+    Raises InvalidCover otherwise. Nothing is decoded, so this is cheap
+    enough to run inside the request.
+    """
+    try:
+        with Image.open(path) as img:
+            if img.format not in UPLOAD_FORMATS:
+                raise InvalidCover('Invalid file type. Allowed types: png, jpg, jpeg, gif')
+            if img.width * img.height > max_pixels:
+                raise InvalidCover(f'Cover image is too large ({img.width}x{img.height} pixels).')
+    except (UnidentifiedImageError, Image.DecompressionBombError, OSError) as e:
+        raise InvalidCover(f'Could not read cover image: {e}')
+
+
+def open_cover(path, size, max_pixels, decode_size=None):
+    """Open an upload, cropped to ``size``'s ratio and decoded no larger than needed.
+
+    The crop is at least ``decode_size`` (default ``size``) where the image
+    is large enough.
+    """
+    decode_size = decode_size or size
+    with Image.open(path) as img:
+        if img.width * img.height > max_pixels:
+            raise InvalidCover(f'Cover image is too large ({img.width}x{img.height} pixels).')
+        # Scale of the largest crop of the cover's shape relative to decode_size.
+        # JPEGs can be decoded at 1/2, 1/4 or 1/8 of their size for a fraction
+        # of the time and memory of a full decode; draft() picks the smallest
+        # scale that still leaves the crop at least decode_size.
+        scale = min(img.width / decode_size[0], img.height / decode_size[1])
+        if scale >= 2:
+            img.draft('RGB', (math.ceil(img.width / scale), math.ceil(img.height / scale)))
+        return crop_to_ratio(img, size)
+
+
+def process_cover_image(path, story_id, config):
+    """Crop an uploaded cover and save its renditions; returns them."""
+    size = config['COVER_SIZE']
+    print_size = config['COVER_PRINT_SIZE']
+    with open_cover(path, size, config['COVER_MAX_PIXELS'], print_size) as img:
+        return render_cover(img, config['UPLOAD_FOLDER'], story_id, config['COVER_RENDITIONS'], size, print_size)
+
+
+def cover_files_of(renditions):
+    """Paths, relative to the static folder, of the files of a set of renditions."""
+    return sorted({rendition[key] for rendition in (renditions or {}).values()
+                   for key, _, _, _ in COVER_FORMATS if key in rendition})
+
+
+def cover_files(story):
+    """Paths, relative to the static folder, of every file of the story's cover."""
+    paths = set(cover_files_of(story.cover_renditions))
+    if story.cover_image:
+        paths.add(story.cover_image)
+    return sorted(paths)
+
+
+def remove_cover(story):
+    """Clear the story's cover; its files are deleted once that is committed."""
+    remove_after_commit(cover_files(story))
+    story.cover_image = None
+    story.cover_renditions = None
+    story.cover_pending = None  # A cover still being processed is discarded
+
+
+def remove_after_commit(paths):
+    """Delete these cover files (relative to the static folder) if the session commits."""
+    db.session.info.setdefault('cover_garbage', set()).update(
+        os.path.join(current_app.static_folder, path) for path in paths)
+
+
+def remove_after_rollback(paths):
+    """Delete these newly written cover files if the session rolls back instead."""
+    db.session.info.setdefault('cover_written', set()).update(
+        os.path.join(current_app.static_folder, path) for path in paths)
+
+
+def remove_files(paths):
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            current_app.logger.warning('Could not remove cover file %s: %s', path, e)
+
+
+@event.listens_for(Session, 'after_commit')
+def _collect_garbage(session):
+    session.info.pop('cover_written', None)
+    garbage = session.info.pop('cover_garbage', None)
+    if garbage:
+        remove_files(garbage)
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _discard_written(session, previous_transaction):
+    session.info.pop('cover_garbage', None)
+    written = session.info.pop('cover_written', None)
+    if written:
+        remove_files(written)
+
+
+def _backfill_one(static_folder, cover_image, folder, story_id, widths, size, print_size, max_pixels):
+    # Runs in a worker process
+    with open_cover(os.path.join(static_folder, cover_image), size, max_pixels, print_size) as img:
+        # Covers saved before renditions existed are already the full JPEG
+        keep = cover_image if img.size == size else None
+        return story_id, render_cover(img, folder, story_id, widths, size, print_size, keep=keep)
+
+
+covers_cli = AppGroup('covers', help='Manage story cover images.')
+
+
+@covers_cli.command('backfill')
+@click.option('--workers', type=int, default=os.cpu_count(), show_default=True,
+              help='Processes rendering covers.')
+@click.option('--all', 'everything', is_flag=True,
+              help='Regenerate every cover, not just those without renditions.')
+@with_appcontext
+def backfill_covers(workers, everything):
+    """Generate cover renditions for existing stories."""
+    stories = Story.query.filter(Story.cover_image.isnot(None)).order_by(Story.id).all()
+    if not everything:
+        # Without renditions, or from before there was a print rendition
+        stories = [story for story in stories if PRINT_RENDITION not in (story.cover_renditions or {})]
+
+    folder = current_app.config['UPLOAD_FOLDER']
+    widths = current_app.config['COVER_RENDITIONS']
+    size = current_app.config['COVER_SIZE']
+    print_size = current_app.config['COVER_PRINT_SIZE']
+    max_pixels = current_app.config['COVER_MAX_PIXELS']
+    table = Story.__table__
+    done = failed = 0
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(_backfill_one, current_app.static_folder, story.cover_image,
+                            folder, story.id, widths, size, print_size, max_pixels)
+            for story in stories
+        ]
+        for story, future in zip(stories, futures):
+            try:
+                story_id, renditions = future.result()
+            except Exception as e:
+                failed += 1
+                click.echo(f'Failed: {e}', err=True)
+                continue
+            new = cover_files_of(renditions)
+            remove_after_rollback(set(new) - set(cover_files(story)))
+            remove_after_commit(set(cover_files(story)) - set(new))
+            # Setting last_updated to itself stops onupdate from bumping it
+            db.session.execute(
+                table.update()
+                .where(table.c.id == story_id)
+                .values(cover_image=renditions[widths[-1][0]]['jpeg'], cover_renditions=renditions,
+                        last_updated=table.c.last_updated)
+            )
+            done += 1
+            if done % BACKFILL_BATCH_SIZE == 0:
+                db.session.commit()
+    db.session.commit()
+    click.echo(f'Generated renditions for {done} covers ({failed} failed).')
@@ -0,0 +1,250 @@
+import logging
+import zipfile
+from html import escape
+from app.zipstream import StreamBuffer
+
+logger = logging.getLogger(__name__)
+
+# EPUB 3 writer for story exports.
+#
+# The container is built with zipfile straight into a StreamBuffer that is
+# drained after every file, so iter_epub() can hand the book to its
+# consumer (a cache file, a response, a ZIP of several books) piece by piece.
+# Chapter XHTML is produced one chapter at a time as it is written, so peak
+# memory is one chapter's markup rather than the whole book's. Nothing touches
+# the filesystem except reading the cover image.
+
+MIMETYPE = 'application/epub+zip'
+
+STYLE = '''
+body {
+    font-family: Cambria, Liberation Serif, Bitstream Vera Serif, Georgia, Times, Times New Roman, serif;
+}
+.title-page {
+    text-align: center;
+    margin: 4em 0;
+}
+.title-page .title {
+    font-size: 2em;
+    margin-bottom: 0.5em;
+}
+.title-page .author {
+    font-size: 1.5em;
+    color: #666;
+}
+.metadata {
+    margin: 2em 0;
+}
+.metadata h2 {
+    color: #666;
+    margin-top: 1em;
+    margin-bottom: 0.5em;
+}
+.metadata p {
+    margin: 0 0 1em 0;
+}
+'''
+
+CONTAINER = '''<?xml version="1.0" encoding="utf-8"?>
+<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">
+  <rootfiles>
+    <rootfile full-path="EPUB/content.opf" media-type="application/oebps-package+xml"/>
+  </rootfiles>
+</container>
+'''
+
+
+def _page(title, body):
+    return f'''<?xml version="1.0" encoding="utf-8"?>
+<!DOCTYPE html>
+<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops" lang="en" xml:lang="en">
+<head>
+  <title>{escape(title)}</title>
+  <link rel="stylesheet" type="text/css" href="style/nav.css"/>
+</head>
+<body>
+{body}
+</body>
+</html>
+'''
+
+
+def _paragraphs(text):
+    return '\n'.join(f'<p>{escape(line.strip())}</p>' for line in (text or '').splitlines() if line.strip())
+
+
+def _date(value):
+    return value.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def _chapter_file(chapter):
+    return f'chapter_{chapter.chapter_number}.xhtml'
+
+
+def _title_page(story):
+    return _page('Title Page', f'''<div class="title-page">
+  <h1 class="title">{escape(story.title)}</h1>
+  <h2 class="author">by {escape(story.author)}</h2>
+</div>''')
+
+
+def _metadata_page(story):
+    rating = ''
+    if story.rating_count:
+        rating = f'<p>Average Rating: {story.average_rating:.1f} ({story.rating_count} ratings)</p>'
+    return _page('Story Information', f'''<h1>Story Information</h1>
+<div class="metadata">
+  <h2>Tags</h2>
+  <p>{escape(", ".join(story.tags)) if story.tags else "No tags"}</p>
+
+  <h2>Description</h2>
+  <p>{escape(story.description) if story.description else "No description"}</p>
+
+  <h2>Statistics</h2>
+  <p>Chapters: {story.chapter_count}</p>
+  <p>Word Count: {story.word_count}</p>
+  {rating}
+  <p>Upload Date: {story.created_at.strftime('%B %d, %Y at %I:%M %p UTC')}</p>
+  <p>Last Updated: {story.last_updated.strftime('%B %d, %Y at %I:%M %p UTC')}</p>
+</div>''')
+
+
+def _chapter_page(chapter):
+    heading = f'Chapter {chapter.chapter_number}: {chapter.title}'
+    return _page(chapter.title, f'<h1>{escape(heading)}</h1>\n{_paragraphs(chapter.content)}')
+
+
+def _package(story, has_cover):
+    metadata = [
+        f'<dc:identifier id="id">story_{story.id}</dc:identifier>',
+        f'<dc:title>{escape(story.title)}</dc:title>',
+        '<dc:language>en</dc:language>',
+        f'<dc:creator id="creator">{escape(story.author)}</dc:creator>',
+        f'<dc:date>{_date(story.created_at)}</dc:date>',
+        f'<meta property="dcterms:modified">{_date(story.last_updated)}</meta>',
+    ]
+    if story.tags:
+        metadata.append(f'<dc:subject>{escape(", ".join(story.tags))}</dc:subject>')
+    if story.rating_count:
+        metadata.append(f'<meta name="rating" content="{story.average_rating:.1f}"/>')
+        metadata.append(f'<meta name="rating_count" content="{story.rating_count}"/>')
+
+    manifest = [
+        '<item id="nav" href="nav.xhtml" media-type="application/xhtml+xml" properties="nav"/>',
+        '<item id="ncx" href="toc.ncx" media-type="application/x-dtbncx+xml"/>',
+        '<item id="style_nav" href="style/nav.css" media-type="text/css"/>',
+        '<item id="title" href="title.xhtml" media-type="application/xhtml+xml"/>',
+        '<item id="metadata" href="metadata.xhtml" media-type="application/xhtml+xml"/>',
+    ]
+    spine = ['nav', 'title', 'metadata']
+    if has_cover:
+        metadata.append('<meta name="cover" content="cover-image"/>')
+        manifest.append('<item id="cover-image" href="cover.jpg" media-type="image/jpeg" properties="cover-image"/>')
+        manifest.append('<item id="cover" href="cover.xhtml" media-type="application/xhtml+xml"/>')
+        spine.insert(0, 'cover')
+    for chapter in story.chapters:
+        item_id = f'chapter_{chapter.chapter_number}'
+        manifest.append(f'<item id="{item_id}" href="{_chapter_file(chapter)}" media-type="application/xhtml+xml"/>')
+        spine.append(item_id)
+
+    newline = '\n    '
+    return f'''<?xml version="1.0" encoding="utf-8"?>
+<package xmlns="http://www.idpf.org/2007/opf" version="3.0" unique-identifier="id" xml:lang="en">
+  <metadata xmlns:dc="http://purl.org/dc/elements/1.1/">
+    {newline.join(metadata)}
+  </metadata>
+  <manifest>
+    {newline.join(manifest)}
+  </manifest>
+  <spine toc="ncx">
+    {newline.join(f'<itemref idref="{item}"/>' for item in spine)}
+  </spine>
+</package>
+'''
+
+
+def _toc(story):
+    """The navigation document (EPUB 3) and NCX (for EPUB 2 readers)."""
+    chapters = ''
+    if story.chapters:
+        links = '\n'.join(
+            f'      <li><a href="{_chapter_file(chapter)}">{escape(chapter.title)}</a></li>'
+            for chapter in story.chapters
+        )
+        chapters = f'\n    <li><span>Chapters</span>\n      <ol>\n{links}\n      </ol>\n    </li>'
+    nav = _page(story.title, f'''<nav epub:type="toc" id="toc">
+  <h1>{escape(story.title)}</h1>
+  <ol>
+    <li><a href="title.xhtml">Title Page</a></li>
+    <li><a href="metadata.xhtml">Story Information</a></li>{chapters}
+  </ol>
+</nav>''')
+
+    points = [('title', 'Title Page', 'title.xhtml'), ('metadata', 'Story Information', 'metadata.xhtml')]
+    points += [(f'chapter_{chapter.chapter_number}', chapter.title, _chapter_file(chapter))
+               for chapter in story.chapters]
+    nav_points = '\n'.join(
+        f'''    <navPoint id="{point_id}" playOrder="{order}">
+      <navLabel><text>{escape(label)}</text></navLabel>
+      <content src="{href}"/>
+    </navPoint>'''
+        for order, (point_id, label, href) in enumerate(points, 1)
+    )
+    ncx = f'''<?xml version="1.0" encoding="utf-8"?>
+<ncx xmlns="http://www.daisy.org/z3986/2005/ncx/" version="2005-1">
+  <head>
+    <meta name="dtb:uid" content="story_{story.id}"/>
+  </head>
+  <docTitle><text>{escape(story.title)}</text></docTitle>
+  <navMap>
+{nav_points}
+  </navMap>
+</ncx>
+'''
+    return nav, ncx
+
+
+def iter_epub(story):
+    """Yield an EPUB of a StorySnapshot as consecutive chunks of bytes."""
+    buffer = StreamBuffer()
+    # Entries are stamped with the story's last update, so the same version of
+    # a story always produces byte-identical books
+    timestamp = story.last_updated.timetuple()[:6]
+
+    def add(book, name, data, compress_type=zipfile.ZIP_DEFLATED):
+        book.writestr(zipfile.ZipInfo(name, timestamp), data, compress_type=compress_type)
+
+    cover = None
+    if story.cover_path:
+        try:
+            with open(story.cover_path, 'rb') as f:
+                cover = f.read()
+        except OSError as e:
+            logger.warning('Could not add the cover of story %s: %s', story.id, e)
+
+    with zipfile.ZipFile(buffer, 'w') as book:
+        # The mimetype has to come first, uncompressed
+        add(book, 'mimetype', MIMETYPE, zipfile.ZIP_STORED)
+        add(book, 'META-INF/container.xml', CONTAINER)
+        add(book, 'EPUB/content.opf', _package(story, cover is not None))
+        nav, ncx = _toc(story)
+        add(book, 'EPUB/nav.xhtml', nav)
+        add(book, 'EPUB/toc.ncx', ncx)
+        add(book, 'EPUB/style/nav.css', STYLE)
+        if cover is not None:
+            add(book, 'EPUB/cover.jpg', cover, zipfile.ZIP_STORED)
+            add(book, 'EPUB/cover.xhtml', _page('Cover', '<img src="cover.jpg" alt="Cover"/>'))
+        add(book, 'EPUB/title.xhtml', _title_page(story))
+        add(book, 'EPUB/metadata.xhtml', _metadata_page(story))
+        yield buffer.drain()
+
+        for chapter in story.chapters:
+            add(book, f'EPUB/{_chapter_file(chapter)}', _chapter_page(chapter))
+            yield buffer.drain()
+    yield buffer.drain()
+
+
+def write_epub(story, out):
+    """Write a StorySnapshot as an EPUB to the binary file object ``out``."""
+    for chunk in iter_epub(story):
+        out.write(chunk)
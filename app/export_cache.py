@@ -0,0 +1,134 @@
+import hashlib
+import os
+import tempfile
+import threading
+from flask import current_app
+from app.exports import WRITERS, discard_snapshot
+from app.covers import PRINT_RENDITION
+
+# On-disk cache of generated PDF and EPUB downloads.
+#
+# An export only depends on the story's content, which every edit stamps with
+# a new last_updated, its rating counters, its cover and the code that renders
+# it. Files are stored under a hash of exactly those inputs, so a cached export
+# can be served as-is (with the hash as its ETag) and is never invalidated;
+# exports of old story versions just stop being asked for and age out. The
+# cache directory is kept under EXPORT_CACHE_MAX_BYTES by deleting the least
+# recently served files first, using modification times that are refreshed on
+# every hit.
+# Exports are rendered by the worker pool in app/export_jobs.py.
+
+# Bump whenever app/exports.py changes what it writes
+EXPORT_FORMAT_VERSION = 4
+
+_lock = threading.Lock()
+_stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'evicted_bytes': 0}
+
+
+def export_key(story, format):
+    """Content address of one export of one version of a story."""
+    parts = [
+        story.id,
+        story.last_updated.isoformat(),
+        story.rating_count,
+        story.rating_sum,
+        # Cover files are named by content, so this changes with the cover
+        # even when last_updated doesn't
+        (story.cover_renditions or {}).get(PRINT_RENDITION, {}).get('jpeg', story.cover_image),
+        format,
+        EXPORT_FORMAT_VERSION,
+    ]
+    return hashlib.sha256(':'.join(str(part) for part in parts).encode()).hexdigest()
+
+
+def export_path(folder, key, format):
+    return os.path.join(folder, f'{key}.{format}')
+
+
+def cache_folder():
+    folder = current_app.config['EXPORT_CACHE_FOLDER']
+    os.makedirs(folder, exist_ok=True)
+    return folder
+
+
+def _count(name, amount=1):
+    with _lock:
+        _stats[name] += amount
+
+
+def find_export(story, format):
+    """Return ``(path, key)`` for a cached export of ``story``; ``path`` is None on a miss."""
+    key = export_key(story, format)
+    path = export_path(cache_folder(), key, format)
+    try:
+        # Mark as recently used for eviction
+        os.utime(path)
+    except FileNotFoundError:
+        _count('misses')
+        return None, key
+    _count('hits')
+    return path, key
+
+
+def render_export(snapshot, format, path):
+    """Write an export of a StorySnapshot to ``path``. Runs in an export worker process."""
+    # Write to a private temporary file and move it into place, so concurrent
+    # requests never see (or serve) a half-written export
+    fd, partial = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.partial')
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            WRITERS[format](snapshot, out)
+        os.replace(partial, path)
+    except BaseException:
+        os.unlink(partial)
+        raise
+    finally:
+        discard_snapshot(snapshot)
+    return path
+
+
+def evict(folder, max_bytes, keep=None):
+    """Delete least recently used exports until ``folder`` fits in ``max_bytes``."""
+    files = []
+    total = 0
+    for entry in os.scandir(folder):
+        if entry.name.endswith('.partial') or not entry.is_file():
+            continue
+        try:
+            stat = entry.stat()
+        except FileNotFoundError:
+            continue
+        files.append((stat.st_mtime, stat.st_size, entry.path))
+        total += stat.st_size
+
+    files.sort()
+    for _, size, path in files:
+        if total <= max_bytes:
+            break
+        if path == keep:
+            continue
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+        _count('evictions')
+        _count('evicted_bytes', size)
+    return total
+
+
+def export_cache_stats():
+    """Hit, miss and eviction counters for this process, plus the cache's current size."""
+    folder = cache_folder()
+    sizes = [entry.stat().st_size for entry in os.scandir(folder)
+             if entry.is_file() and not entry.name.endswith('.partial')]
+    with _lock:
+        stats = dict(_stats)
+    lookups = stats['hits'] + stats['misses']
+    stats.update({
+        'files': len(sizes),
+        'bytes': sum(sizes),
+        'max_bytes': current_app.config['EXPORT_CACHE_MAX_BYTES'],
+        'hit_rate': round(stats['hits'] / lookups, 3) if lookups else None,
+    })
+    return stats
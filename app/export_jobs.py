@@ -0,0 +1,153 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from flask import current_app
+from app.utils import spawn_pool
+from app.exports import snapshot_story, discard_snapshot
+from app.export_cache import export_key, export_path, cache_folder, render_export, evict
+
+# Export jobs, rendered by a pool of worker processes.
+#
+# Laying out a long PDF is seconds of CPU-bound reportlab work, which would
+# otherwise hold a request thread (and the GIL) for the whole time. Requests
+# snapshot the story and hand it to a ProcessPoolExecutor instead. A job is
+# identified by its export cache key, so asking for an export that is already
+# queued or running joins the existing job rather than rendering it twice.
+# Finished exports land in the export cache, which is what downloads serve.
+#
+# EXPORT_WORKERS sets the number of worker processes and EXPORT_QUEUE_DEPTH how
+# many jobs may be waiting or running at once before new ones are turned away.
+
+FINISHED_JOBS_KEPT = 1024  # Finished jobs remembered for status requests
+
+_lock = threading.Lock()
+_executor = None
+_jobs = OrderedDict()
+
+
+class ExportQueueFull(Exception):
+    """Raised when EXPORT_QUEUE_DEPTH jobs are already waiting or running."""
+
+
+class ExportJob:
+    """One export being rendered, or already rendered, into the export cache."""
+
+    def __init__(self, key, story_id, format, path, future=None):
+        self.key = key
+        self.story_id = story_id
+        self.format = format
+        self.path = path
+        self.future = future
+        self.submitted_at = time.time()
+
+    @property
+    def status(self):
+        if self.future is None:
+            return 'done'
+        if self.future.running():
+            return 'running'
+        if not self.future.done():
+            return 'queued'
+        return 'failed' if self.future.exception() is not None else 'done'
+
+    @property
+    def finished(self):
+        return self.future is None or self.future.done()
+
+    def wait(self, timeout=None):
+        """Wait up to ``timeout`` seconds; return True if the export is ready."""
+        if self.future is not None:
+            try:
+                self.future.result(timeout=timeout)
+            except Exception:
+                return False
+        return True
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        _executor = spawn_pool(current_app.config['EXPORT_WORKERS'])
+    return _executor
+
+
+def _forget_finished():
+    finished = [key for key, job in _jobs.items() if job.finished]
+    for key in finished[:max(0, len(finished) - FINISHED_JOBS_KEPT)]:
+        del _jobs[key]
+
+
+def _reusable(job):
+    # Failed jobs are retried, and finished ones may have been evicted since
+    if job is None or job.status == 'failed':
+        return False
+    return not job.finished or os.path.exists(job.path)
+
+
+def submit_export(story, format):
+    """Return the ExportJob for an export of ``story``, queueing it if needed.
+
+    Raises ExportQueueFull when the queue is at EXPORT_QUEUE_DEPTH.
+    """
+    key = export_key(story, format)
+    folder = cache_folder()
+    path = export_path(folder, key, format)
+    with _lock:
+        job = _jobs.get(key)
+        if _reusable(job):
+            return job
+    if os.path.exists(path):
+        # Rendered earlier, possibly by another server process
+        return ExportJob(key, story.id, format, path)
+
+    # Taken outside the lock, this spools every chapter; the worker deletes
+    # the spool once it has rendered the export
+    snapshot = snapshot_story(story)
+    max_bytes = current_app.config['EXPORT_CACHE_MAX_BYTES']
+    with _lock:
+        job = _jobs.get(key)
+        if _reusable(job):
+            discard_snapshot(snapshot)
+            return job
+        pending = sum(1 for job in _jobs.values() if not job.finished)
+        if pending >= current_app.config['EXPORT_QUEUE_DEPTH']:
+            discard_snapshot(snapshot)
+            raise ExportQueueFull()
+        future = _get_executor().submit(render_export, snapshot, format, path)
+        future.add_done_callback(lambda future: evict(folder, max_bytes, keep=path))
+        job = _jobs[key] = ExportJob(key, story.id, format, path, future)
+        _forget_finished()
+    return job
+
+
+def queue_full():
+    """Whether new exports would be turned away right now."""
+    with _lock:
+        pending = sum(1 for job in _jobs.values() if not job.finished)
+    return pending >= current_app.config['EXPORT_QUEUE_DEPTH']
+
+
+def forget_job(job):
+    """Drop a failed job, so the next request for its export starts a new one."""
+    with _lock:
+        if _jobs.get(job.key) is job:
+            del _jobs[job.key]
+
+
+def get_job(key):
+    """Return the ExportJob with this key, or None if this process doesn't know it."""
+    with _lock:
+        return _jobs.get(key)
+
+
+def queue_stats():
+    """Jobs by status, for /metrics/cache."""
+    with _lock:
+        jobs = list(_jobs.values())
+    counts = {'queued': 0, 'running': 0, 'done': 0, 'failed': 0}
+    for job in jobs:
+        counts[job.status] += 1
+    counts['workers'] = current_app.config['EXPORT_WORKERS']
+    counts['queue_depth'] = current_app.config['EXPORT_QUEUE_DEPTH']
+    return counts
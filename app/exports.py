@@ -0,0 +1,123 @@
+import os
+import tempfile
+from collections import namedtuple
+from flask import current_app
+from app.epub_writer import write_epub
+from app.pdf_writer import write_pdf
+from app.covers import PRINT_RENDITION
+from app.chapters import chapters_with_text
+
+# PDF and EPUB builders for story downloads.
+#
+# Writers run in export worker processes (see app/export_jobs.py), away from
+# the database session, so they are given a StorySnapshot: plain copies of
+# everything an export shows, taken while the request still has the Story.
+# Each writer takes a snapshot and a binary file object and writes the
+# finished document to it.
+#
+# The chapter text itself isn't copied into the snapshot, which would put the
+# whole book in memory in the request process and again in the worker. It is
+# read from the database SPOOL_BATCH_CHAPTERS chapters at a time and written
+# to a spool file next to the export cache; the snapshot's chapters only say
+# where in that file their text is, and each one reads it when its content is
+# asked for. Writers go through the chapters in order, so at most about one
+# chapter's text is held at a time. The spool is deleted with
+# discard_snapshot() once the export has been rendered.
+
+SPOOL_BATCH_CHAPTERS = 16
+
+StorySnapshot = namedtuple('StorySnapshot', [
+    'id', 'title', 'author', 'description', 'tags',
+    'chapter_count', 'word_count', 'rating_count', 'average_rating',
+    'created_at', 'last_updated', 'cover_path', 'cover_print', 'chapters', 'spool',
+], defaults=[None])
+ChapterSnapshot = namedtuple('ChapterSnapshot', ['chapter_number', 'title', 'content'])
+
+
+class SpooledChapter(namedtuple('SpooledChapter', ['chapter_number', 'title', 'path', 'offset', 'length'])):
+    """A ChapterSnapshot whose text stays in the spool file until it is read."""
+
+    __slots__ = ()
+
+    @property
+    def content(self):
+        with open(self.path, 'rb') as f:
+            f.seek(self.offset)
+            return f.read(self.length).decode('utf-8')
+
+EXPORT_MIMETYPES = {
+    'pdf': 'application/pdf',
+    'epub': 'application/epub+zip',
+}
+
+
+def spool_chapters(chapters, folder):
+    """Write the text of ``chapters`` to a new spool file in ``folder``.
+
+    Returns the SpooledChapters and the spool's path.
+    """
+    fd, path = tempfile.mkstemp(dir=folder, suffix='.chapters.partial')
+    spooled = []
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            for chapter in chapters:
+                data = (chapter.content or '').encode('utf-8')
+                spooled.append(SpooledChapter(chapter.chapter_number, chapter.title, path, f.tell(), len(data)))
+                f.write(data)
+    except BaseException:
+        os.unlink(path)
+        raise
+    return spooled, path
+
+
+def discard_snapshot(snapshot):
+    """Delete a snapshot's spool file, if it has one."""
+    if snapshot.spool:
+        try:
+            os.unlink(snapshot.spool)
+        except FileNotFoundError:
+            pass
+
+
+def snapshot_story(story):
+    """Copy what the writers need out of a Story, so it can be sent to another process.
+
+    Pass the snapshot to discard_snapshot() when done with it.
+    """
+    cover_path = cover_print = None
+    if story.cover_image:
+        cover_path = os.path.join(current_app.static_folder, story.cover_image)
+        # (path, width, height) of the JPEG PDFs embed as it is. Covers from
+        # before there was a print rendition are a COVER_SIZE JPEG
+        rendition = (story.cover_renditions or {}).get(PRINT_RENDITION)
+        if rendition:
+            cover_print = (os.path.join(current_app.static_folder, rendition['jpeg']),
+                           rendition['width'], rendition['height'])
+        else:
+            cover_print = (cover_path, *current_app.config['COVER_SIZE'])
+    folder = current_app.config['EXPORT_CACHE_FOLDER']
+    os.makedirs(folder, exist_ok=True)
+    chapters, spool = spool_chapters(chapters_with_text(story.id, batch_size=SPOOL_BATCH_CHAPTERS), folder)
+    return StorySnapshot(
+        id=story.id,
+        title=story.title,
+        author=story.author.username,
+        description=story.description,
+        tags=[tag.name for tag in story.tags],
+        chapter_count=story.chapter_count,
+        word_count=story.word_count,
+        rating_count=story.rating_count,
+        average_rating=story.average_rating,
+        created_at=story.created_at,
+        last_updated=story.last_updated,
+        cover_path=cover_path,
+        cover_print=cover_print,
+        chapters=chapters,
+        spool=spool,
+    )
+
+
+WRITERS = {
+    'pdf': write_pdf,
+    'epub': write_epub,
+}
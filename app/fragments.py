@@ -0,0 +1,74 @@
+import sys
+from flask import current_app
+from markupsafe import Markup
+from app.models import Story
+from app.queries import card_options
+from app.cache import SizedCache
+
+# Rendered story cards, cached per story version.
+#
+# A card only depends on the story row, its author and its tags, and every
+# edit to those bumps Story.last_updated; votes change the rating counters
+# instead. So (last_updated, rating_count, rating_sum) identifies a rendered
+# card exactly, and a cached card never needs invalidating, only replacing.
+# Listings load plain Story rows, look their cards up here, and load authors
+# and tags (in one batch) only for the stories whose card has to be rendered.
+#
+# Page-specific parts of a card (search snippets, the saved date in a library,
+# edit buttons on a profile) are kept out of the cached HTML: the card macro is
+# rendered around a placeholder and stored as the markup before and after it.
+
+CARD_CACHE_BYTES = 8 * 1024 * 1024
+
+EXTRAS_PLACEHOLDER = Markup('\x00extras\x00')
+
+card_cache = SizedCache(CARD_CACHE_BYTES)
+
+
+class StoryCard:
+    """A cached story card. Call it, or use it in a ``{% call %}`` block to add extras."""
+
+    __slots__ = ('head', 'tail')
+
+    def __init__(self, head, tail):
+        self.head = head
+        self.tail = tail
+
+    def __call__(self, caller=None):
+        extras = caller() if caller is not None else ''
+        return self.head + extras + self.tail
+
+    @property
+    def size(self):
+        return sys.getsizeof(self.head) + sys.getsizeof(self.tail)
+
+
+def card_version(story):
+    return (story.last_updated, story.rating_count, story.rating_sum)
+
+
+def _render_card(story):
+    macro = current_app.jinja_env.get_template('story_card.html').module.story_card
+    head, tail = str(macro(story, EXTRAS_PLACEHOLDER)).split(EXTRAS_PLACEHOLDER)
+    return StoryCard(Markup(head), Markup(tail))
+
+
+def story_cards(stories):
+    """Return {story id: StoryCard} for ``stories``, rendering any that aren't cached."""
+    cards = {}
+    missing = []
+    for story in stories:
+        card = card_cache.get(story.id, card_version(story))
+        if card is None:
+            missing.append(story)
+        else:
+            cards[story.id] = card
+
+    if missing:
+        # Load authors and tags for everything about to be rendered in one go
+        Story.query.options(*card_options()).filter(Story.id.in_([story.id for story in missing])).all()
+        for story in missing:
+            card = _render_card(story)
+            card_cache.set(story.id, card_version(story), card, card.size)
+            cards[story.id] = card
+    return cards
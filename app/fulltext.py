@@ -0,0 +1,164 @@
+import re
+from markupsafe import Markup, escape
+from sqlalchemy import DDL, event, text
+from app.models import db, Story
+
+# Full-text index over story title, description, tags and chapter content.
+#
+# PostgreSQL keeps a weighted tsvector in story.search_vector behind a GIN
+# index. SQLite (tests and local development) keeps an FTS5 shadow table,
+# story_fts, whose rowid is the story id. Both are created alongside the story
+# table and refreshed by index_story() whenever a story is written or edited.
+
+# Sentinels wrapped around matches by the database, swapped for <mark> tags
+# after the snippet text has been HTML-escaped
+MARK_START = '\x02'
+MARK_END = '\x03'
+SNIPPET_WORDS = 16
+
+event.listen(Story.__table__, 'after_create', DDL(
+    'ALTER TABLE story ADD COLUMN search_vector tsvector'
+).execute_if(dialect='postgresql'))
+event.listen(Story.__table__, 'after_create', DDL(
+    'CREATE INDEX ix_story_search_vector ON story USING GIN (search_vector)'
+).execute_if(dialect='postgresql'))
+event.listen(Story.__table__, 'after_create', DDL(
+    'CREATE VIRTUAL TABLE story_fts USING fts5(title, description, tags, content)'
+).execute_if(dialect='sqlite'))
+event.listen(Story.__table__, 'before_drop', DDL(
+    'DROP TABLE IF EXISTS story_fts'
+).execute_if(dialect='sqlite'))
+
+# Title outranks description and tags, which outrank chapter text. Chapter
+# text is stripped of positions so long stories stay under the 1MB tsvector limit.
+# It is passed in rather than read from the chapter table, where it may be
+# stored compressed (see app/chapter_text.py).
+POSTGRES_REINDEX = text('''
+    UPDATE story SET search_vector =
+        setweight(to_tsvector('english', coalesce(story.title, '')), 'A') ||
+        setweight(to_tsvector('english', coalesce(story.description, '') || ' ' || coalesce(
+            (SELECT string_agg(tag.name, ' ') FROM tag
+             JOIN story_tags ON story_tags.tag_id = tag.id
+             WHERE story_tags.story_id = story.id), '')), 'B') ||
+        strip(to_tsvector('english', :content))
+    WHERE story.id = :story_id
+''')
+
+
+def _dialect():
+    return db.engine.dialect.name
+
+
+def _terms(search_query):
+    """Split free text into plain word terms, dropping any query syntax."""
+    return re.findall(r'\w+', search_query.lower())
+
+
+def _tsquery(terms):
+    # The last term is matched as a prefix so results keep up with typing
+    return ' & '.join(terms) + ':*'
+
+
+def _fts_query(terms):
+    return ' '.join(f'"{term}"' for term in terms) + '*'
+
+
+def index_story(story, chapters):
+    """Refresh the search index entry for a story.
+
+    Must run after the story's chapters and tags have been added to the
+    session; the index is updated inside the same transaction.
+    """
+    dialect = _dialect()
+    if dialect == 'postgresql':
+        db.session.flush()
+        db.session.execute(POSTGRES_REINDEX, {
+            'story_id': story.id,
+            'content': ' '.join(chapter.content for chapter in chapters),
+        })
+    elif dialect == 'sqlite':
+        remove_story(story.id)
+        db.session.execute(text(
+            'INSERT INTO story_fts (rowid, title, description, tags, content) '
+            'VALUES (:story_id, :title, :description, :tags, :content)'
+        ), {
+            'story_id': story.id,
+            'title': story.title or '',
+            'description': story.description or '',
+            'tags': ' '.join(tag.name for tag in story.tags),
+            'content': '\n'.join(chapter.content for chapter in chapters),
+        })
+
+
+def remove_story(story_id):
+    """Drop a story from the search index (PostgreSQL rows go with the story itself)."""
+    if _dialect() == 'sqlite':
+        db.session.execute(text('DELETE FROM story_fts WHERE rowid = :story_id'), {'story_id': story_id})
+
+
+def search_hits(search_query):
+    """Return a subquery of (story_id, rank) for stories matching free text.
+
+    Lower rank is a better match on both backends. Returns None when the query has no searchable words or the database has no
+    full-text support, in which case callers fall back to substring matching.
+    """
+    terms = _terms(search_query)
+    if not terms:
+        return None
+    dialect = _dialect()
+    if dialect == 'postgresql':
+        return text('''
+            SELECT id AS story_id, -ts_rank_cd(search_vector, query) AS rank
+            FROM story, to_tsquery('english', :tsquery) query
+            WHERE search_vector @@ query
+        ''').bindparams(tsquery=_tsquery(terms)).columns(
+            db.column('story_id', db.Integer), db.column('rank', db.Float)
+        ).subquery('search_hits')
+    if dialect == 'sqlite':
+        # Column weights follow the PostgreSQL setweight() order above
+        return text('''
+            SELECT rowid AS story_id, bm25(story_fts, 10.0, 4.0, 4.0, 1.0) AS rank
+            FROM story_fts WHERE story_fts MATCH :fts_query
+        ''').bindparams(fts_query=_fts_query(terms)).columns(
+            db.column('story_id', db.Integer), db.column('rank', db.Float)
+        ).subquery('search_hits')
+    return None
+
+
+def _highlight(snippet):
+    if not snippet:
+        return None
+    return Markup(str(escape(snippet)).replace(MARK_START, '<mark>').replace(MARK_END, '</mark>'))
+
+
+def snippets(search_query, story_ids):
+    """Return {story_id: highlighted Markup snippet} for one page of results."""
+    terms = _terms(search_query)
+    if not terms or not story_ids:
+        return {}
+    dialect = _dialect()
+    if dialect == 'postgresql':
+        statement = text('''
+            SELECT id, ts_headline('english', coalesce(description, title), to_tsquery('english', :tsquery), :options)
+            FROM story WHERE id IN :story_ids
+        ''')
+        params = {
+            'tsquery': _tsquery(terms),
+            'options': f'StartSel={MARK_START}, StopSel={MARK_END}, MinWords={SNIPPET_WORDS // 2}, MaxWords={SNIPPET_WORDS}',
+        }
+    elif dialect == 'sqlite':
+        statement = text('''
+            SELECT rowid, snippet(story_fts, -1, :start, :end, '…', :words)
+            FROM story_fts WHERE story_fts MATCH :fts_query AND rowid IN :story_ids
+        ''')
+        params = {
+            'fts_query': _fts_query(terms),
+            'start': MARK_START,
+            'end': MARK_END,
+            'words': SNIPPET_WORDS,
+        }
+    else:
+        return {}
+    params['story_ids'] = list(story_ids)
+    statement = statement.bindparams(db.bindparam('story_ids', expanding=True))
+    return {story_id: _highlight(snippet) for story_id, snippet in db.session.execute(statement, params)}
@@ -1,14 +1,63 @@
-from flask import Blueprint, render_template, redirect, url_for, flash
+from flask import Blueprint, render_template, redirect, url_for, flash, request, abort, jsonify, stream_with_context, current_app
 from flask_login import login_required, current_user
 from app.models import db, SavedStory, Story
+from app.queries import saved_story_cards
+from app.fragments import story_cards
+from app.exports import EXPORT_MIMETYPES
+from app.library_export import iter_library_zip, acquire_slot, release_slot, TooManyLibraryExports
+from app.export_jobs import queue_full
 
 library = Blueprint('library', __name__)
 
 @library.route('/library')
 @login_required
 def view_library():
-    saved_stories = SavedStory.query.filter_by(user_id=current_user.id).order_by(SavedStory.saved_at.desc()).all()
-    return render_template('library.html', saved_stories=saved_stories)
+    saved_stories = saved_story_cards(current_user.id).all()
+    cards = story_cards([saved.story for saved in saved_stories])
+    return render_template('library.html', saved_stories=saved_stories, cards=cards)
+
+@library.route('/library/download/<format>')
+@login_required
+def download_library(format):
+    if format not in EXPORT_MIMETYPES:
+        abort(404)
+    stories = [saved.story for saved in saved_story_cards(current_user.id)]
+    # Optionally just a selection of the library
+    selected = set(request.args.getlist('story_id', type=int))
+    if selected:
+        stories = [story for story in stories if story.id in selected]
+    if not stories:
+        flash('There are no stories in your library to download.')
+        return redirect(url_for('library.view_library'))
+
+    if queue_full():
+        return jsonify({'error': 'Too many exports in progress, try again shortly.'}), 503, {'Retry-After': '10'}
+    user_id = current_user.id
+    try:
+        acquire_slot(user_id)
+    except TooManyLibraryExports:
+        return jsonify({'error': 'Your library is already being downloaded.'}), 429, {'Retry-After': '30'}
+    released = []
+
+    def release():
+        # Runs when the ZIP is finished and again when the response closes
+        if not released:
+            released.append(True)
+            release_slot(user_id)
+
+    def generate():
+        try:
+            yield from iter_library_zip(stories, format)
+        finally:
+            release()
+
+    response = current_app.response_class(
+        stream_with_context(generate()),
+        mimetype='application/zip',
+        headers={'Content-Disposition': f'attachment; filename="library-{format}.zip"'},
+    )
+    response.call_on_close(release)
+    return response
 
 @library.route('/save_story/<int:story_id>', methods=['POST'])
 @login_required
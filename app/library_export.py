@@ -0,0 +1,158 @@
+import os
+import re
+import threading
+import time
+import zipfile
+from collections import deque
+from flask import current_app
+from app.export_cache import find_export
+from app.export_jobs import submit_export, ExportQueueFull
+from app.zipstream import StreamBuffer
+
+# "Download my library": a reader's saved stories as one ZIP of EPUBs or PDFs.
+#
+# The ZIP is streamed to the client as it is assembled. Books already in the
+# export cache are copied straight in; missing ones are queued on the export
+# worker pool a few at a time (LIBRARY_EXPORT_PARALLEL) ahead of the book
+# currently being sent, so rendering overlaps with the download. Each reader
+# may only run LIBRARY_EXPORTS_PER_USER of these downloads at once. That count
+# is kept in memory, so the cap applies per server process: a reader whose
+# requests land on different processes can run that many in each.
+#
+# When the worker pool is full before anything has been sent, the download
+# is answered with 503 like single exports. Once the ZIP is streaming, a book
+# waits at most LIBRARY_QUEUE_WAIT_SECONDS for room on the pool and is left
+# out with a note if none comes; later books then get a single try each, so a
+# busy pool can't hold the request for long. Likewise a book whose render
+# isn't done within LIBRARY_RENDER_WAIT_SECONDS is left out with a note.
+
+COPY_CHUNK_SIZE = 256 * 1024
+QUEUE_RETRY_SECONDS = 1
+
+UNSAFE_FILENAME_RE = re.compile(r'[\x00-\x1f\\/:*?"<>|]+')
+
+_lock = threading.Lock()
+_active = {}  # user id -> library downloads in progress
+
+
+class TooManyLibraryExports(Exception):
+    """Raised when a reader already has LIBRARY_EXPORTS_PER_USER downloads running."""
+
+
+def acquire_slot(user_id):
+    with _lock:
+        if _active.get(user_id, 0) >= current_app.config['LIBRARY_EXPORTS_PER_USER']:
+            raise TooManyLibraryExports()
+        _active[user_id] = _active.get(user_id, 0) + 1
+
+
+def release_slot(user_id):
+    with _lock:
+        _active[user_id] -= 1
+        if not _active[user_id]:
+            del _active[user_id]
+
+
+def archive_names(stories, format):
+    """File names for the books in the archive, made safe and unique."""
+    names = []
+    seen = set()
+    for story in stories:
+        base = UNSAFE_FILENAME_RE.sub('_', story.title).strip(' .') or f'story_{story.id}'
+        name = f'{base}.{format}'
+        if name in seen:
+            name = f'{base} ({story.id}).{format}'
+        seen.add(name)
+        names.append(name)
+    return names
+
+
+def _queue(story, format, wait):
+    """Submit an export, waiting up to ``wait`` seconds for room on the worker pool.
+
+    Returns None if there was no room in time.
+    """
+    deadline = time.monotonic() + wait
+    while True:
+        try:
+            return submit_export(story, format)
+        except ExportQueueFull:
+            if time.monotonic() + QUEUE_RETRY_SECONDS > deadline:
+                return None
+            time.sleep(QUEUE_RETRY_SECONDS)
+
+
+def _ready_exports(stories, format):
+    """Yield (story, path) in archive order, rendering missing exports ahead of time.
+
+    ``path`` is None when the export could not be rendered.
+    """
+    parallel = current_app.config['LIBRARY_EXPORT_PARALLEL']
+    wait = current_app.config['LIBRARY_QUEUE_WAIT_SECONDS']
+    render_wait = current_app.config['LIBRARY_RENDER_WAIT_SECONDS']
+    pending = deque()  # (story, cached path or None, job or None)
+    upcoming = iter(stories)
+
+    def queue(story):
+        nonlocal wait
+        job = _queue(story, format, wait)
+        if job is None:
+            # The pool stayed full; don't wait on it again
+            wait = 0
+        return job
+
+    def top_up():
+        # Keep up to ``parallel`` renders in flight beyond the book being sent
+        while sum(1 for _, _, job in pending if job is not None) < parallel:
+            story = next(upcoming, None)
+            if story is None:
+                return
+            path, _ = find_export(story, format)
+            pending.append((story, path, None if path else queue(story)))
+
+    top_up()
+    while pending:
+        story, path, job = pending.popleft()
+        top_up()
+        if job is None and path is not None and not os.path.exists(path):
+            # Evicted since it was looked up
+            path = None
+            job = queue(story)
+        if job is not None:
+            path = job.path if job.wait(render_wait) else None
+        yield story, path
+
+
+def iter_library_zip(stories, format):
+    """Yield a ZIP of ``stories`` exported as ``format``."""
+    buffer = StreamBuffer(seekable=False)
+    names = archive_names(stories, format)
+    with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        for name, (story, path) in zip(names, _ready_exports(stories, format)):
+            try:
+                source = open(path, 'rb') if path else None
+            except FileNotFoundError:
+                source = None
+            if source is None:
+                # Leave a note rather than abort the whole download
+                archive.writestr(f'{name}.error.txt', 'This story could not be exported, please try again later.')
+                yield buffer.drain()
+                continue
+            # Sizes can only follow the data in a data descriptor here, which
+            # readers don't accept for stored entries. EPUBs and PDFs are
+            # compressed already, so they are deflated at level 0 instead:
+            # stored blocks inside a deflate stream, which marks its own end
+            info = zipfile.ZipInfo(name, story.last_updated.timetuple()[:6])
+            info.compress_type = zipfile.ZIP_DEFLATED
+            # ZipFile.open() has no compresslevel argument; the ZipInfo's
+            # attribute is public as compress_level from Python 3.13
+            if hasattr(info, 'compress_level'):
+                info.compress_level = 0
+            else:
+                info._compresslevel = 0
+            with source, archive.open(info, 'w') as entry:
+                for chunk in iter(lambda: source.read(COPY_CHUNK_SIZE), b''):
+                    entry.write(chunk)
+                    yield buffer.drain()
+            yield buffer.drain()
+    yield buffer.drain()
@@ -0,0 +1,35 @@
+from flask import Blueprint, jsonify, current_app, abort
+from flask_login import login_required
+from app.page_cache import page_cache
+from app.fragments import card_cache
+from app.export_cache import export_cache_stats
+from app.export_jobs import queue_stats
+from app.counts import count_cache
+from app.author_stats import stats_cache
+from app.search_query import plan_cache_info
+
+# Cache counters for this worker process, for sizing and tuning the caches.
+# Off unless CACHE_METRICS is set, and then only for logged in users.
+
+metrics = Blueprint('metrics', __name__)
+
+@metrics.route('/metrics/cache')
+@login_required
+def cache_metrics():
+    if not current_app.config['CACHE_METRICS']:
+        abort(404)
+    plans = plan_cache_info()
+    return jsonify({
+        'pages': page_cache.stats(),
+        'story_cards': card_cache.stats(),
+        'exports': export_cache_stats(),
+        'export_jobs': queue_stats(),
+        'counts': count_cache.stats(),
+        'author_stats': stats_cache.stats(),
+        'search_plans': {
+            'entries': plans.currsize,
+            'max_entries': plans.maxsize,
+            'hits': plans.hits,
+            'misses': plans.misses,
+        },
+    })
@@ -1,6 +1,11 @@
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import UserMixin
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import deferred
+from sqlalchemy.ext.hybrid import hybrid_property
 from datetime import datetime
+from app.utils import count_words
+from app import chapter_text
 
 db = SQLAlchemy()
 
@@ -28,31 +33,77 @@ class Story(db.Model):
     description = db.Column(db.Text, nullable=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     cover_image = db.Column(db.String(255), nullable=True)  # Store image path
+    cover_renditions = db.Column(db.JSON(none_as_null=True), nullable=True)  # Sizes and formats, see app/covers.py
+    cover_pending = db.Column(db.String(16), nullable=True)  # Tag of an upload still being processed
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     last_updated = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     chapters = db.relationship('Chapter', backref='story', lazy=True, order_by='Chapter.chapter_number', cascade='all, delete-orphan')
     ratings = db.relationship('Rating', backref='story', lazy=True, cascade='all, delete-orphan')
     saved_by = db.relationship('SavedStory', backref=db.backref('story', lazy=True), lazy=True, cascade='all, delete-orphan')
 
-    @property
-    def word_count(self):
-        total_words = 0
-        for chapter in self.chapters:
-            total_words += len(chapter.content.split())
-        return total_words
+    # Denormalized statistics so story cards never have to load chapters or ratings
+    word_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    chapter_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    rating_sum = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    rating_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+
+    # Word-count sorts and filters are range scans over (word_count, id)
+    __table_args__ = (
+        db.Index('ix_story_word_count', 'word_count', 'id'),
+    )
 
     @property
     def average_rating(self):
-        if not self.ratings:
+        if not self.rating_count:
             return 0
-        return sum(rating.value for rating in self.ratings) / len(self.ratings)
+        return self.rating_sum / self.rating_count
+
+    rating_stats = db.relationship('StoryRatingStats', backref='story', uselist=False, lazy=True, cascade='all, delete-orphan')
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        # Every story gets a (possibly empty) rating histogram row
+        if self.rating_stats is None:
+            self.rating_stats = StoryRatingStats()
+
+    def refresh_chapter_stats(self, chapters):
+        """Recompute chapter_count and word_count from the story's current chapters."""
+        self.chapter_count = len(chapters)
+        self.word_count = sum(chapter.word_count for chapter in chapters)
+
+# Characters of chapter text kept in Chapter.excerpt
+CHAPTER_EXCERPT_LENGTH = 200
 
 class Chapter(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(100), nullable=False)
-    content = db.Column(db.Text, nullable=False)
+    # The text, as plain text or compressed (see app/chapter_text.py); read
+    # and write it through the content property. Deferred: chapter lists only
+    # need the other columns, and a long story's text is megabytes. Code that
+    # reads it loads it with undefer_group('text')
+    _content = deferred(db.Column('content', db.Text, nullable=True), group='text')
+    content_compressed = deferred(db.Column(db.LargeBinary, nullable=True), group='text')
+    # The start of the text, for chapter lists
+    excerpt = db.Column(db.String(CHAPTER_EXCERPT_LENGTH), nullable=False, default='', server_default='')
     chapter_number = db.Column(db.Integer, nullable=False)
     story_id = db.Column(db.Integer, db.ForeignKey('story.id'), nullable=False)
+    word_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+
+    @hybrid_property
+    def content(self):
+        return chapter_text.decode(self._content, self.content_compressed)
+
+    @content.setter
+    def content(self, text):
+        self._content, self.content_compressed = chapter_text.encode(text)
+        # Keep the cached word count and excerpt in step with every assignment
+        self.word_count = count_words(text)
+        self.excerpt = (text or '')[:CHAPTER_EXCERPT_LENGTH]
+
+    @content.expression
+    def content(cls):
+        # Only matches chapters stored as plain text
+        return cls._content
 
 class Rating(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -67,6 +118,76 @@ class Rating(db.Model):
         db.UniqueConstraint('user_id', 'story_id', name='unique_user_story_rating'),
     )
 
+class StoryRatingStats(db.Model):
+    """Per-story histogram of 1-5 star votes, with the average stored so it can be indexed."""
+    __tablename__ = 'story_rating_stats'
+    story_id = db.Column(db.Integer, db.ForeignKey('story.id'), primary_key=True)
+    stars_1 = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    stars_2 = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    stars_3 = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    stars_4 = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    stars_5 = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    rating_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    average = db.Column(db.Float, nullable=False, default=0, server_default='0')  # 0 when unrated
+
+    # Rating filters and sorts are range scans over (average, story_id)
+    __table_args__ = (
+        db.Index('ix_story_rating_stats_average', 'average', 'story_id'),
+    )
+
+    @property
+    def histogram(self):
+        """(stars, votes, percent of votes) from 5 stars down to 1."""
+        return [(stars, getattr(self, f'stars_{stars}'),
+                 100 * getattr(self, f'stars_{stars}') / self.rating_count if self.rating_count else 0)
+                for stars in range(5, 0, -1)]
+
+def _apply_rating_change(connection, story_id, added=0, removed=0):
+    """Adjust a story's rating totals and histogram for one vote being added, changed or removed.
+
+    ``added`` and ``removed`` are the star values entering and leaving the
+    story (0 meaning none). Both updates are relative SQL increments run in
+    the flush's transaction, so concurrent raters can't overwrite each other.
+    """
+    if added == removed:
+        return
+    count_delta = (1 if added else 0) - (1 if removed else 0)
+
+    story = Story.__table__.c
+    connection.execute(Story.__table__.update().where(story.id == story_id).values(
+        rating_sum=story.rating_sum + (added - removed),
+        rating_count=story.rating_count + count_delta,
+        last_updated=story.last_updated,  # A new vote doesn't count as a story update
+    ))
+
+    stats = StoryRatingStats.__table__.c
+    # SET expressions see the old row, so derive the new average from old values plus deltas
+    new_sum = sum(stars * stats[f'stars_{stars}'] for stars in range(1, 6)) + (added - removed)
+    new_count = stats.rating_count + count_delta
+    values = {
+        'rating_count': new_count,
+        'average': db.case((new_count > 0, db.cast(new_sum, db.Float) / new_count), else_=0.0),
+    }
+    if added:
+        values[f'stars_{added}'] = stats[f'stars_{added}'] + 1
+    if removed:
+        values[f'stars_{removed}'] = stats[f'stars_{removed}'] - 1
+    connection.execute(StoryRatingStats.__table__.update().where(stats.story_id == story_id).values(**values))
+
+@event.listens_for(Rating, 'after_insert')
+def _rating_added(mapper, connection, rating):
+    _apply_rating_change(connection, rating.story_id, added=rating.value)
+
+@event.listens_for(Rating, 'after_update')
+def _rating_changed(mapper, connection, rating):
+    history = inspect(rating).attrs.value.history
+    if history.deleted:
+        _apply_rating_change(connection, rating.story_id, added=rating.value, removed=history.deleted[0])
+
+@event.listens_for(Rating, 'after_delete')
+def _rating_removed(mapper, connection, rating):
+    _apply_rating_change(connection, rating.story_id, removed=rating.value)
+
 class SavedStory(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
@@ -0,0 +1,83 @@
+import hashlib
+from functools import wraps
+from flask import request, session, g, current_app
+from app.cache import VersionedCache, catalogue_generation, catalogue_changed_at
+
+# Whole-response cache for anonymous visitors.
+#
+# Public pages (the home feed, story pages and author pages) look the same for
+# every visitor who isn't logged in, so their rendered HTML is kept per path and
+# query string until the catalogue generation changes. Responses carry an ETag
+# and Last-Modified; a conditional request whose ETag still matches the cached
+# entry gets a 304 without any database work at all. Logged in users, and
+# visitors with pending flash messages, always get a freshly rendered page.
+
+PAGE_CACHE_SIZE = 512
+PAGE_CACHE_TTL = 30  # seconds
+
+page_cache = VersionedCache(PAGE_CACHE_SIZE, PAGE_CACHE_TTL)
+
+
+class CachedPage:
+    """A rendered response body plus the validators it was served with."""
+
+    def __init__(self, body, mimetype, etag, last_modified):
+        self.body = body
+        self.mimetype = mimetype
+        self.etag = etag
+        self.last_modified = last_modified
+
+
+def _cacheable():
+    if request.method != 'GET':
+        return False
+    if '_user_id' in session or '_flashes' in session:
+        return False
+    return current_app.config.get('REMEMBER_COOKIE_NAME', 'remember_token') not in request.cookies
+
+
+def _cache_key():
+    return request.path, tuple(sorted(request.args.items(multi=True)))
+
+
+def _send(page, status=200):
+    response = current_app.response_class(page.body if status == 200 else b'', status=status, mimetype=page.mimetype)
+    response.set_etag(page.etag)
+    response.last_modified = page.last_modified
+    response.cache_control.public = True
+    response.cache_control.max_age = 0
+    response.cache_control.must_revalidate = True
+    response.vary.add('Cookie')
+    return response
+
+
+def cached_page(view):
+    """Serve ``view`` from the page cache for anonymous GET requests.
+
+    Views may set ``g.last_modified`` to the newest timestamp behind the page
+    (for example the story's last_updated); otherwise the last catalogue
+    change seen by this process is used.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if not _cacheable():
+            return view(*args, **kwargs)
+
+        key = _cache_key()
+        generation = catalogue_generation()
+        page = page_cache.get(key, generation)
+        if page is not None:
+            if page.etag in request.if_none_match:
+                return _send(page, 304)
+            return _send(page)
+
+        response = current_app.make_response(view(*args, **kwargs))
+        if response.status_code != 200 or response.direct_passthrough:
+            return response
+        last_modified = max(filter(None, (g.get('last_modified'), catalogue_changed_at())))
+        body = response.get_data()
+        etag = hashlib.sha1(repr((key, generation, last_modified)).encode() + body).hexdigest()
+        page = CachedPage(body, response.mimetype, etag, last_modified.replace(microsecond=0))
+        page_cache.set(key, generation, page)
+        return _send(page).make_conditional(request)
+    return wrapper
@@ -0,0 +1,152 @@
+import base64
+import binascii
+import json
+import math
+from sqlalchemy import types
+from app.models import db
+
+# Keyset (cursor) pagination for story listings.
+#
+# Listings are ordered by a list of sort keys, (expression, descending) pairs
+# ending in a unique column such as Story.id. Next/previous links carry an
+# opaque cursor holding the sort key values of the last/first row shown, and
+# the following page is fetched with a WHERE clause that seeks past those
+# values instead of an OFFSET, so page 500 costs the same as page 2. Numbered
+# page links still use OFFSET, but only for the first MAX_NUMBERED_PAGES pages.
+
+MAX_NUMBERED_PAGES = 10
+INT64_RANGE = range(-2 ** 63, 2 ** 63)  # Integer keys are BIGINT at most
+
+
+class Pager:
+    """One page of a keyset-paginated listing, plus what the templates need for links."""
+
+    def __init__(self, items, page, total_pages, has_prev, has_next, prev_cursor, next_cursor, approximate=False):
+        self.items = items
+        self.page = page
+        self.total_pages = total_pages
+        self.approximate = approximate
+        self.has_prev = has_prev
+        self.has_next = has_next
+        self.prev_cursor = prev_cursor
+        self.next_cursor = next_cursor
+
+    @property
+    def numbered_pages(self):
+        """Page numbers that may be linked to directly."""
+        return range(1, min(self.total_pages, MAX_NUMBERED_PAGES) + 1)
+
+    @property
+    def show_last(self):
+        return not self.approximate and self.total_pages <= MAX_NUMBERED_PAGES
+
+    @property
+    def shown_total_pages(self):
+        """Total pages for display; estimates are rounded down to two significant figures."""
+        if not self.approximate or self.total_pages < 100:
+            return self.total_pages
+        scale = 10 ** (len(str(self.total_pages)) - 2)
+        return self.total_pages // scale * scale
+
+
+def encode_cursor(sort_name, values):
+    payload = json.dumps([sort_name, list(values)], separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+
+
+def _fits(value, expression):
+    """Whether a cursor value can be bound against the sort key ``expression``."""
+    if isinstance(value, bool):
+        return False
+    if isinstance(value, int):
+        in_range = value in INT64_RANGE
+    elif isinstance(value, float):
+        in_range = math.isfinite(value)
+    else:
+        return isinstance(value, str) and isinstance(expression.type, types.String)
+    if isinstance(expression.type, types.Integer):
+        return isinstance(value, int) and in_range
+    return isinstance(expression.type, types.Numeric) and in_range
+
+
+def decode_cursor(token, sort_name, keys):
+    """Return the sort key values in a cursor, or None if it is missing, corrupt or for another sort."""
+    if not token:
+        return None
+    try:
+        padded = token + '=' * (-len(token) % 4)
+        cursor_sort, values = json.loads(base64.urlsafe_b64decode(padded.encode()))
+    except (ValueError, TypeError, binascii.Error):
+        return None
+    if cursor_sort != sort_name or not isinstance(values, list) or len(values) != len(keys):
+        return None
+    # Only values of the type and range each key holds; anything else would
+    # fail in the database when bound
+    if not all(_fits(value, expression) for (expression, _), value in zip(keys, values)):
+        return None
+    return values
+
+
+def _seek(keys, values, backwards):
+    """Rows strictly after ``values`` in sort order, or strictly before when going backwards."""
+    alternatives = []
+    for i, ((expression, descending), value) in enumerate(zip(keys, values)):
+        ties = [key[0] == tie for key, tie in zip(keys[:i], values[:i])]
+        if descending != backwards:
+            alternatives.append(db.and_(*ties, expression < value))
+        else:
+            alternatives.append(db.and_(*ties, expression > value))
+    return db.or_(*alternatives)
+
+
+def _order(keys, backwards):
+    return [expression.desc() if descending != backwards else expression.asc()
+            for expression, descending in keys]
+
+
+def paginate(query, keys, sort_name, per_page, count, page=1, after=None, before=None):
+    """Fetch one page of ``query`` ordered by ``keys``.
+
+    ``count`` is the listing's StoryCount. ``after``/``before`` are cursors
+    from a previous Pager; when neither is usable the numbered ``page`` is
+    fetched with OFFSET, clamped to the shallow pages. ``page`` is otherwise
+    only carried along for display.
+    """
+    total_pages = (count.total + per_page - 1) // per_page
+    after_values = decode_cursor(after, sort_name, keys)
+    before_values = None if after_values else decode_cursor(before, sort_name, keys)
+    backwards = before_values is not None
+
+    query = query.order_by(None).order_by(*_order(keys, backwards))
+    query = query.add_columns(*(expression for expression, _ in keys))
+    if after_values:
+        query = query.filter(_seek(keys, after_values, False))
+    elif before_values:
+        query = query.filter(_seek(keys, before_values, True))
+    else:
+        page = max(1, min(page, total_pages, MAX_NUMBERED_PAGES)) if total_pages > 0 else 1
+        query = query.offset((page - 1) * per_page)
+
+    # One extra row tells us whether there is anything beyond this page
+    rows = query.limit(per_page + 1).all()
+    more = len(rows) > per_page
+    rows = rows[:per_page]
+    if backwards:
+        rows.reverse()
+
+    page = max(page, 1)
+    if backwards:
+        has_prev, has_next = more, True
+    else:
+        has_prev, has_next = page > 1 or after_values is not None, more
+
+    return Pager(
+        items=[row[0] for row in rows],
+        page=page,
+        total_pages=total_pages,
+        has_prev=has_prev and bool(rows),
+        has_next=has_next and bool(rows),
+        prev_cursor=encode_cursor(sort_name, rows[0][1:]) if rows else None,
+        next_cursor=encode_cursor(sort_name, rows[-1][1:]) if rows else None,
+        approximate=count.approximate,
+    )
@@ -0,0 +1,216 @@
+import os
+import re
+from xml.sax.saxutils import escape
+from reportlab import rl_config
+from reportlab.lib.pagesizes import letter
+from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, PageBreak
+from reportlab.platypus import Image as RLImage
+
+# PDF writer for story exports.
+#
+# reportlab lays out a Paragraph by rewrapping everything left over each time
+# it splits across a page, so a chapter handed over as one Paragraph costs
+# time quadratic in its length. Chapter text is instead split into its real
+# paragraphs, and overly long ones into runs of PARAGRAPH_CHUNK_WORDS words.
+#
+# The flowables themselves are generated lazily: LazyFlowables hands reportlab
+# a list that is topped up from a generator as layout consumes it, so only a
+# few paragraphs exist at a time however long the story is. Each chapter's
+# text is only read from the snapshot's spool file (see app/exports.py) when
+# layout reaches it, so about one chapter of text is in memory. Every chapter
+# starts on a new page, gets an entry in the PDF outline (the bookmarks
+# sidebar) and is linked from a table of contents after the story information.
+#
+# The cover is the print rendition made when it was uploaded (see
+# app/covers.py): a 300 dpi baseline JPEG that reportlab copies into the PDF
+# without decoding, so exports do no image work of their own.
+
+# Binary streams (the cover JPEG above all) are written as they are rather
+# than ASCII85 encoded, which took longer than the rest of a short story's
+# layout and made them a quarter larger. Nothing else here uses reportlab.
+rl_config.useA85 = 0
+
+PARAGRAPH_CHUNK_WORDS = 400  # Longest paragraph laid out in one piece
+LOOKAHEAD = 8  # Flowables kept ready for reportlab's keep-with-next handling
+
+PARAGRAPH_BREAK_RE = re.compile(r'\n\s*\n')
+
+
+class LazyFlowables(list):
+    """A list of flowables filled from ``source`` as reportlab consumes it.
+
+    reportlab only ever looks at (and splices into) the front of the list, so
+    keeping a few items buffered behaves exactly like the complete list.
+    """
+
+    def __init__(self, source):
+        super().__init__()
+        self.source = iter(source)
+        self.exhausted = False
+
+    def _fill(self, count):
+        while not self.exhausted and super().__len__() < count:
+            try:
+                self.append(next(self.source))
+            except StopIteration:
+                self.exhausted = True
+
+    def __len__(self):
+        self._fill(LOOKAHEAD)
+        return super().__len__()
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            self._fill(index.stop if index.stop is not None else float('inf'))
+        else:
+            self._fill(index + 1 if index >= 0 else float('inf'))
+        return super().__getitem__(index)
+
+
+class Bookmark(Spacer):
+    """Zero-height marker placed where a chapter starts; see StoryDocTemplate."""
+
+    def __init__(self, key, title):
+        super().__init__(0, 0)
+        self.key = key
+        self.title = title
+
+
+class StoryDocTemplate(SimpleDocTemplate):
+    """Adds an outline entry and a link destination at every Bookmark."""
+
+    def afterFlowable(self, flowable):
+        if isinstance(flowable, Bookmark):
+            if not getattr(self, 'outline_shown', False):
+                # Open the PDF with the outline visible
+                self.canv.showOutline()
+                self.outline_shown = True
+            self.canv.bookmarkPage(flowable.key)
+            self.canv.addOutlineEntry(flowable.title, flowable.key, level=0)
+
+
+def split_paragraphs(text, chunk_words=PARAGRAPH_CHUNK_WORDS):
+    """Yield the paragraphs of ``text``, breaking up any longer than ``chunk_words``."""
+    text = (text or '').replace('\r\n', '\n')
+    blocks = PARAGRAPH_BREAK_RE.split(text)
+    if len(blocks) == 1:
+        # No blank lines, so single line breaks separate paragraphs
+        blocks = text.splitlines()
+    for block in blocks:
+        words = block.split()
+        for start in range(0, len(words), chunk_words):
+            yield ' '.join(words[start:start + chunk_words])
+
+
+def _styles():
+    styles = getSampleStyleSheet()
+    styles.add(ParagraphStyle(
+        'TitleStyle',
+        parent=styles['Title'],
+        fontSize=24,
+        alignment=1,  # Center alignment
+        spaceAfter=12
+    ))
+    styles.add(ParagraphStyle(
+        'AuthorStyle',
+        parent=styles['Normal'],
+        fontSize=16,
+        alignment=1,  # Center alignment
+        spaceAfter=24
+    ))
+    styles.add(ParagraphStyle(
+        'StoryStyle',
+        parent=styles['Normal'],
+        fontSize=12,
+        spaceAfter=12
+    ))
+    styles.add(ParagraphStyle(
+        'ContentsEntry',
+        parent=styles['Normal'],
+        fontSize=12,
+        leftIndent=12,
+        spaceAfter=6
+    ))
+    return styles
+
+
+def _cover(story):
+    """Yield the cover image flowables, if the story has a cover.
+
+    The cover's print rendition is embedded as it is, scaled to fit the page
+    width and half its height; nothing is decoded or resized here.
+    """
+    if not story.cover_print:
+        return
+    path, width, height = story.cover_print
+    if not os.path.exists(path):
+        return
+    max_width = letter[0] - 100  # Leave margins
+    max_height = letter[1] / 2   # Use half page height
+    scale = min(max_width / width, max_height / height)
+    yield RLImage(path, width=width * scale, height=height * scale)
+    yield Spacer(1, 24)
+
+
+def _chapter_key(chapter):
+    return f'chapter_{chapter.chapter_number}'
+
+
+def _chapter_title(chapter):
+    return f"Chapter {chapter.chapter_number}: {chapter.title}"
+
+
+def iter_flowables(story, styles):
+    """Yield the flowables of a StorySnapshot in order, one chapter paragraph at a time."""
+    yield from _cover(story)
+
+    # Title page
+    yield Paragraph(escape(story.title), styles['TitleStyle'])
+    yield Paragraph(f"by {escape(story.author)}", styles['AuthorStyle'])
+    yield Spacer(1, 48)
+
+    # Story information
+    yield Paragraph("Story Information", styles['Title'])
+    yield Spacer(1, 24)
+    if story.tags:
+        yield Paragraph("Tags:", styles['Heading2'])
+        yield Paragraph(escape(", ".join(story.tags)), styles['Normal'])
+        yield Spacer(1, 12)
+    if story.description:
+        yield Paragraph("Description:", styles['Heading2'])
+        yield Paragraph(escape(story.description), styles['Normal'])
+        yield Spacer(1, 12)
+    yield Paragraph("Statistics:", styles['Heading2'])
+    yield Paragraph(f"Chapters: {story.chapter_count}", styles['Normal'])
+    yield Paragraph(f"Word Count: {story.word_count}", styles['Normal'])
+    if story.rating_count:
+        yield Paragraph(f"Average Rating: {story.average_rating:.1f} ({story.rating_count} ratings)", styles['Normal'])
+    yield Paragraph(f"Upload Date: {story.created_at.strftime('%B %d, %Y at %I:%M %p UTC')}", styles['Normal'])
+    yield Paragraph(f"Last Updated: {story.last_updated.strftime('%B %d, %Y at %I:%M %p UTC')}", styles['Normal'])
+    yield Spacer(1, 24)
+
+    # Table of contents, linking to each chapter's first page
+    if story.chapters:
+        yield Paragraph("Contents", styles['Heading2'])
+        for chapter in story.chapters:
+            yield Paragraph(
+                f'<a href="#{_chapter_key(chapter)}" color="#2c3e50">{escape(_chapter_title(chapter))}</a>',
+                styles['ContentsEntry'],
+            )
+
+    # Chapters, each starting on a new page
+    for chapter in story.chapters:
+        yield PageBreak()
+        yield Bookmark(_chapter_key(chapter), _chapter_title(chapter))
+        yield Paragraph(escape(_chapter_title(chapter)), styles['Heading1'])
+        yield Spacer(1, 12)
+        for paragraph in split_paragraphs(chapter.content):
+            yield Paragraph(escape(paragraph), styles['StoryStyle'])
+
+
+def write_pdf(story, out):
+    """Write a StorySnapshot as a PDF to the binary file object ``out``; returns the page count."""
+    doc = StoryDocTemplate(out, pagesize=letter, title=story.title, author=story.author)
+    doc.build(LazyFlowables(iter_flowables(story, _styles())))
+    return doc.page
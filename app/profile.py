@@ -1,65 +1,43 @@
 from flask import Blueprint, render_template, request, redirect, url_for, flash
 from flask_login import login_required, current_user
-from app.models import db, User, Story, Rating
+from app.models import db, User, Story
+from app.fragments import story_cards
+from app.pagination import paginate
+from app.counts import count_stories
+from app.author_stats import author_stats
+from app.page_cache import cached_page
 
 profile = Blueprint('profile', __name__)
 
-@profile.route('/profile')
-@login_required
-def view_profile():
-    user = current_user
+def render_profile(user):
+    """Render the profile page for an author; shared by view_profile and view_author."""
     page = request.args.get('page', 1, type=int)
     per_page = 10  # Number of stories per page
     
-    # Get all stories for statistics
-    all_stories = Story.query.filter_by(user_id=user.id).all()
-    
-    # Get paginated stories for display
-    stories_query = Story.query.filter_by(user_id=user.id).order_by(Story.id.desc())
-    total_stories = stories_query.count()
-    total_pages = (total_stories + per_page - 1) // per_page
-    
-    # Ensure page is within valid range
-    page = max(1, min(page, total_pages)) if total_pages > 0 else 1
-    
-    # Get paginated stories
-    stories = stories_query.offset((page - 1) * per_page).limit(per_page).all()
-    
-    # Calculate statistics from all stories
-    total_words = sum(story.word_count for story in all_stories)
-    avg_words = total_words / total_stories if total_stories > 0 else 0
-    
-    # Calculate average rating across all stories
-    total_ratings = 0
-    rating_count = 0
-    for story in all_stories:
-        if story.ratings:
-            total_ratings += sum(rating.value for rating in story.ratings)
-            rating_count += len(story.ratings)
-    avg_rating = total_ratings / rating_count if rating_count > 0 else 0
-    
-    # Calculate most used tag from all stories
-    tag_counts = {}
-    for story in all_stories:
-        for tag in story.tags:
-            tag_counts[tag.name] = tag_counts.get(tag.name, 0) + 1
-    
-    most_used_tag = None
-    if tag_counts:
-        most_used_tag_name = max(tag_counts.items(), key=lambda x: x[1])[0]
-        most_used_tag = {'name': most_used_tag_name, 'count': tag_counts[most_used_tag_name]}
+    # Get paginated stories for display, newest first
+    stories_query = Story.query.filter_by(user_id=user.id)
+    story_count = count_stories(stories_query, ('author', user.id))
+    pager = paginate(
+        stories_query, [(Story.id, True)],
+        sort_name='desc',
+        per_page=per_page,
+        count=story_count,
+        page=page,
+        after=request.args.get('after'),
+        before=request.args.get('before'),
+    )
     
     return render_template('profile.html', 
                          user=user, 
-                         stories=stories,
-                         total_stories=total_stories,
-                         total_words=total_words,
-                         avg_words=round(avg_words),
-                         avg_rating=round(avg_rating, 1),
-                         rating_count=rating_count,
-                         most_used_tag=most_used_tag,
-                         current_page=page,
-                         total_pages=total_pages)
+                         stories=pager.items,
+                         cards=story_cards(pager.items),
+                         pager=pager,
+                         **author_stats(user.id))
+
+@profile.route('/profile')
+@login_required
+def view_profile():
+    return render_profile(current_user)
 
 @profile.route('/edit_bio', methods=['POST'])
 @login_required
@@ -71,57 +49,7 @@ def edit_bio():
     return redirect(url_for('profile.view_profile'))
 
 @profile.route('/author/<int:user_id>')
+@cached_page
 def view_author(user_id):
     user = User.query.get_or_404(user_id)
-    page = request.args.get('page', 1, type=int)
-    per_page = 10  # Number of stories per page
-    
-    # Get all stories for statistics
-    all_stories = Story.query.filter_by(user_id=user.id).all()
-    
-    # Get paginated stories for display
-    stories_query = Story.query.filter_by(user_id=user.id).order_by(Story.id.desc())
-    total_stories = stories_query.count()
-    total_pages = (total_stories + per_page - 1) // per_page
-    
-    # Ensure page is within valid range
-    page = max(1, min(page, total_pages)) if total_pages > 0 else 1
-    
-    # Get paginated stories
-    stories = stories_query.offset((page - 1) * per_page).limit(per_page).all()
-    
-    # Calculate statistics from all stories
-    total_words = sum(story.word_count for story in all_stories)
-    avg_words = total_words / total_stories if total_stories > 0 else 0
-    
-    # Calculate average rating across all stories
-    total_ratings = 0
-    rating_count = 0
-    for story in all_stories:
-        if story.ratings:
-            total_ratings += sum(rating.value for rating in story.ratings)
-            rating_count += len(story.ratings)
-    avg_rating = total_ratings / rating_count if rating_count > 0 else 0
-    
-    # Calculate most used tag from all stories
-    tag_counts = {}
-    for story in all_stories:
-        for tag in story.tags:
-            tag_counts[tag.name] = tag_counts.get(tag.name, 0) + 1
-    
-    most_used_tag = None
-    if tag_counts:
-        most_used_tag_name = max(tag_counts.items(), key=lambda x: x[1])[0]
-        most_used_tag = {'name': most_used_tag_name, 'count': tag_counts[most_used_tag_name]}
-    
-    return render_template('profile.html', 
-                         user=user, 
-                         stories=stories,
-                         total_stories=total_stories,
-                         total_words=total_words,
-                         avg_words=round(avg_words),
-                         avg_rating=round(avg_rating, 1),
-                         rating_count=rating_count,
-                         most_used_tag=most_used_tag,
-                         current_page=page,
-                         total_pages=total_pages) 
\ No newline at end of file
+    return render_profile(user)
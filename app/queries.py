@@ -0,0 +1,23 @@
+from sqlalchemy.orm import joinedload, selectinload
+from app.models import Story, SavedStory
+
+
+def card_options():
+    """Loader options for everything a story card renders.
+
+    Authors are joined in and tags are fetched with one batched IN query, so
+    rendering a page of cards costs a fixed number of queries however many
+    stories it shows. Chapters and ratings are never touched; cards read the
+    cached counters on Story instead. Listings themselves load plain Story rows
+    and only stories whose card isn't cached are loaded with these options
+    (see app/fragments.py).
+    """
+    return [joinedload(Story.author), selectinload(Story.tags)]
+
+
+def saved_story_cards(user_id):
+    """Return a user's library, newest first, with the saved stories loaded."""
+    return (SavedStory.query
+            .filter_by(user_id=user_id)
+            .options(joinedload(SavedStory.story))
+            .order_by(SavedStory.saved_at.desc()))
@@ -0,0 +1,206 @@
+import math
+import re
+from collections import namedtuple
+from functools import lru_cache
+from app.models import db, Story, User, Tag, StoryRatingStats
+from app.utils import clean_tag
+from app import fulltext
+
+# Search query language used by the home page search box.
+#
+#   title:"dragons"  by:"author"  tags:"fantasy, adventure"
+#   rating:"4.5"  rating_more_than:"4"  rating_less_than:"3"
+#   words_more_than:"1000"  words_less_than:"50000"
+#   -tags:"horror"            negates a term
+#   title:"a" OR title:"b"    either side may match (OR binds loosest)
+#   title:"say \"hi\""        quoted values accept backslash escapes
+#
+# Anything that is not a modifier is free text and goes to the full-text index.
+# A query is tokenized and parsed in one pass into an AST, a list of OR'ed
+# groups whose terms are AND'ed, and compiled into a single WHERE clause.
+
+Term = namedtuple('Term', ['field', 'value', 'negated'])
+SearchPlan = namedtuple('SearchPlan', ['criteria', 'text_query'])
+
+PLAN_CACHE_SIZE = 256
+
+TOKEN_RE = re.compile(r'''
+    (?P<or>\|\||\||OR(?=\s|$))
+  | (?P<neg>-)?
+    (?:(?P<field>[a-z_]+):)?
+    (?:"(?P<quoted>(?:[^"\\]|\\.)*)(?:"|$)|(?P<bare>[^\s"]+))
+''', re.VERBOSE)
+
+ESCAPE_RE = re.compile(r'\\(.)')
+
+
+def _text_criteria(value):
+    hits = fulltext.search_hits(value)
+    if hits is None:
+        # No full-text support on this database, fall back to substring matching
+        return Story.title.ilike(f'%{value}%') | Story.description.ilike(f'%{value}%')
+    return Story.id.in_(db.select(hits.c.story_id))
+
+
+def _tags_criteria(value):
+    tags = [tag for tag in (clean_tag(tag) for tag in value.split(',')) if tag]
+    if not tags:
+        return None
+    return db.and_(*(Story.tags.any(Tag.name == tag) for tag in tags))
+
+
+def _rating_criteria(compare):
+    """Build a rating modifier as a comparison against the story's average rating.
+
+    Rating modifiers are conditions on the story_rating_stats table rather
+    than WHERE clauses on Story; all of a group's rating conditions are merged
+    into a single range scan of its average index when the group is compiled.
+    """
+    def criteria(value):
+        try:
+            target = float(value)
+        except ValueError:
+            return None
+        return compare(StoryRatingStats.average, target)
+    return criteria
+
+
+# Largest value of the Story.word_count column (a 32-bit INTEGER)
+MAX_WORD_COUNT = 2 ** 31 - 1
+
+
+def _word_count_criteria(compare):
+    """Build a word-count modifier as a comparison against Story.word_count."""
+    def criteria(value):
+        try:
+            target = float(value)
+        except (ValueError, OverflowError):
+            return None
+        if not math.isfinite(target):
+            return None
+        # Out-of-range numbers would overflow the integer bind parameter
+        target = min(max(int(target), 0), MAX_WORD_COUNT)
+        return compare(Story.word_count, target)
+    return criteria
+
+
+MODIFIERS = {
+    'title': lambda value: Story.title.ilike(f'%{value}%'),
+    'by': lambda value: Story.author.has(User.username.ilike(f'%{value}%')),
+    'tags': _tags_criteria,
+    'rating': _rating_criteria(lambda average, target: average == target),
+    'rating_more_than': _rating_criteria(lambda average, target: average > target),
+    'rating_less_than': _rating_criteria(lambda average, target: average < target),
+    'words_more_than': _word_count_criteria(lambda words, target: words > target),
+    'words_less_than': _word_count_criteria(lambda words, target: words < target),
+}
+RATING_MODIFIERS = {'rating', 'rating_more_than', 'rating_less_than'}
+
+
+def normalize(search_query):
+    """Collapse whitespace so equivalent queries share a cached plan."""
+    return ' '.join(search_query.split())
+
+
+def parse(search_query):
+    """Parse a search query into a list of OR'ed groups of AND'ed Terms.
+
+    Free text is collected into Terms whose field is None. Unknown modifiers
+    are treated as free text, and empty values are dropped.
+    """
+    groups = [[]]
+    words = []  # Plain free-text words of the current group, merged into one term
+
+    def close_words():
+        if words:
+            groups[-1].append(Term(None, ' '.join(words), False))
+            words.clear()
+
+    for match in TOKEN_RE.finditer(search_query):
+        if match.group('or'):
+            close_words()
+            groups.append([])
+            continue
+        negated = bool(match.group('neg'))
+        field = match.group('field')
+        if match.group('quoted') is not None:
+            value = ESCAPE_RE.sub(r'\1', match.group('quoted')).strip()
+        else:
+            value = match.group('bare')
+        if field and field not in MODIFIERS:
+            value = f'{field}:{value}'
+            field = None
+        if not value:
+            continue
+        if field is None and not negated:
+            words.append(value)
+        else:
+            groups[-1].append(Term(field, value, negated))
+    close_words()
+    return [group for group in groups if group]
+
+
+def _compile_term(term):
+    if term.field is None:
+        criteria = _text_criteria(term.value)
+    else:
+        criteria = MODIFIERS[term.field](term.value)
+    if criteria is None:
+        return None
+    return ~criteria if term.negated else criteria
+
+
+def _compile_group(group):
+    """AND a group's terms together, folding every rating term into one stats lookup."""
+    clauses = []
+    rating = []
+    for term in group:
+        clause = _compile_term(term)
+        if clause is None:
+            continue
+        if term.field in RATING_MODIFIERS:
+            rating.append(clause)
+        else:
+            clauses.append(clause)
+    if rating:
+        rated = db.select(StoryRatingStats.story_id).where(StoryRatingStats.rating_count > 0, *rating)
+        clauses.append(Story.id.in_(rated))
+    return db.and_(*clauses) if clauses else None
+
+
+@lru_cache(maxsize=PLAN_CACHE_SIZE)
+def _compile(normalized_query, dialect):
+    # ``dialect`` is only part of the cache key: free-text criteria differ by backend
+    groups = parse(normalized_query)
+    text_query = None
+    if len(groups) == 1:
+        # A single group can rank by its free text instead of filtering on it
+        plain = [term for term in groups[0] if term.field is None and not term.negated]
+        if plain:
+            text_query = plain[0].value
+            groups = [[term for term in groups[0] if term is not plain[0]]]
+
+    alternatives = []
+    for group in groups:
+        clauses = _compile_group(group)
+        if clauses is not None:
+            alternatives.append(clauses)
+        elif len(groups) > 1:
+            # An OR branch with nothing usable in it matches everything
+            return SearchPlan(None, text_query)
+    criteria = db.or_(*alternatives) if alternatives else None
+    return SearchPlan(criteria, text_query)
+
+
+def compile_search(search_query):
+    """Return the cached SearchPlan for a search query.
+
+    ``criteria`` is a WHERE clause (or None) for Story queries. ``text_query``
+    is free text the caller should rank results by through the full-text index.
+    """
+    return _compile(normalize(search_query), db.engine.dialect.name)
+
+
+def plan_cache_info():
+    """Hit/miss statistics for the compiled plan cache."""
+    return _compile.cache_info()
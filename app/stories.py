@@ -1,19 +1,18 @@
-from flask import Blueprint, render_template, request, redirect, url_for, flash, send_file, current_app
+from flask import Blueprint, render_template, request, redirect, url_for, flash, send_file, current_app, g, abort, jsonify
 from flask_login import login_required, current_user
 from datetime import datetime
-import os
-import io
-import tempfile
-from reportlab.pdfgen import canvas
-from reportlab.lib.pagesizes import letter
-from reportlab.pdfbase import pdfmetrics
-from reportlab.pdfbase.ttfonts import TTFont
-from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer
-from ebooklib import epub
-from PIL import Image
-from app.models import db, Story, Chapter, Tag, Rating
-from app.utils import clean_tag, allowed_file, process_cover_image
+from sqlalchemy.orm import undefer_group
+from app.models import db, Story, Chapter, Rating
+from app.utils import allowed_file
+from app.covers import remove_cover, InvalidCover
+from app.cover_jobs import stage_cover, submit_cover
+from app.chapters import chapter_index, chapters_with_text, parse_chapter_form, save_chapters
+from app.tags import parse_tags, set_story_tags
+from app import fulltext
+from app.page_cache import cached_page
+from app.exports import EXPORT_MIMETYPES
+from app.export_cache import find_export
+from app.export_jobs import submit_export, get_job, forget_job, ExportQueueFull
 
 stories = Blueprint('stories', __name__)
 
@@ -25,7 +24,7 @@ def write():
         description = request.form.get('description')
         chapter_titles = request.form.getlist('chapter_title[]')
         chapter_contents = request.form.getlist('chapter_content[]')
-        tags = request.form.get('tags', '').split(',')
+        tags = request.form.get('tags', '')
         
         story = Story(
             title=title, 
@@ -37,23 +36,20 @@ def write():
         db.session.add(story)
         db.session.flush()  # Get the story ID
         
-        # Handle cover image upload
+        # Handle cover image upload, resized in the background once the story is saved
+        cover_upload = None
         if 'cover' in request.files:
             cover_file = request.files['cover']
             if cover_file and cover_file.filename and allowed_file(cover_file.filename):
-                cover_path = process_cover_image(cover_file, story.id, current_app)
-                story.cover_image = cover_path
+                try:
+                    cover_upload = stage_cover(story, cover_file)
+                except InvalidCover as e:
+                    flash(str(e))
         
-        # Add tags (limited to 10)
-        for tag_name in tags[:10]:
-            tag_name = clean_tag(tag_name)
-            if tag_name:
-                tag = Tag.query.filter_by(name=tag_name).first()
-                if not tag:
-                    tag = Tag(name=tag_name)
-                    db.session.add(tag)
-                story.tags.append(tag)
+        # Add tags (limited to 10); a new story has none yet
+        set_story_tags(story, parse_tags(tags), current=())
         
+        chapters = []
         for i, (chapter_title, chapter_content) in enumerate(zip(chapter_titles, chapter_contents), 1):
             if chapter_title and chapter_content:  # Only add non-empty chapters
                 chapter = Chapter(
@@ -63,21 +59,45 @@ def write():
                     story_id=story.id
                 )
                 db.session.add(chapter)
+                chapters.append(chapter)
+        story.refresh_chapter_stats(chapters)
+        fulltext.index_story(story, chapters)
         
         db.session.commit()
+        if cover_upload:
+            submit_cover(cover_upload)
         return redirect(url_for('search.index'))
     return render_template('write.html')
 
 @stories.route('/story/<int:story_id>')
+@cached_page
 def view_story(story_id):
     story = Story.query.get_or_404(story_id)
+    g.last_modified = story.last_updated
     current_user_rating = None
     if current_user.is_authenticated:
         current_user_rating = Rating.query.filter_by(
             user_id=current_user.id,
             story_id=story.id
         ).first()
-    return render_template('story.html', story=story, current_user_rating=current_user_rating)
+    return render_template('story.html', story=story, chapters=chapter_index(story.id),
+                           current_user_rating=current_user_rating)
+
+@stories.route('/story/<int:story_id>/chapter/<int:number>')
+@cached_page
+def read_chapter(story_id, number):
+    story = Story.query.get_or_404(story_id)
+    g.last_modified = story.last_updated
+    chapters = chapter_index(story.id)
+    position = next((i for i, entry in enumerate(chapters) if entry.chapter_number == number), None)
+    if position is None:
+        abort(404)
+    chapter = Chapter.query.options(undefer_group('text')).get(chapters[position].id)
+    return render_template(
+        'chapter.html', story=story, chapter=chapter, chapters=chapters,
+        previous_chapter=chapters[position - 1] if position > 0 else None,
+        next_chapter=chapters[position + 1] if position + 1 < len(chapters) else None,
+    )
 
 @stories.route('/story/<int:story_id>/rate', methods=['POST'])
 @login_required
@@ -147,74 +167,41 @@ def edit_story(story_id):
         
         # Handle cover image removal
         if request.form.get('remove_cover') == '1':
-            if story.cover_image:
-                # Delete the file from the filesystem
-                try:
-                    file_path = os.path.join(current_app.static_folder, story.cover_image)
-                    if os.path.exists(file_path):
-                        os.remove(file_path)
-                except Exception as e:
-                    flash(f'Error removing old cover image: {str(e)}')
-            story.cover_image = None
+            # The files are deleted once the story is saved
+            remove_cover(story)
         
-        # Handle cover image upload (independent of removal)
+        # Handle cover image upload (independent of removal). The old cover
+        # stays up until the new one has been processed
+        cover_upload = None
         if 'cover_image' in request.files:
             file = request.files['cover_image']
             if file and file.filename and allowed_file(file.filename):
                 try:
-                    # Remove old cover image if it exists
-                    if story.cover_image:
-                        try:
-                            old_file_path = os.path.join(current_app.static_folder, story.cover_image)
-                            if os.path.exists(old_file_path):
-                                os.remove(old_file_path)
-                        except Exception as e:
-                            flash(f'Error removing old cover image: {str(e)}')
-                    
-                    cover_path = process_cover_image(file, story.id, current_app)
-                    story.cover_image = cover_path
-                except Exception as e:
+                    cover_upload = stage_cover(story, file)
+                except InvalidCover as e:
                     flash(f'Error processing cover image: {str(e)}')
             elif file and file.filename:
                 flash('Invalid file type. Allowed types: png, jpg, jpeg, gif')
         
-        # Update tags
-        story.tags = []  # Clear existing tags
-        tags = request.form.get('tags', '').split(',')
-        for tag_name in tags[:10]:  # Limit to 10 tags
-            tag_name = clean_tag(tag_name)
-            if tag_name:
-                tag = Tag.query.filter_by(name=tag_name).first()
-                if not tag:
-                    tag = Tag(name=tag_name)
-                    db.session.add(tag)
-                story.tags.append(tag)
-        
-        # Get chapter data from form
-        chapter_ids = request.form.getlist('chapter_id[]')
-        chapter_titles = request.form.getlist('chapter_title[]')
-        chapter_contents = request.form.getlist('chapter_content[]')
-        
-        # First, delete all existing chapters
-        for chapter in story.chapters:
-            db.session.delete(chapter)
+        # Update tags (limited to 10)
+        set_story_tags(story, parse_tags(request.form.get('tags', '')))
         
-        # Then add the new chapters
-        for i, (chapter_title, chapter_content) in enumerate(zip(chapter_titles, chapter_contents), 1):
-            if chapter_title and chapter_content:  # Only add non-empty chapters
-                chapter = Chapter(
-                    title=chapter_title,
-                    content=chapter_content,
-                    chapter_number=i,
-                    story_id=story.id
-                )
-                db.session.add(chapter)
+        # Apply the posted chapters to the existing ones; only what changed is written
+        chapters = save_chapters(story, parse_chapter_form(
+            request.form.getlist('chapter_id[]'),
+            request.form.getlist('chapter_title[]'),
+            request.form.getlist('chapter_content[]'),
+        ))
+        story.refresh_chapter_stats(chapters)
+        fulltext.index_story(story, chapters)
         
         db.session.commit()
+        if cover_upload:
+            submit_cover(cover_upload)
         flash('Story updated successfully!')
         return redirect(url_for('stories.view_story', story_id=story.id))
     
-    return render_template('edit_story.html', story=story)
+    return render_template('edit_story.html', story=story, chapters=chapters_with_text(story.id))
 
 @stories.route('/story/<int:story_id>/delete', methods=['POST'])
 @login_required
@@ -226,286 +213,75 @@ def delete_story(story_id):
         flash('You can only delete your own stories.')
         return redirect(url_for('stories.view_story', story_id=story.id))
     
-    # Delete cover image if it exists
-    if story.cover_image:
-        try:
-            file_path = os.path.join(current_app.static_folder, story.cover_image)
-            if os.path.exists(file_path):
-                os.remove(file_path)
-        except Exception as e:
-            flash(f'Error removing cover image: {str(e)}')
+    # Delete cover image if it exists, once the story is gone
+    remove_cover(story)
     
     # Delete the story (this will cascade delete related records)
+    fulltext.remove_story(story.id)
     db.session.delete(story)
     db.session.commit()
     
     flash('Story deleted successfully!')
     return redirect(url_for('search.index'))
 
+def export_status(job):
+    return {
+        'job': job.key,
+        'story_id': job.story_id,
+        'format': job.format,
+        'status': job.status,
+        'status_url': url_for('stories.export_job_status', job_id=job.key),
+        'download_url': url_for('stories.download_story', story_id=job.story_id, format=job.format),
+    }
+
+@stories.route('/story/<int:story_id>/export/<format>', methods=['POST'])
+@login_required
+def export_story(story_id, format):
+    story = Story.query.get_or_404(story_id)
+    if format not in EXPORT_MIMETYPES:
+        abort(404)
+    try:
+        job = submit_export(story, format)
+    except ExportQueueFull:
+        return jsonify({'error': 'Too many exports in progress, try again shortly.'}), 503, {'Retry-After': '10'}
+    return jsonify(export_status(job)), 200 if job.status == 'done' else 202
+
+@stories.route('/exports/<job_id>')
+@login_required
+def export_job_status(job_id):
+    job = get_job(job_id)
+    if job is None:
+        abort(404)
+    return jsonify(export_status(job))
+
 @stories.route('/story/<int:story_id>/download/<format>')
 @login_required
 def download_story(story_id, format):
     story = Story.query.get_or_404(story_id)
-    
-    if format == 'pdf':
-        # Create a PDF
-        buffer = io.BytesIO()
-        doc = SimpleDocTemplate(buffer, pagesize=letter)
-        styles = getSampleStyleSheet()
-        
-        # Create custom styles
-        title_style = ParagraphStyle(
-            'TitleStyle',
-            parent=styles['Title'],
-            fontSize=24,
-            alignment=1,  # Center alignment
-            spaceAfter=12
-        )
-        author_style = ParagraphStyle(
-            'AuthorStyle',
-            parent=styles['Normal'],
-            fontSize=16,
-            alignment=1,  # Center alignment
-            spaceAfter=24
-        )
-        story_style = ParagraphStyle(
-            'StoryStyle',
-            parent=styles['Normal'],
-            fontSize=12,
-            spaceAfter=12
-        )
-        
-        # Create the content
-        content = []
-        
-        # Add cover image if available
-        if story.cover_image:
-            try:
-                cover_path = os.path.join(current_app.static_folder, story.cover_image)
-                if os.path.exists(cover_path):
-                    img = Image.open(cover_path)
-                    # Resize image to fit page width while maintaining aspect ratio
-                    img_width, img_height = img.size
-                    aspect = img_height / float(img_width)
-                    max_width = letter[0] - 100  # Leave margins
-                    max_height = letter[1] / 2   # Use half page height
-                    
-                    if img_width > max_width:
-                        img_width = max_width
-                        img_height = img_width * aspect
-                    if img_height > max_height:
-                        img_height = max_height
-                        img_width = img_height / aspect
-                    
-                    img = img.resize((int(img_width), int(img_height)), Image.Resampling.LANCZOS)
-                    img_buffer = io.BytesIO()
-                    img.save(img_buffer, format='PNG')
-                    img_buffer.seek(0)
-                    
-                    from reportlab.platypus import Image as RLImage
-                    cover_img = RLImage(img_buffer, width=img_width, height=img_height)
-                    content.append(cover_img)
-                    content.append(Spacer(1, 24))
-            except Exception as e:
-                print(f"Error adding cover image: {str(e)}")
-        
-        # Add title page
-        content.append(Paragraph(story.title, title_style))
-        content.append(Paragraph(f"by {story.author.username}", author_style))
-        content.append(Spacer(1, 48))  # Add extra space after title page
-        
-        # Add story information section
-        content.append(Paragraph("Story Information", styles['Title']))
-        content.append(Spacer(1, 24))
-        
-        # Tags
-        if story.tags:
-            content.append(Paragraph("Tags:", styles['Heading2']))
-            content.append(Paragraph(", ".join(tag.name for tag in story.tags), styles['Normal']))
-            content.append(Spacer(1, 12))
-        
-        # Description
-        if story.description:
-            content.append(Paragraph("Description:", styles['Heading2']))
-            content.append(Paragraph(story.description, styles['Normal']))
-            content.append(Spacer(1, 12))
-        
-        # Statistics and Rating
-        content.append(Paragraph("Statistics:", styles['Heading2']))
-        content.append(Paragraph(f"Chapters: {len(story.chapters)}", styles['Normal']))
-        content.append(Paragraph(f"Word Count: {story.word_count}", styles['Normal']))
-        if story.ratings:
-            content.append(Paragraph(f"Average Rating: {story.average_rating:.1f} ({len(story.ratings)} ratings)", styles['Normal']))
-        content.append(Paragraph(f"Upload Date: {story.created_at.strftime('%B %d, %Y at %I:%M %p UTC')}", styles['Normal']))
-        content.append(Paragraph(f"Last Updated: {story.last_updated.strftime('%B %d, %Y at %I:%M %p UTC')}", styles['Normal']))
-        content.append(Spacer(1, 24))
-        
-        # Add a page break
-        content.append(Paragraph("Story Content", styles['Title']))
-        content.append(Spacer(1, 24))
-        
-        # Add chapters
-        for chapter in story.chapters:
-            content.append(Paragraph(f"Chapter {chapter.chapter_number}: {chapter.title}", styles['Heading1']))
-            content.append(Spacer(1, 12))
-            content.append(Paragraph(chapter.content, story_style))
-            content.append(Spacer(1, 24))
-        
-        # Build the PDF
-        doc.build(content)
-        buffer.seek(0)
-        
-        return send_file(
-            buffer,
-            as_attachment=True,
-            download_name=f"{story.title}.pdf",
-            mimetype='application/pdf'
-        )
-    
-    elif format == 'epub':
-        # Create an EPUB
-        book = epub.EpubBook()
-        
-        # Set metadata
-        book.set_identifier(f'story_{story.id}')
-        book.set_title(story.title)
-        book.set_language('en')
-        book.add_author(story.author.username)
-        
-        # Add dates to metadata
-        book.add_metadata('DC', 'date', story.created_at.strftime('%Y-%m-%dT%H:%M:%SZ'))
-        book.add_metadata('DC', 'date.modified', story.last_updated.strftime('%Y-%m-%dT%H:%M:%SZ'))
-        
-        # Add cover image if available
-        if story.cover_image:
-            try:
-                cover_path = os.path.join(current_app.static_folder, story.cover_image)
-                if os.path.exists(cover_path):
-                    with open(cover_path, 'rb') as f:
-                        book.set_cover('cover.jpg', f.read())
-            except Exception as e:
-                print(f"Error adding cover image: {str(e)}")
-        
-        # Add tags to metadata
-        if story.tags:
-            book.add_metadata('DC', 'subject', ', '.join(tag.name for tag in story.tags))
-        
-        # Add rating to metadata
-        if story.ratings:
-            book.add_metadata('DC', 'rating', f"{story.average_rating:.1f}")
-            book.add_metadata('DC', 'rating_count', str(len(story.ratings)))
-        
-        # Create title page
-        title_page = epub.EpubHtml(
-            title='Title Page',
-            file_name='title.xhtml'
-        )
-        
-        # Create title page content
-        title_content = f'''
-        <div class="title-page">
-            <h1 class="title">{story.title}</h1>
-            <h2 class="author">by {story.author.username}</h2>
-        </div>
-        '''
-        title_page.content = title_content
-        book.add_item(title_page)
-        
-        # Create metadata chapter
-        metadata_chapter = epub.EpubHtml(
-            title='Story Information',
-            file_name='metadata.xhtml'
-        )
-        
-        # Create metadata content
-        metadata_content = f'''
-        <h1>Story Information</h1>
-        <div class="metadata">
-            <h2>Tags</h2>
-            <p>{", ".join(tag.name for tag in story.tags) if story.tags else "No tags"}</p>
-            
-            <h2>Description</h2>
-            <p>{story.description if story.description else "No description"}</p>
-            
-            <h2>Statistics</h2>
-            <p>Chapters: {len(story.chapters)}</p>
-            <p>Word Count: {story.word_count}</p>
-            {f'<p>Average Rating: {story.average_rating:.1f} ({len(story.ratings)} ratings)</p>' if story.ratings else ''}
-            <p>Upload Date: {story.created_at.strftime('%B %d, %Y at %I:%M %p UTC')}</p>
-            <p>Last Updated: {story.last_updated.strftime('%B %d, %Y at %I:%M %p UTC')}</p>
-        </div>
-        '''
-        metadata_chapter.content = metadata_content
-        book.add_item(metadata_chapter)
-        
-        # Create chapters
-        chapters = []
-        for chapter in story.chapters:
-            chapter_file = epub.EpubHtml(
-                title=chapter.title,
-                file_name=f'chapter_{chapter.chapter_number}.xhtml'
-            )
-            chapter_file.content = f'<h1>Chapter {chapter.chapter_number}: {chapter.title}</h1><p>{chapter.content}</p>'
-            book.add_item(chapter_file)
-            chapters.append(chapter_file)
-        
-        # Create table of contents
-        book.toc = [
-            epub.Link('title.xhtml', 'Title Page', 'title'),
-            epub.Link('metadata.xhtml', 'Story Information', 'metadata'),
-            (epub.Section('Chapters'),
-             [epub.Link(f'chapter_{i+1}.xhtml', chapter.title, f'chapter_{i+1}') 
-              for i, chapter in enumerate(story.chapters)])
-        ]
-        
-        # Add default NCX and Nav files
-        book.add_item(epub.EpubNcx())
-        book.add_item(epub.EpubNav())
-        
-        # Define CSS style
-        style = '''
-        body {
-            font-family: Cambria, Liberation Serif, Bitstream Vera Serif, Georgia, Times, Times New Roman, serif;
-        }
-        .title-page {
-            text-align: center;
-            margin: 4em 0;
-        }
-        .title-page .title {
-            font-size: 2em;
-            margin-bottom: 0.5em;
-        }
-        .title-page .author {
-            font-size: 1.5em;
-            color: #666;
-        }
-        .metadata {
-            margin: 2em 0;
-        }
-        .metadata h2 {
-            color: #666;
-            margin-top: 1em;
-            margin-bottom: 0.5em;
-        }
-        .metadata p {
-            margin: 0 0 1em 0;
-        }
-        '''
-        nav_css = epub.EpubItem(uid="style_nav", file_name="style/nav.css", media_type="text/css", content=style)
-        book.add_item(nav_css)
-        
-        # Create spine
-        book.spine = ['nav', title_page, metadata_chapter] + chapters
-        
-        # Create EPUB file
-        epub_path = os.path.join(tempfile.gettempdir(), f"{story.title}.epub")
-        epub.write_epub(epub_path, book)
-        
-        return send_file(
-            epub_path,
-            as_attachment=True,
-            download_name=f"{story.title}.epub",
-            mimetype='application/epub+zip'
-        )
-    
-    return redirect(url_for('search.index')) 
\ No newline at end of file
+    if format not in EXPORT_MIMETYPES:
+        return redirect(url_for('search.index'))
+
+    # Exports are rendered once per story version and then served from disk
+    path, key = find_export(story, format)
+    if path is None:
+        # Render it in the worker pool, waiting a little while for it to finish
+        try:
+            job = submit_export(story, format)
+        except ExportQueueFull:
+            return jsonify({'error': 'Too many exports in progress, try again shortly.'}), 503, {'Retry-After': '10'}
+        if not job.wait(current_app.config['EXPORT_WAIT_SECONDS']):
+            if job.status == 'failed':
+                # Answer with the error once; the next request tries again
+                current_app.logger.error('Exporting story %s as %s failed: %s', story.id, format, job.future.exception())
+                forget_job(job)
+                return jsonify({'error': 'The export failed, please try again later.'}), 500
+            return jsonify(export_status(job)), 202, {'Retry-After': '5'}
+        path = job.path
+    return send_file(
+        path,
+        as_attachment=True,
+        download_name=f"{story.title}.{format}",
+        mimetype=EXPORT_MIMETYPES[format],
+        etag=key,
+        conditional=True,
+    )
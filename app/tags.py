@@ -0,0 +1,86 @@
+from sqlalchemy import select
+from sqlalchemy.dialects import postgresql, sqlite
+from app.models import db, Tag, story_tags
+from app.utils import clean_tag
+
+# Story tags, saved a whole list at a time.
+#
+# Saving a story's tags takes a fixed handful of statements however many tags
+# it has: one SELECT ... IN for the tags that already exist, one INSERT for
+# those that don't, and a set difference applied to story_tags (one DELETE,
+# one INSERT). New tags are inserted with ON CONFLICT DO NOTHING, so two
+# stories saved at once with the same new tag don't fail on tag.name's unique
+# constraint; whichever loses the race picks up the other's row. PostgreSQL
+# returns the inserted ids directly; elsewhere they are selected afterwards.
+
+MAX_TAGS = 10
+
+tag_table = Tag.__table__
+
+
+def parse_tags(text):
+    """Cleaned, de-duplicated tag names from a comma separated list, at most MAX_TAGS."""
+    names = []
+    for name in text.split(','):
+        name = clean_tag(name)
+        if name and name not in names:
+            names.append(name)
+    return names[:MAX_TAGS]
+
+
+def _select_ids(names):
+    return dict(db.session.execute(
+        select(tag_table.c.name, tag_table.c.id).where(tag_table.c.name.in_(names))
+    ).all())
+
+
+def get_or_create_tags(names):
+    """Map each tag name to its tag id, adding the tags that don't exist yet."""
+    if not names:
+        return {}
+    ids = _select_ids(names)
+    missing = [name for name in names if name not in ids]
+    if missing:
+        rows = [{'name': name} for name in missing]
+        dialect = db.engine.dialect.name
+        if dialect == 'postgresql':
+            inserted = db.session.execute(
+                postgresql.insert(tag_table).values(rows)
+                .on_conflict_do_nothing(index_elements=['name'])
+                .returning(tag_table.c.name, tag_table.c.id)
+            )
+            ids.update(dict(inserted.all()))
+        elif dialect == 'sqlite':
+            db.session.execute(sqlite.insert(tag_table).values(rows).on_conflict_do_nothing())
+        else:
+            db.session.execute(tag_table.insert(), rows)
+        missing = [name for name in missing if name not in ids]
+        if missing:
+            # Added by this statement without RETURNING, or by a concurrent save
+            ids.update(_select_ids(missing))
+    return ids
+
+
+def set_story_tags(story, names, current=None):
+    """Tag ``story`` with exactly ``names``.
+
+    ``current`` is the ids of the tags the story has now; they are looked up
+    if not given (pass an empty tuple for a story that has just been added).
+    """
+    wanted = set(get_or_create_tags(names).values())
+    if current is None:
+        current = db.session.execute(
+            select(story_tags.c.tag_id).where(story_tags.c.story_id == story.id)
+        ).scalars().all()
+    current = set(current)
+
+    removed = current - wanted
+    if removed:
+        db.session.execute(story_tags.delete().where(
+            story_tags.c.story_id == story.id, story_tags.c.tag_id.in_(removed)))
+    added = wanted - current
+    if added:
+        db.session.execute(story_tags.insert(), [{'story_id': story.id, 'tag_id': tag_id} for tag_id in sorted(added)])
+
+    # A loaded story.tags is out of date now
+    db.session.expire(story, ['tags'])
@@ -0,0 +1,41 @@
+import mimetypes
+import os
+from flask import Blueprint, current_app, send_from_directory, abort
+from werkzeug.security import safe_join
+
+# Uploaded cover files, served under the static URL they have always had.
+#
+# Cover files are named after their content (see app/covers.py), so a URL
+# always serves the same bytes and can be cached by browsers and proxies for
+# a year without revalidating. Set COVER_SENDFILE to have a front proxy send
+# the file instead of a Python worker:
+#
+#   'x-accel-redirect'  nginx; the response names COVER_ACCEL_PREFIX + file,
+#                       which should be an internal location aliasing the
+#                       uploads folder
+#   'x-sendfile'        Apache mod_xsendfile, lighttpd; the response names
+#                       the file's path on disk
+
+uploads = Blueprint('uploads', __name__)
+
+
+@uploads.route('/static/uploads/<path:filename>')
+def cover_file(filename):
+    folder = os.path.join(current_app.static_folder, 'uploads')
+    mode = current_app.config['COVER_SENDFILE']
+    if mode:
+        path = safe_join(folder, filename)
+        if path is None or not os.path.isfile(path):
+            abort(404)
+        response = current_app.response_class(
+            mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream')
+        if mode == 'x-accel-redirect':
+            response.headers['X-Accel-Redirect'] = current_app.config['COVER_ACCEL_PREFIX'] + filename
+        else:
+            response.headers['X-Sendfile'] = os.path.abspath(path)
+    else:
+        response = send_from_directory(folder, filename)
+    response.cache_control.public = True
+    response.cache_control.max_age = current_app.config['COVER_CACHE_MAX_AGE']
+    response.cache_control.immutable = True
+    return response
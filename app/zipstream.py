@@ -0,0 +1,48 @@
+import io
+
+# Support for writing ZIP archives with zipfile while streaming them out.
+#
+# zipfile wants a seekable file so it can go back and patch each entry's local
+# header (sizes and CRC) once the entry is written. StreamBuffer only keeps the
+# bytes not yet handed on; drain() it and yield what it returns.
+#
+# A seekable StreamBuffer may only be drained between entries, since the
+# patching seeks back to the start of the current one. Created with
+# ``seekable=False`` it makes zipfile put sizes in a data descriptor after
+# each entry instead, so it can be drained at any point, including in the
+# middle of an entry written through ZipFile.open().
+
+
+class StreamBuffer:
+    """Write-only buffer for zipfile that forgets everything already drained."""
+
+    def __init__(self, seekable=True):
+        self.buffer = io.BytesIO()
+        self.offset = 0  # Bytes drained so far
+        self._seekable = seekable
+
+    def write(self, data):
+        return self.buffer.write(data)
+
+    def tell(self):
+        return self.offset + self.buffer.tell()
+
+    def seekable(self):
+        return self._seekable
+
+    def seek(self, position, whence=io.SEEK_SET):
+        if not self._seekable:
+            raise io.UnsupportedOperation('seek')
+        if whence == io.SEEK_SET:
+            position -= self.offset
+        self.buffer.seek(position, whence)
+        return self.tell()
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = self.buffer.getvalue()
+        self.offset += len(data)
+        self.buffer = io.BytesIO()
+        return data
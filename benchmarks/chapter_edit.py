@@ -0,0 +1,116 @@
+"""Benchmark saving a story edit that changes one chapter.
+
+Saves the same edit (one chapter's text changed in a long story) the way the
+edit form used to (delete every chapter, insert them all again) and the way
+it does now (apply the difference), and reports the statements issued and
+rows written by each. On PostgreSQL the WAL generated is reported as well.
+Uses DATABASE_URL, an in-memory SQLite database by default; point it at a
+scratch database, as the tables are created and dropped. Run from the
+repository root:
+
+    python -m benchmarks.chapter_edit --chapters 200 --chapter-words 3000
+"""
+import argparse
+import os
+import time
+from sqlalchemy import event, text
+
+os.environ.setdefault('DATABASE_URL', 'sqlite:///:memory:')
+
+from app import create_app
+from app.models import db, User, Story, Chapter
+from app.chapters import chapters_with_text, save_chapters
+from app import fulltext
+
+SENTENCE = 'The quick brown fox jumps over the lazy dog while the story goes on. '
+
+
+def make_story(chapters, chapter_words):
+    user = User(username='benchmark', password_hash='')
+    db.session.add(user)
+    db.session.flush()
+    story = Story(title='Benchmark', user_id=user.id)
+    db.session.add(story)
+    db.session.flush()
+    content = ' '.join((SENTENCE * (chapter_words // 13 + 1)).split()[:chapter_words])
+    for number in range(1, chapters + 1):
+        db.session.add(Chapter(title=f'Chapter {number}', content=content, chapter_number=number, story_id=story.id))
+    db.session.commit()
+    return story
+
+
+def legacy_save(story, posted):
+    """What the edit form used to do: replace every chapter."""
+    for chapter in story.chapters:
+        db.session.delete(chapter)
+    chapters = []
+    for number, (_, title, content) in enumerate(posted, 1):
+        chapter = Chapter(title=title, content=content, chapter_number=number, story_id=story.id)
+        db.session.add(chapter)
+        chapters.append(chapter)
+    return chapters
+
+
+def wal_position():
+    if db.engine.dialect.name != 'postgresql':
+        return None
+    return db.session.execute(text('SELECT pg_current_wal_insert_lsn()')).scalar()
+
+
+def measure(save, story_id, edit):
+    """Save one edit with ``save``; return (statements, rows written, WAL bytes or None, seconds)."""
+    db.session.expire_all()
+    story = Story.query.get(story_id)
+    posted = [(chapter.id, chapter.title, chapter.content) for chapter in chapters_with_text(story_id)]
+    chapter_id, title, content = posted[edit]
+    posted[edit] = (chapter_id, title, content + ' One more sentence.')
+    db.session.commit()
+
+    statements = []
+    rows = []
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+        if statement.split()[0] in ('INSERT', 'UPDATE', 'DELETE'):
+            rows.append(cursor.rowcount)
+    start = wal_position()
+    event.listen(db.engine, 'after_cursor_execute', record)
+    started = time.perf_counter()
+    try:
+        chapters = save(Story.query.get(story_id), posted)
+        story.refresh_chapter_stats(chapters)
+        fulltext.index_story(story, chapters)
+        db.session.commit()
+    finally:
+        event.remove(db.engine, 'after_cursor_execute', record)
+    elapsed = time.perf_counter() - started
+    wal = None
+    if start is not None:
+        wal = db.session.execute(text('SELECT pg_wal_lsn_diff(pg_current_wal_insert_lsn(), :start)'),
+                                 {'start': start}).scalar()
+    return len(statements), sum(rows), wal, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--chapters', type=int, default=200)
+    parser.add_argument('--chapter-words', type=int, default=3000)
+    args = parser.parse_args()
+
+    app = create_app()
+    with app.app_context():
+        db.create_all()
+        try:
+            story_id = make_story(args.chapters, args.chapter_words).id
+            print(f'database:       {db.engine.dialect.name}')
+            print(f'story:          {args.chapters} chapters of {args.chapter_words} words, editing one')
+            for name, save in (('before', legacy_save), ('now', save_chapters)):
+                statements, rows, wal, elapsed = measure(save, story_id, args.chapters // 2)
+                wal = f', WAL {wal / 1024:.0f} KiB' if wal is not None else ''
+                print(f'{name + ":":<15} {statements} statements, {rows} rows written{wal}, {elapsed * 1000:.1f} ms')
+        finally:
+            db.session.remove()
+            db.drop_all()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+"""Benchmark compressed chapter storage.
+
+Stores the same synthetic chapters (prose-like text drawn from a Zipf
+distribution over a vocabulary, which compresses about as well as fiction)
+as plain text and with each available codec, with and without a trained
+dictionary, in a SQLite database file. Reports the size of the stored text,
+the database file size, and the time to write every chapter and to read a
+whole story back through the ORM. Run from the repository root:
+
+    python -m benchmarks.chapter_storage --chapters 300 --chapter-words 3000
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+
+os.environ.setdefault('DATABASE_URL', 'sqlite:///:memory:')
+
+from app import create_app, chapter_text
+from app.models import db, User, Story, Chapter
+from app.chapters import chapters_with_text
+
+CHAPTERS_PER_STORY = 30
+
+
+def make_vocabulary(rng, size):
+    letters = 'etaoinshrdlcumwfgypbvkjxqz'
+    weights = [26 - i for i in range(len(letters))]
+    return [''.join(rng.choices(letters, weights, k=rng.randint(1, 9))) for _ in range(size)]
+
+
+def make_chapters(count, words, seed=1):
+    rng = random.Random(seed)
+    vocabulary = make_vocabulary(rng, 20000)
+    weights = [1 / rank for rank in range(1, len(vocabulary) + 1)]
+    chapters = []
+    for _ in range(count):
+        text = rng.choices(vocabulary, weights, k=words)
+        # Sentences and paragraphs
+        for i in range(0, words, rng.randint(8, 20)):
+            text[i] = text[i].capitalize()
+            if i:
+                text[i - 1] += '.' if rng.random() > 0.05 else '.\n\n'
+        chapters.append(' '.join(text) + '.')
+    return chapters
+
+
+def measure(mode, codec, dictionary, chapters, folder):
+    path = os.path.join(folder, f'{mode}.db')
+    app = create_app()
+    app.config.update(SQLALCHEMY_DATABASE_URI=f'sqlite:///{path}', CHAPTER_COMPRESSION=codec,
+                      CHAPTER_DICTIONARY=dictionary)
+    with app.app_context():
+        db.create_all()
+        user = User(username='benchmark', password_hash='')
+        db.session.add(user)
+        db.session.flush()
+        story_ids = []
+        started = time.perf_counter()
+        for start in range(0, len(chapters), CHAPTERS_PER_STORY):
+            story = Story(title='Benchmark', user_id=user.id)
+            db.session.add(story)
+            db.session.flush()
+            story_ids.append(story.id)
+            for number, text in enumerate(chapters[start:start + CHAPTERS_PER_STORY], 1):
+                db.session.add(Chapter(title=f'Chapter {number}', content=text,
+                                       chapter_number=number, story_id=story.id))
+        db.session.commit()
+        write = time.perf_counter() - started
+
+        stored = db.session.execute(db.text(
+            'SELECT SUM(COALESCE(LENGTH(CAST(content AS BLOB)), 0) + COALESCE(LENGTH(content_compressed), 0)) FROM chapter'
+        )).scalar()
+
+        db.session.remove()
+        started = time.perf_counter()
+        for story_id in story_ids:
+            text = ''.join(chapter.content for chapter in chapters_with_text(story_id))
+            db.session.remove()
+        read = (time.perf_counter() - started) / len(story_ids)
+        db.session.remove()
+        db.engine.dispose()
+    return stored, os.path.getsize(path), write, read
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--chapters', type=int, default=300)
+    parser.add_argument('--chapter-words', type=int, default=3000)
+    args = parser.parse_args()
+
+    chapters = make_chapters(args.chapters, args.chapter_words)
+    samples = make_chapters(200, args.chapter_words, seed=2)
+    plain_bytes = sum(len(text.encode('utf-8')) for text in chapters)
+    codecs = ['zlib'] + (['zstd'] if chapter_text.zstandard is not None else [])
+
+    with tempfile.TemporaryDirectory() as folder:
+        modes = [('plain', None, None)]
+        for codec in codecs:
+            dictionary = os.path.join(folder, f'{codec}.dict')
+            with open(dictionary, 'wb') as f:
+                f.write(chapter_text.train_dictionary(codec, samples, 112 * 1024))
+            modes += [(codec, codec, None), (f'{codec}+dict', codec, dictionary)]
+
+        print(f'chapters:       {args.chapters} of {args.chapter_words} words, {plain_bytes / 1024 / 1024:.1f} MiB of text')
+        if 'zstd' not in codecs:
+            print('zstd:           skipped, the zstandard package is not installed')
+        print(f'{"mode":<14} {"stored":>10} {"ratio":>6} {"db file":>10} {"write":>9} {"read story":>11}')
+        for mode, codec, dictionary in modes:
+            stored, size, write, read = measure(mode, codec, dictionary, chapters, folder)
+            print(f'{mode:<14} {stored / 1024 / 1024:>6.1f} MiB {plain_bytes / stored:>5.2f}x '
+                  f'{size / 1024 / 1024:>6.1f} MiB {write:>7.2f} s {read * 1000:>8.1f} ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+"""Benchmark cover image processing.
+
+Processes a synthetic photo-like upload the way uploads used to be handled
+(decoded in full and resized inside the request) and the way they are now
+(header check in the request, reduced-size decode in a worker), each in a
+fresh process so peak memory can be compared. Also reports the size of every
+rendition against the single 512x800 quality 95 JPEG that story cards used to
+load. Run from the repository root:
+
+    python -m benchmarks.covers --width 4000 --height 6000
+"""
+import argparse
+import os
+import resource
+import shutil
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image, ImageFilter
+from app.covers import check_upload, crop_to_ratio, process_cover_image
+
+COVER_SIZE = (512, 800)
+CONFIG = {
+    'COVER_SIZE': COVER_SIZE,
+    'COVER_RENDITIONS': (('thumb', 128), ('card', 256), ('full', 512)),
+    'COVER_PRINT_SIZE': (1056, 1650),
+    'COVER_MAX_PIXELS': 50 * 1000 * 1000,
+}
+CARDS_PER_PAGE = 20
+
+
+def make_upload(path, width, height):
+    """A blurred noise image, which compresses about like a photograph."""
+    img = Image.effect_noise((width // 4, height // 4), 64).convert('RGB')
+    img = img.resize((width, height), Image.Resampling.BICUBIC).filter(ImageFilter.GaussianBlur(2))
+    img.save(path, 'JPEG', quality=92)
+
+
+def _measure(function, *args):
+    # Runs in a fresh worker process
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    started = time.perf_counter()
+    result = function(*args)
+    elapsed = time.perf_counter() - started
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return elapsed, (peak - baseline) / 1024, result
+
+
+def measure(function, *args):
+    """Run ``function`` in a new process; return (seconds, peak RSS increase in MiB, result)."""
+    with ProcessPoolExecutor(max_workers=1) as executor:
+        # Import everything first so the measurement only sees the work itself
+        executor.submit(_measure, len, ()).result()
+        return executor.submit(_measure, function, *args).result()
+
+
+def legacy_process(upload, out):
+    """What the request used to do: a full decode, LANCZOS resize and quality 95 JPEG."""
+    img = Image.open(upload)
+    img = crop_to_ratio(img, COVER_SIZE).convert('RGB')
+    img = img.resize(COVER_SIZE, Image.Resampling.LANCZOS)
+    img.save(out, quality=95, optimize=True)
+    return os.path.getsize(out)
+
+
+def stage(upload, incoming):
+    """What the request does now: copy the upload aside and read its header."""
+    shutil.copyfile(upload, incoming)
+    check_upload(incoming, CONFIG['COVER_MAX_PIXELS'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--width', type=int, default=4000)
+    parser.add_argument('--height', type=int, default=6000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as folder:
+        upload = os.path.join(folder, 'upload.jpg')
+        make_upload(upload, args.width, args.height)
+        config = dict(CONFIG, UPLOAD_FOLDER=folder)
+
+        legacy_seconds, legacy_rss, legacy_bytes = measure(legacy_process, upload, os.path.join(folder, 'legacy.jpg'))
+        stage_seconds, stage_rss, _ = measure(stage, upload, os.path.join(folder, 'incoming'))
+        worker_seconds, worker_rss, renditions = measure(process_cover_image, upload, 1, config)
+
+        def size(path):
+            return os.path.getsize(os.path.join(folder, os.path.basename(path)))
+
+        print(f'upload:                {args.width}x{args.height}, {os.path.getsize(upload) / 1024:.0f} KiB')
+        print(f'in request, before:    {legacy_seconds * 1000:.0f} ms, peak RSS +{legacy_rss:.1f} MiB')
+        print(f'in request, now:       {stage_seconds * 1000:.1f} ms, peak RSS +{stage_rss:.1f} MiB')
+        print(f'in worker, now:        {worker_seconds * 1000:.0f} ms, peak RSS +{worker_rss:.1f} MiB')
+        print(f'legacy cover:          {legacy_bytes / 1024:.1f} KiB')
+        for name, rendition in renditions.items():
+            if 'webp' not in rendition:
+                print(f'{name + ":":<22} {rendition["width"]}x{rendition["height"]}  '
+                      f'jpeg {size(rendition["jpeg"]) / 1024:.1f} KiB')
+                continue
+            print(f'{name + ":":<22} {rendition["width"]}x{rendition["height"]}  '
+                  f'jpeg {size(rendition["jpeg"]) / 1024:.1f} KiB  webp {size(rendition["webp"]) / 1024:.1f} KiB')
+        for name in ('thumb', 'card'):
+            webp = size(renditions[name]['webp'])
+            print(f'home feed, {CARDS_PER_PAGE} covers as {name} webp: {CARDS_PER_PAGE * webp / 1024:.0f} KiB '
+                  f'vs {CARDS_PER_PAGE * legacy_bytes / 1024:.0f} KiB ({legacy_bytes / webp:.1f}x smaller)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+"""Benchmark PDF export of a very long story.
+
+Renders a synthetic story (500k words by default) with the export PDF writer
+and reports pages per second and peak memory. The chapters are spooled to a
+temporary file as exports spool them, so the text isn't held in memory while
+the PDF is laid out. Run from the repository root:
+
+    python -m benchmarks.pdf_export --words 500000 --chapters 100
+"""
+import argparse
+import io
+import resource
+import tempfile
+import time
+from datetime import datetime
+from app.exports import StorySnapshot, ChapterSnapshot, spool_chapters
+from app.pdf_writer import write_pdf
+
+SENTENCE = 'The quick brown fox jumps over the lazy dog while the story goes on. '
+
+
+def make_story(words, chapters, paragraph_words, folder):
+    per_chapter = words // chapters
+    paragraph = ' '.join((SENTENCE * (paragraph_words // 13 + 1)).split()[:paragraph_words])
+    paragraphs = max(1, per_chapter // paragraph_words)
+    content = '\n\n'.join([paragraph] * paragraphs)
+    spooled, spool = spool_chapters(
+        (ChapterSnapshot(number, f'Chapter {number}', content) for number in range(1, chapters + 1)), folder)
+    now = datetime.utcnow()
+    return StorySnapshot(
+        id=1, title='Benchmark', author='benchmark', description='Synthetic story', tags=[],
+        chapter_count=chapters, word_count=words, rating_count=0, average_rating=0,
+        created_at=now, last_updated=now, cover_path=None, cover_print=None,
+        chapters=spooled, spool=spool,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--words', type=int, default=500000)
+    parser.add_argument('--chapters', type=int, default=100)
+    parser.add_argument('--paragraph-words', type=int, default=120)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as folder:
+        story = make_story(args.words, args.chapters, args.paragraph_words, folder)
+        baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        out = io.BytesIO()
+        started = time.perf_counter()
+        pages = write_pdf(story, out)
+        elapsed = time.perf_counter() - started
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    print(f'words:          {args.words}')
+    print(f'chapters:       {args.chapters}')
+    print(f'pages:          {pages}')
+    print(f'seconds:        {elapsed:.2f}')
+    print(f'pages/second:   {pages / elapsed:.1f}')
+    print(f'pdf size:       {len(out.getvalue()) / 1024 / 1024:.1f} MiB')
+    print(f'peak RSS delta: {(peak - baseline) / 1024:.1f} MiB')
+
+
+if __name__ == '__main__':
+    main()
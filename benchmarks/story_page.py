@@ -0,0 +1,111 @@
+"""Benchmark time to first byte of a very long story's pages.
+
+Builds a synthetic story (300k words by default) and requests its overview
+page and a chapter in the reader, against the page as it used to be rendered
+(every chapter's text inline). The page cache is cleared before each request
+so every response is rendered from the database. Responses aren't streamed,
+so the time to the first byte is the time to the whole response. Uses
+DATABASE_URL, an in-memory SQLite database by default; point it at a scratch
+database, as the tables are created and dropped. Run from the repository root:
+
+    python -m benchmarks.story_page --words 300000 --chapters 100
+"""
+import argparse
+import os
+import statistics
+import time
+from flask import render_template_string
+
+os.environ.setdefault('DATABASE_URL', 'sqlite:///:memory:')
+
+from app import create_app
+from app.models import db, User, Story, Chapter
+from app.page_cache import page_cache
+from app.chapters import chapters_with_text
+
+SENTENCE = 'The quick brown fox jumps over the lazy dog while the story goes on. '
+
+# The chapter list story.html used to render, with every chapter's text
+LEGACY_PAGE = '''{% extends "base.html" %}
+{% block content %}
+<h1>{{ story.title }}</h1>
+<div class="accordion" id="storyChapters">
+{% for chapter in chapters %}
+    <div class="accordion-item">
+        <h2 class="accordion-header" id="heading{{ chapter.id }}">
+            <button class="accordion-button collapsed" type="button" data-bs-toggle="collapse"
+                    data-bs-target="#collapse{{ chapter.id }}">
+                Chapter {{ chapter.chapter_number }}: {{ chapter.title }}
+            </button>
+        </h2>
+        <div id="collapse{{ chapter.id }}" class="accordion-collapse collapse" data-bs-parent="#storyChapters">
+            <div class="accordion-body">{{ chapter.content }}</div>
+        </div>
+    </div>
+{% endfor %}
+</div>
+{% endblock %}'''
+
+
+def make_story(words, chapters):
+    user = User(username='benchmark', password_hash='')
+    db.session.add(user)
+    db.session.flush()
+    story = Story(title='Benchmark', user_id=user.id)
+    db.session.add(story)
+    db.session.flush()
+    per_chapter = words // chapters
+    content = ' '.join((SENTENCE * (per_chapter // 13 + 1)).split()[:per_chapter])
+    for number in range(1, chapters + 1):
+        db.session.add(Chapter(title=f'Chapter {number}', content=content, chapter_number=number, story_id=story.id))
+    db.session.commit()
+    return story.id
+
+
+def time_request(fetch, repeat):
+    """Median seconds and size in bytes of ``fetch()`` over ``repeat`` cold requests."""
+    timings = []
+    for _ in range(repeat):
+        page_cache.clear()
+        db.session.expire_all()
+        started = time.perf_counter()
+        body = fetch()
+        timings.append(time.perf_counter() - started)
+    return statistics.median(timings), len(body)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--words', type=int, default=300000)
+    parser.add_argument('--chapters', type=int, default=100)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    app = create_app()
+    with app.app_context():
+        db.create_all()
+        try:
+            story_id = make_story(args.words, args.chapters)
+            client = app.test_client()
+
+            def legacy():
+                with app.test_request_context(f'/story/{story_id}'):
+                    return render_template_string(LEGACY_PAGE, story=Story.query.get(story_id),
+                                                  chapters=chapters_with_text(story_id)).encode()
+
+            pages = (
+                ('before, whole book:', legacy),
+                ('now, overview:', lambda: client.get(f'/story/{story_id}').data),
+                ('now, one chapter:', lambda: client.get(f'/story/{story_id}/chapter/{args.chapters // 2}').data),
+            )
+            print(f'story:               {args.words} words in {args.chapters} chapters')
+            for name, fetch in pages:
+                seconds, size = time_request(fetch, args.repeat)
+                print(f'{name:<20} {seconds * 1000:7.1f} ms, {size / 1024:7.1f} KiB')
+        finally:
+            db.session.remove()
+            db.drop_all()
+
+
+if __name__ == '__main__':
+    main()
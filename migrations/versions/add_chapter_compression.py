@@ -0,0 +1,45 @@
+"""Allow chapter text to be stored compressed, and keep chapter excerpts
+
+Revision ID: add_chapter_compression
+Revises: add_cover_pending
+Create Date: 2026-10-18 20:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'add_chapter_compression'
+down_revision = 'add_cover_pending'
+branch_labels = None
+depends_on = None
+
+BATCH_SIZE = 500
+EXCERPT_LENGTH = 200
+
+
+def upgrade():
+    op.add_column('chapter', sa.Column('content_compressed', sa.LargeBinary(), nullable=True))
+    op.add_column('chapter', sa.Column('excerpt', sa.String(length=EXCERPT_LENGTH), nullable=False, server_default=''))
+    with op.batch_alter_table('chapter') as batch_op:
+        batch_op.alter_column('content', existing_type=sa.Text(), nullable=True)
+
+    # Every chapter is still plain text here; `flask chapters recompress`
+    # compresses them once CHAPTER_COMPRESSION is set
+    connection = op.get_bind()
+    max_id = connection.execute(sa.text('SELECT MAX(id) FROM chapter')).scalar() or 0
+    for start in range(0, max_id + 1, BATCH_SIZE):
+        connection.execute(
+            sa.text('UPDATE chapter SET excerpt = substr(content, 1, :length) WHERE id >= :start AND id < :end'),
+            {'length': EXCERPT_LENGTH, 'start': start, 'end': start + BATCH_SIZE}
+        )
+
+
+def downgrade():
+    # Run `flask chapters recompress` with CHAPTER_COMPRESSION unset first:
+    # compressed chapters have no plain text to fall back on
+    with op.batch_alter_table('chapter') as batch_op:
+        batch_op.alter_column('content', existing_type=sa.Text(), nullable=False)
+    op.drop_column('chapter', 'excerpt')
+    op.drop_column('chapter', 'content_compressed')
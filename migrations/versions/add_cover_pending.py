@@ -0,0 +1,24 @@
+"""Mark stories whose cover upload is still being processed
+
+Revision ID: add_cover_pending
+Revises: add_cover_renditions
+Create Date: 2026-10-18 17:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'add_cover_pending'
+down_revision = 'add_cover_renditions'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('story', sa.Column('cover_pending', sa.String(length=16), nullable=True))
+
+
+def downgrade():
+    op.drop_column('story', 'cover_pending')
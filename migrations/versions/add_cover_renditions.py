@@ -0,0 +1,26 @@
+"""Record cover image renditions
+
+Revision ID: add_cover_renditions
+Revises: add_word_count_index
+Create Date: 2026-10-18 16:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'add_cover_renditions'
+down_revision = 'add_word_count_index'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Existing covers keep working from cover_image until
+    # `flask covers backfill` has generated their renditions
+    op.add_column('story', sa.Column('cover_renditions', sa.JSON(none_as_null=True), nullable=True))
+
+
+def downgrade():
+    op.drop_column('story', 'cover_renditions')
@@ -0,0 +1,54 @@
+"""Add full-text search vector
+
+Revision ID: add_fulltext_search
+Revises: add_story_stats
+Create Date: 2026-10-18 11:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = 'add_fulltext_search'
+down_revision = 'add_story_stats'
+branch_labels = None
+depends_on = None
+
+BATCH_SIZE = 500
+
+
+def upgrade():
+    # SQLite development databases get their FTS5 table from db.create_all()
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+
+    op.add_column('story', sa.Column('search_vector', postgresql.TSVECTOR(), nullable=True))
+
+    connection = op.get_bind()
+    max_story_id = connection.execute(sa.text('SELECT MAX(id) FROM story')).scalar() or 0
+    for start in range(0, max_story_id + 1, BATCH_SIZE):
+        connection.execute(sa.text('''
+            UPDATE story SET search_vector =
+                setweight(to_tsvector('english', coalesce(story.title, '')), 'A') ||
+                setweight(to_tsvector('english', coalesce(story.description, '') || ' ' || coalesce(
+                    (SELECT string_agg(tag.name, ' ') FROM tag
+                     JOIN story_tags ON story_tags.tag_id = tag.id
+                     WHERE story_tags.story_id = story.id), '')), 'B') ||
+                strip(to_tsvector('english', coalesce(
+                    (SELECT string_agg(chapter.content, ' ') FROM chapter
+                     WHERE chapter.story_id = story.id), '')))
+            WHERE id >= :start AND id < :end
+        '''), {'start': start, 'end': start + BATCH_SIZE})
+
+    # Build the index after the backfill rather than maintaining it row by row
+    op.create_index('ix_story_search_vector', 'story', ['search_vector'], postgresql_using='gin')
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+
+    op.drop_index('ix_story_search_vector', table_name='story')
+    op.drop_column('story', 'search_vector')
@@ -0,0 +1,60 @@
+"""Add story rating histogram
+
+Revision ID: add_rating_stats
+Revises: add_fulltext_search
+Create Date: 2026-10-18 13:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'add_rating_stats'
+down_revision = 'add_fulltext_search'
+branch_labels = None
+depends_on = None
+
+BATCH_SIZE = 500
+
+
+def upgrade():
+    op.create_table('story_rating_stats',
+        sa.Column('story_id', sa.Integer(), nullable=False),
+        sa.Column('stars_1', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('stars_2', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('stars_3', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('stars_4', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('stars_5', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('rating_count', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('average', sa.Float(), nullable=False, server_default='0'),
+        sa.ForeignKeyConstraint(['story_id'], ['story.id'], ),
+        sa.PrimaryKeyConstraint('story_id')
+    )
+
+    # Every story gets a row, including unrated ones, so rating sorts can inner join
+    connection = op.get_bind()
+    max_story_id = connection.execute(sa.text('SELECT MAX(id) FROM story')).scalar() or 0
+    for start in range(0, max_story_id + 1, BATCH_SIZE):
+        connection.execute(sa.text('''
+            INSERT INTO story_rating_stats
+                (story_id, stars_1, stars_2, stars_3, stars_4, stars_5, rating_count, average)
+            SELECT story.id,
+                   COUNT(CASE WHEN rating.value = 1 THEN 1 END),
+                   COUNT(CASE WHEN rating.value = 2 THEN 1 END),
+                   COUNT(CASE WHEN rating.value = 3 THEN 1 END),
+                   COUNT(CASE WHEN rating.value = 4 THEN 1 END),
+                   COUNT(CASE WHEN rating.value = 5 THEN 1 END),
+                   COUNT(rating.id),
+                   COALESCE(AVG(CAST(rating.value AS FLOAT)), 0)
+            FROM story LEFT JOIN rating ON rating.story_id = story.id
+            WHERE story.id >= :start AND story.id < :end
+            GROUP BY story.id
+        '''), {'start': start, 'end': start + BATCH_SIZE})
+
+    op.create_index('ix_story_rating_stats_average', 'story_rating_stats', ['average', 'story_id'])
+
+
+def downgrade():
+    op.drop_index('ix_story_rating_stats_average', table_name='story_rating_stats')
+    op.drop_table('story_rating_stats')
@@ -0,0 +1,66 @@
+"""Add denormalized story statistics
+
+Revision ID: add_story_stats
+Revises: add_chapters
+Create Date: 2026-10-18 09:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'add_story_stats'
+down_revision = 'add_chapters'
+branch_labels = None
+depends_on = None
+
+BATCH_SIZE = 500
+
+
+def upgrade():
+    op.add_column('chapter', sa.Column('word_count', sa.Integer(), nullable=False, server_default='0'))
+    op.add_column('story', sa.Column('word_count', sa.Integer(), nullable=False, server_default='0'))
+    op.add_column('story', sa.Column('chapter_count', sa.Integer(), nullable=False, server_default='0'))
+    op.add_column('story', sa.Column('rating_sum', sa.Integer(), nullable=False, server_default='0'))
+    op.add_column('story', sa.Column('rating_count', sa.Integer(), nullable=False, server_default='0'))
+
+    connection = op.get_bind()
+
+    # Backfill chapter word counts in id-ordered batches so we never hold
+    # more than BATCH_SIZE chapter bodies in memory at once
+    last_id = 0
+    while True:
+        rows = connection.execute(
+            sa.text('SELECT id, content FROM chapter WHERE id > :last_id ORDER BY id LIMIT :limit'),
+            {'last_id': last_id, 'limit': BATCH_SIZE}
+        ).fetchall()
+        if not rows:
+            break
+        connection.execute(
+            sa.text('UPDATE chapter SET word_count = :word_count WHERE id = :id'),
+            [{'id': chapter_id, 'word_count': len(content.split()) if content else 0}
+             for chapter_id, content in rows]
+        )
+        last_id = rows[-1][0]
+
+    # Roll chapter and rating totals up to their stories, one id range at a time
+    max_story_id = connection.execute(sa.text('SELECT MAX(id) FROM story')).scalar() or 0
+    for start in range(0, max_story_id + 1, BATCH_SIZE):
+        params = {'start': start, 'end': start + BATCH_SIZE}
+        connection.execute(sa.text('''
+            UPDATE story SET
+                word_count = (SELECT COALESCE(SUM(word_count), 0) FROM chapter WHERE chapter.story_id = story.id),
+                chapter_count = (SELECT COUNT(*) FROM chapter WHERE chapter.story_id = story.id),
+                rating_sum = (SELECT COALESCE(SUM(value), 0) FROM rating WHERE rating.story_id = story.id),
+                rating_count = (SELECT COUNT(*) FROM rating WHERE rating.story_id = story.id)
+            WHERE id >= :start AND id < :end
+        '''), params)
+
+
+def downgrade():
+    op.drop_column('story', 'rating_count')
+    op.drop_column('story', 'rating_sum')
+    op.drop_column('story', 'chapter_count')
+    op.drop_column('story', 'word_count')
+    op.drop_column('chapter', 'word_count')
@@ -0,0 +1,23 @@
+"""Index story word counts
+
+Revision ID: add_word_count_index
+Revises: add_rating_stats
+Create Date: 2026-10-18 14:00:00.000000
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'add_word_count_index'
+down_revision = 'add_rating_stats'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_story_word_count', 'story', ['word_count', 'id'])
+
+
+def downgrade():
+    op.drop_index('ix_story_word_count', table_name='story')
@@ -0,0 +1,13 @@
+import pytest
+from app import cache
+
+
+@pytest.fixture(autouse=True)
+def fresh_catalogue():
+    """Start every test's caches afresh.
+
+    Each test gets a new database whose ids repeat the last one's, so nothing
+    cached by an earlier test may match in a later one.
+    """
+    yield
+    cache.bump_catalogue_generation(list(cache._author_generations))
@@ -1,17 +1,21 @@
 import pytest
+import re
+from contextlib import contextmanager
+from sqlalchemy import event
 from app import create_app
 from app.models import db, User, Story, Chapter, SavedStory, Tag
 from flask_login import login_user, current_user
 from werkzeug.security import generate_password_hash
 
 @pytest.fixture
-def app():
+def app(tmp_path):
     """Create and configure a Flask app for testing."""
     app = create_app()
     app.config.update({
         'TESTING': True,
         'SQLALCHEMY_DATABASE_URI': 'sqlite:///:memory:',
         'WTF_CSRF_ENABLED': False,
+        'EXPORT_CACHE_FOLDER': str(tmp_path / 'exports'),
     })
     
     with app.app_context():
@@ -47,6 +51,32 @@ def auth_client(client, test_user):
             session['_user_id'] = str(test_user.id)
     return client
 
+@contextmanager
+def count_queries():
+    """Count the SQL statements executed inside the block."""
+    statements = []
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+    event.listen(db.engine, 'before_cursor_execute', record)
+    try:
+        yield statements
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', record)
+
+def add_card_stories(user, count):
+    """Add stories with tags, chapters, ratings and library entries for listing tests."""
+    from app.models import Rating
+    start = Story.query.count()
+    for i in range(start, start + count):
+        story = Story(title=f'Story {i}', user_id=user.id)
+        story.tags.append(Tag(name=f'tag{i}'))
+        db.session.add(story)
+        db.session.flush()
+        db.session.add(Chapter(title='One', content='some words here', chapter_number=1, story_id=story.id))
+        db.session.add(Rating(user_id=user.id, story_id=story.id, value=4))
+        db.session.add(SavedStory(user_id=user.id, story_id=story.id))
+    db.session.commit()
+
 # Authentication Tests
 def test_register(client):
     """Test user registration."""
@@ -122,6 +152,114 @@ def test_view_story(client, test_user):
         assert b'Test Story' in response.data
         assert b'Test Description' in response.data
 
+def test_story_page_lists_chapters_without_text(client, test_user):
+    """Test that the story page links to its chapters without loading their text."""
+    with client.application.app_context():
+        story = Story(title='Test Story', user_id=test_user.id)
+        db.session.add(story)
+        db.session.flush()
+        for number in (1, 2):
+            db.session.add(Chapter(title=f'Part {number}', content=f'opening line {number}. ' + 'filler ' * 50 + 'secret ending',
+                                   chapter_number=number, story_id=story.id))
+        db.session.commit()
+
+        with count_queries() as statements:
+            response = client.get(f'/story/{story.id}')
+        assert response.status_code == 200
+        assert b'Part 2' in response.data
+        assert f'/story/{story.id}/chapter/2'.encode() in response.data
+        assert b'opening line 2' in response.data
+        assert b'secret ending' not in response.data
+        assert not any('chapter.content AS' in statement for statement in statements)
+
+def test_chapter_text_is_deferred(app, test_user):
+    """Test that loading a story's chapters leaves their text until it is asked for."""
+    from sqlalchemy.orm import undefer_group
+    story = Story(title='Test Story', user_id=test_user.id)
+    db.session.add(story)
+    db.session.flush()
+    db.session.add(Chapter(title='One', content='a few words of text', chapter_number=1, story_id=story.id))
+    db.session.commit()
+    db.session.expire_all()
+
+    with count_queries() as statements:
+        chapter = Story.query.get(story.id).chapters[0]
+        assert (chapter.title, chapter.word_count, chapter.excerpt) == ('One', 5, 'a few words of text')
+    assert not any('chapter.content AS' in statement for statement in statements)
+
+    with count_queries() as statements:
+        assert chapter.content == 'a few words of text'
+    assert len(statements) == 1
+
+    db.session.expire_all()
+    with count_queries() as statements:
+        chapter = Chapter.query.options(undefer_group('text')).first()
+        assert chapter.content == 'a few words of text'
+    assert len(statements) == 1
+
+def test_recompress_chapters(auth_client, app):
+    """Test that recompress converts stored chapters and edits keep working on compressed ones."""
+    text = ' '.join(f'Chapter sentence number {i} goes here.' for i in range(60))
+    with app.app_context():
+        auth_client.post('/write', data={
+            'title': 'Draft',
+            'chapter_title[]': ['One', 'Two'],
+            'chapter_content[]': [text, text + ' More.'],
+        })
+        story = Story.query.first()
+        assert all(chapter.content_compressed is None for chapter in story.chapters)
+
+        app.config['CHAPTER_COMPRESSION'] = 'zlib'
+        result = app.test_cli_runner().invoke(args=['chapters', 'recompress', '--batch-size', '1'])
+        assert 'Converted 2 chapters' in result.output
+        db.session.expire_all()
+        chapters = Chapter.query.order_by(Chapter.id).all()
+        assert all(chapter._content is None and chapter.content_compressed for chapter in chapters)
+        assert chapters[1].content == text + ' More.'
+        result = app.test_cli_runner().invoke(args=['chapters', 'recompress'])
+        assert 'Converted 0 chapters' in result.output
+
+        ids = [str(chapter.id) for chapter in chapters]
+        auth_client.post(f'/story/{story.id}/edit', data={
+            'title': 'Draft',
+            'chapter_id[]': ids,
+            'chapter_title[]': ['One', 'Two'],
+            'chapter_content[]': [text, text + ' Rewritten ending.'],
+        })
+        response = auth_client.get(f'/story/{story.id}/chapter/2')
+        assert b'Rewritten ending.' in response.data
+        assert b'Draft' in auth_client.get('/?search=rewritten').data
+
+        app.config['CHAPTER_COMPRESSION'] = None
+        result = app.test_cli_runner().invoke(args=['chapters', 'recompress'])
+        assert 'Converted 2 chapters' in result.output
+        db.session.expire_all()
+        assert [chapter._content for chapter in Chapter.query.order_by(Chapter.id)] == [text, text + ' Rewritten ending.']
+
+def test_read_chapter(client, test_user):
+    """Test that the chapter reader shows one chapter with links to its neighbours."""
+    with client.application.app_context():
+        story = Story(title='Test Story', user_id=test_user.id)
+        db.session.add(story)
+        db.session.flush()
+        for number in (1, 2, 3):
+            db.session.add(Chapter(title=f'Part {number}', content=f'secret text {number}',
+                                   chapter_number=number, story_id=story.id))
+        db.session.commit()
+
+        response = client.get(f'/story/{story.id}/chapter/2')
+        assert response.status_code == 200
+        assert b'secret text 2' in response.data
+        assert b'secret text 1' not in response.data and b'secret text 3' not in response.data
+        assert f'href="/story/{story.id}/chapter/1" class="btn btn-outline-primary" rel="prev"'.encode() in response.data
+        assert f'href="/story/{story.id}/chapter/3" class="btn btn-outline-primary" rel="next"'.encode() in response.data
+
+        response = client.get(f'/story/{story.id}/chapter/1')
+        assert b'rel="prev"' not in response.data and b'rel="next"' in response.data
+
+        assert client.get(f'/story/{story.id}/chapter/4').status_code == 404
+        assert client.get('/story/999/chapter/1').status_code == 404
+
 def test_rate_story(auth_client, test_user):
     """Test rating a story."""
     with auth_client.application.app_context():
@@ -142,6 +280,55 @@ def test_rate_story(auth_client, test_user):
         saved_story = Story.query.first()
         assert len(saved_story.ratings) == 1
         assert saved_story.ratings[0].value == 5
+        assert saved_story.rating_count == 1
+        assert saved_story.average_rating == 5
+
+def test_rating_stats_maintained(auth_client, test_user):
+    """Test that changing and removing a rating keeps the story totals in step."""
+    with auth_client.application.app_context():
+        story = Story(title='Test Story', user_id=test_user.id)
+        db.session.add(story)
+        db.session.commit()
+
+        last_updated = story.last_updated
+        auth_client.post(f'/story/{story.id}/rate', data={'rating': 2})
+        auth_client.post(f'/story/{story.id}/rate', data={'rating': 4})
+        db.session.expire_all()
+        story = Story.query.first()
+        assert story.rating_count == 1
+        assert story.rating_sum == 4
+        assert story.rating_stats.stars_4 == 1
+        assert story.rating_stats.stars_2 == 0
+        assert story.rating_stats.average == 4
+        assert story.last_updated == last_updated
+
+        response = auth_client.get(f'/story/{story.id}')
+        assert b'rating-histogram' in response.data
+
+        auth_client.post(f'/story/{story.id}/remove_rating')
+        db.session.expire_all()
+        story = Story.query.first()
+        assert story.rating_count == 0
+        assert story.average_rating == 0
+        assert story.rating_stats.rating_count == 0
+        assert story.rating_stats.average == 0
+
+def test_write_story_stats(auth_client):
+    """Test that writing a story stores its chapter and word counts."""
+    response = auth_client.post('/write', data={
+        'title': 'Counted Story',
+        'description': 'Description',
+        'chapter_title[]': ['One', 'Two'],
+        'chapter_content[]': ['a b c', 'd e'],
+        'tags': 'fantasy'
+    }, follow_redirects=True)
+    assert response.status_code == 200
+
+    with auth_client.application.app_context():
+        story = Story.query.filter_by(title='Counted Story').first()
+        assert story.chapter_count == 2
+        assert story.word_count == 5
+        assert b'5 words' in response.data
 
 def test_remove_rating(auth_client, test_user):
     """Test removing a story rating."""
@@ -244,6 +431,950 @@ def test_combined_search(client, test_user):
         assert b'Fantasy Adventure' in response.data
         assert b'Sci-Fi Story' not in response.data
 
+def test_parse_search_query():
+    """Test tokenizing modifiers, negation, OR and escaped quotes in one pass."""
+    from app.search_query import parse, Term
+    groups = parse('title:"say \\"hi\\"" -tags:"horror" dragons OR by:"someone" rating_more_than:4')
+    assert groups == [
+        [Term('title', 'say "hi"', False), Term('tags', 'horror', True), Term(None, 'dragons', False)],
+        [Term('by', 'someone', False), Term('rating_more_than', '4', False)],
+    ]
+    assert parse('unknown:"value"') == [[Term(None, 'unknown:value', False)]]
+
+def test_search_negation_and_or(client, test_user):
+    """Test excluding tags and combining alternatives with OR."""
+    with client.application.app_context():
+        story1 = Story(title='Haunted House', user_id=test_user.id)
+        story2 = Story(title='Sunny Meadow', user_id=test_user.id)
+        story3 = Story(title='Quiet Lake', user_id=test_user.id)
+        story1.tags.append(Tag(name='horror'))
+        story2.tags.append(Tag(name='cozy'))
+        db.session.add_all([story1, story2, story3])
+        db.session.commit()
+
+        response = client.get('/?search=-tags:"horror"')
+        assert b'Haunted House' not in response.data
+        assert b'Sunny Meadow' in response.data
+        assert b'Quiet Lake' in response.data
+
+        response = client.get('/?search=title:"Haunted" OR tags:"cozy"')
+        assert b'Haunted House' in response.data
+        assert b'Sunny Meadow' in response.data
+        assert b'Quiet Lake' not in response.data
+
+def test_search_plan_cache(client):
+    """Test that repeated searches reuse the compiled plan."""
+    from app.search_query import compile_search, plan_cache_info
+    with client.application.app_context():
+        first = compile_search('title:"cached"  rating_more_than:3')
+        hits = plan_cache_info().hits
+        assert compile_search('title:"cached" rating_more_than:3') is first
+        assert plan_cache_info().hits == hits + 1
+
+def test_word_count_sort_and_filters(auth_client):
+    """Test that word sorting and filters use word counts rather than characters."""
+    with auth_client.application.app_context():
+        for title, content in [('Long Words', 'extraordinarily incomprehensible circumlocutions'),
+                               ('Many Words', 'a b c d e f'),
+                               ('Few Words', 'x y')]:
+            auth_client.post('/write', data={
+                'title': title,
+                'chapter_title[]': ['One'],
+                'chapter_content[]': [content],
+            })
+
+        response = auth_client.get('/?sort=words')
+        data = response.data
+        assert data.index(b'Many Words') < data.index(b'Long Words') < data.index(b'Few Words')
+
+        response = auth_client.get('/?search=words_more_than:"3"')
+        assert b'Many Words' in response.data
+        assert b'Long Words' not in response.data
+        assert b'Few Words' not in response.data
+
+        response = auth_client.get('/?search=words_less_than:"6" -words_less_than:"3"')
+        assert b'Many Words' not in response.data
+        assert b'Long Words' in response.data
+        assert b'Few Words' not in response.data
+
+def test_word_count_filter_out_of_range(auth_client):
+    """Test that infinite or huge word-count filters are ignored or clamped instead of failing."""
+    with auth_client.application.app_context():
+        auth_client.post('/write', data={
+            'title': 'Counted', 'chapter_title[]': ['One'], 'chapter_content[]': ['a b c'],
+        })
+        for search in ('words_more_than:"inf"', 'words_less_than:"-inf"', 'words_more_than:"nan"'):
+            response = auth_client.get(f'/?search={search}')
+            assert response.status_code == 200
+            assert b'Counted' in response.data
+
+        response = auth_client.get('/?search=words_more_than:"1e30"')
+        assert response.status_code == 200
+        assert b'Counted' not in response.data
+        response = auth_client.get('/?search=words_less_than:"1e30" words_more_than:"-1e30"')
+        assert response.status_code == 200
+        assert b'Counted' in response.data
+
+def test_full_text_search(auth_client):
+    """Test free-text search over chapter content with highlighted snippets."""
+    auth_client.post('/write', data={
+        'title': 'Dragon Tale',
+        'description': 'A quiet story',
+        'chapter_title[]': ['One'],
+        'chapter_content[]': ['The <b>wyvern</b> circled the mountain at dawn.'],
+        'tags': 'fantasy'
+    })
+    auth_client.post('/write', data={
+        'title': 'Sea Story',
+        'description': 'Sailing',
+        'chapter_title[]': ['One'],
+        'chapter_content[]': ['Waves broke over the bow.'],
+        'tags': 'adventure'
+    })
+
+    response = auth_client.get('/?search=wyvern mount')
+    assert response.status_code == 200
+    assert b'Dragon Tale' in response.data
+    assert b'Sea Story' not in response.data
+    assert b'<mark>wyvern</mark>' in response.data
+    assert b'<b>' not in response.data
+
+    response = auth_client.get('/?search=adventure')
+    assert b'Sea Story' in response.data
+    assert b'Dragon Tale' not in response.data
+
+def test_full_text_index_follows_edits(auth_client):
+    """Test that editing a story replaces its full-text index entry."""
+    with auth_client.application.app_context():
+        auth_client.post('/write', data={
+            'title': 'Draft',
+            'chapter_title[]': ['One'],
+            'chapter_content[]': ['original words'],
+        })
+        story_id = Story.query.first().id
+
+        auth_client.post(f'/story/{story_id}/edit', data={
+            'title': 'Draft',
+            'chapter_title[]': ['One'],
+            'chapter_content[]': ['rewritten passage'],
+        })
+        assert b'Draft' in auth_client.get('/?search=rewritten').data
+        assert b'Draft' not in auth_client.get('/?search=original').data
+
+def test_edit_writes_only_changed_chapter(auth_client):
+    """Test that editing one chapter updates that row alone and keeps chapter ids."""
+    with auth_client.application.app_context():
+        auth_client.post('/write', data={
+            'title': 'Draft',
+            'chapter_title[]': ['One', 'Two', 'Three'],
+            'chapter_content[]': ['first part', 'second part', 'third part'],
+        })
+        story = Story.query.first()
+        ids = [str(chapter.id) for chapter in story.chapters]
+
+        with count_queries() as statements:
+            auth_client.post(f'/story/{story.id}/edit', data={
+                'title': 'Draft',
+                'chapter_id[]': ids,
+                'chapter_title[]': ['One', 'Two', 'Three'],
+                'chapter_content[]': ['first part', 'second part, now longer', 'third part'],
+            })
+        writes = [s for s in statements if re.match(r'(INSERT INTO|UPDATE|DELETE FROM) chapter ', s)]
+        assert len(writes) == 1 and writes[0].startswith('UPDATE chapter')
+
+        db.session.expire_all()
+        story = Story.query.first()
+        assert [str(chapter.id) for chapter in story.chapters] == ids
+        assert story.chapters[1].content == 'second part, now longer'
+        assert story.chapters[1].word_count == 4
+        assert story.word_count == 8
+
+def test_edit_reorders_adds_and_removes_chapters(auth_client, test_user):
+    """Test that chapters can be moved, added and removed, and foreign ids are inserted as new."""
+    with auth_client.application.app_context():
+        other = Story(title='Other', user_id=test_user.id)
+        db.session.add(other)
+        db.session.flush()
+        foreign = Chapter(title='Elsewhere', content='not yours', chapter_number=1, story_id=other.id)
+        db.session.add(foreign)
+        db.session.commit()
+        auth_client.post('/write', data={
+            'title': 'Draft',
+            'chapter_title[]': ['One', 'Two', 'Three'],
+            'chapter_content[]': ['first part', 'second part', 'third part'],
+        })
+        story = Story.query.filter_by(title='Draft').first()
+        one, two, three = [chapter.id for chapter in story.chapters]
+
+        with count_queries() as statements:
+            auth_client.post(f'/story/{story.id}/edit', data={
+                'title': 'Draft',
+                'chapter_id[]': [str(three), '', str(foreign.id), str(two)],
+                'chapter_title[]': ['Three', 'New', 'Stolen', 'Two'],
+                'chapter_content[]': ['third part', 'new part', 'not yours', 'second part'],
+            })
+        writes = [s.split()[0] for s in statements if re.match(r'(INSERT INTO|UPDATE|DELETE FROM) chapter ', s)]
+        assert sorted(writes) == ['DELETE', 'INSERT', 'UPDATE']
+
+        db.session.expire_all()
+        story = Story.query.filter_by(title='Draft').first()
+        chapters = story.chapters
+        assert [chapter.title for chapter in chapters] == ['Three', 'New', 'Stolen', 'Two']
+        assert [chapter.chapter_number for chapter in chapters] == [1, 2, 3, 4]
+        assert chapters[0].id == three and chapters[3].id == two
+        assert one not in [chapter.id for chapter in chapters]
+        assert foreign.id not in [chapter.id for chapter in chapters]
+        assert Chapter.query.get(foreign.id).story_id == other.id
+        assert story.chapter_count == 4
+
+def test_tags_saved_in_bulk(auth_client):
+    """Test that a story's tags are saved with a fixed number of statements, as a set difference."""
+    with auth_client.application.app_context():
+        db.session.add(Tag(name='existing'))
+        db.session.commit()
+
+        names = ', '.join(['Existing', 'existing!'] + [f'tag{i}' for i in range(12)])
+        with count_queries() as statements:
+            auth_client.post('/write', data={
+                'title': 'Draft', 'tags': names,
+                'chapter_title[]': ['One'], 'chapter_content[]': ['some words'],
+            })
+        # Loading story.tags afterwards (for the search index) isn't part of saving them
+        tag_statements = [s for s in statements if re.match(r'(SELECT tag\.name|INSERT INTO tag|(INSERT INTO|DELETE FROM|SELECT) story_tags)\b', s)]
+        assert len(tag_statements) == 4  # Select, insert, select the ids inserted (no RETURNING on SQLite), link
+
+        story = Story.query.filter_by(title='Draft').first()
+        assert sorted(tag.name for tag in story.tags) == sorted(['existing'] + [f'tag{i}' for i in range(9)])
+        assert Tag.query.count() == 10
+
+        tag_ids = {tag.name: tag.id for tag in story.tags}
+        with count_queries() as statements:
+            auth_client.post(f'/story/{story.id}/edit', data={
+                'title': 'Draft', 'tags': 'existing, tag1, new',
+                'chapter_title[]': ['One'], 'chapter_content[]': ['some words'],
+            })
+        links = [s.split()[0] for s in statements if re.match(r'(INSERT INTO|DELETE FROM) story_tags\b', s)]
+        assert links == ['DELETE', 'INSERT']
+
+        db.session.expire_all()
+        story = Story.query.get(story.id)
+        assert {tag.name: tag.id for tag in story.tags if tag.name != 'new'} == \
+            {'existing': tag_ids['existing'], 'tag1': tag_ids['tag1']}
+        assert sorted(tag.name for tag in story.tags) == ['existing', 'new', 'tag1']
+
+def test_tag_created_concurrently(app, monkeypatch):
+    """Test that a tag added by another save after the lookup is reused rather than failing."""
+    from app import tags
+    db.session.add(Tag(name='racing'))
+    db.session.commit()
+    lookups = []
+    select_ids = tags._select_ids
+    def stale_first_lookup(names):
+        # The first lookup runs before the other save committed its tag
+        lookups.append(names)
+        return {} if len(lookups) == 1 else select_ids(names)
+    monkeypatch.setattr(tags, '_select_ids', stale_first_lookup)
+
+    ids = tags.get_or_create_tags(['racing', 'fresh'])
+    db.session.commit()
+    assert ids == {tag.name: tag.id for tag in Tag.query}
+    assert Tag.query.count() == 2
+
+# Listing Tests
+@pytest.mark.parametrize('url', ['/', '/library', '/profile'])
+def test_listing_query_count_is_constant(auth_client, test_user, url):
+    """Test that listing pages issue the same number of queries for few or many stories."""
+    with auth_client.application.app_context():
+        counts = []
+        for batch in (2, 8):
+            add_card_stories(test_user, batch)
+            db.session.expire_all()
+            with count_queries() as statements:
+                response = auth_client.get(url)
+            assert response.status_code == 200
+            counts.append(len(statements))
+        assert counts[0] == counts[1]
+        assert counts[0] <= 8
+
+@pytest.mark.parametrize('url', ['/', '/library', '/profile'])
+def test_warm_listing_renders_cached_cards(auth_client, test_user, url):
+    """Test that a warm listing only loads the page's stories and reuses their cards."""
+    from app.fragments import card_cache
+    card_cache.clear()
+    with auth_client.application.app_context():
+        add_card_stories(test_user, 3)
+        auth_client.get(url)
+        db.session.expire_all()
+        with count_queries() as statements:
+            response = auth_client.get(url)
+        assert response.status_code == 200
+        assert not any('tag' in statement.lower() for statement in statements)
+        assert card_cache.stats()['entries'] == 3
+
+def test_story_card_follows_story_changes(auth_client, test_user):
+    """Test that cached cards are replaced when a story is edited or rated."""
+    from app.models import Rating
+    with auth_client.application.app_context():
+        add_card_stories(test_user, 1)
+        story = Story.query.first()
+        assert b'4.0' in auth_client.get('/').data
+
+        db.session.add(Rating(user_id=test_user.id + 1, story_id=story.id, value=2))
+        db.session.commit()
+        assert b'3.0' in auth_client.get('/').data
+
+        auth_client.post(f'/story/{story.id}/edit', data={
+            'title': 'Renamed Story',
+            'description': '',
+            'tags': 'renamed',
+            'chapter_title[]': ['One'],
+            'chapter_content[]': ['some words here'],
+        })
+        response = auth_client.get('/')
+        assert b'Renamed Story' in response.data
+        assert b'class="tag">renamed</a>' in response.data
+
+def test_keyset_pagination(client, test_user):
+    """Test following next/prev cursors through every sort option."""
+    import re
+    from html import unescape
+    from app.models import Rating
+    with client.application.app_context():
+        for i in range(45):
+            story = Story(title=f'Paged {i:02d}', user_id=test_user.id)
+            db.session.add(story)
+            db.session.flush()
+            db.session.add(Chapter(title='One', content='word ' * (i % 7 + 1), chapter_number=1, story_id=story.id))
+            if i % 3:
+                db.session.add(Rating(user_id=test_user.id, story_id=story.id, value=i % 5 + 1))
+        db.session.commit()
+
+        def titles(response):
+            return re.findall(rb'>(Paged \d\d)</a></h2>', response.data)
+
+        def link(response, icon):
+            match = re.search(r'href="([^"]+)" class="btn btn-outline-primary" >\s*<i class="fas fa-angle-' + icon + '"', response.data.decode())
+            return unescape(match.group(1)) if match else None
+
+        for sort in ['desc', 'asc', 'words', 'chapters', 'rating', 'title', 'author']:
+            first = client.get(f'/?sort={sort}')
+            pages = [titles(first)]
+            response = first
+            while link(response, 'right'):
+                response = client.get(link(response, 'right'))
+                pages.append(titles(response))
+            seen = [title for page in pages for title in page]
+            assert [len(page) for page in pages] == [20, 20, 5], sort
+            assert len(set(seen)) == 45, sort
+
+            # Walking back from the last page retraces the same pages
+            back = client.get(link(response, 'left'))
+            assert titles(back) == pages[1], sort
+            assert titles(client.get(link(back, 'left'))) == pages[0], sort
+
+def test_invalid_cursor_falls_back_to_first_page(client, test_user):
+    """Test that a corrupt or mismatched cursor is ignored."""
+    with client.application.app_context():
+        db.session.add(Story(title='Only Story', user_id=test_user.id))
+        db.session.commit()
+        assert b'Only Story' in client.get('/?after=not-a-cursor').data
+        from app.pagination import encode_cursor
+        assert b'Only Story' in client.get(f'/?sort=title&after={encode_cursor("desc", [1])}').data
+        for values in ([{'a': 1}], [[1]], [True], [float('inf')], [None], [10 ** 30], ['1'], [1.5]):
+            response = client.get(f'/?after={encode_cursor("desc", values)}')
+            assert response.status_code == 200
+            assert b'Only Story' in response.data
+        # Each value has to suit its own key
+        for sort, values in (('title', [1, 1]), ('title', ['a', 'b']), ('rating', [4.5, 10 ** 30])):
+            response = client.get(f'/?sort={sort}&after={encode_cursor(sort, values)}')
+            assert response.status_code == 200
+            assert b'Only Story' in response.data
+        # A well-formed cursor is still followed (nothing is rated below -1)
+        response = client.get(f'/?sort=rating&after={encode_cursor("rating", [-1.0, 10 ** 9])}')
+        assert b'Only Story' not in response.data
+
+def test_listing_count_cached_until_catalogue_changes(client, test_user):
+    """Test that result counts are reused until a story is written."""
+    from app.counts import count_cache
+    count_cache.clear()
+    with client.application.app_context():
+        db.session.add(Story(title='Counted', user_id=test_user.id))
+        db.session.commit()
+
+        client.get('/?search=title:"Counted"')
+        with count_queries() as statements:
+            client.get('/?search=title:"Counted"')
+        assert not any('count(' in statement.lower() for statement in statements)
+
+        db.session.add(Story(title='Counted Again', user_id=test_user.id))
+        db.session.commit()
+        with count_queries() as statements:
+            response = client.get('/?search=title:"Counted"')
+        assert any('count(' in statement.lower() for statement in statements)
+        assert b'Counted Again' in response.data
+
+def test_approximate_count_display(client, test_user, monkeypatch):
+    """Test that planner estimates are shown as a lower bound."""
+    from app import counts
+    monkeypatch.setattr(counts, 'estimate_rows', lambda query: 123456)
+    with client.application.app_context():
+        for i in range(25):
+            db.session.add(Story(title=f'Story {i}', user_id=test_user.id))
+        db.session.commit()
+
+        response = client.get('/')
+        assert b'more than 6100' in response.data
+        assert b'fa-angle-double-right' not in response.data
+
+        # Filtered listings still count exactly
+        response = client.get('/?search=title:"Story"')
+        assert b'more than' not in response.data
+
+def test_anonymous_page_cache(client, test_user):
+    """Test that anonymous pages are cached until the catalogue changes."""
+    from app.page_cache import page_cache
+    page_cache.clear()
+    hits = page_cache.stats()['hits']
+    with client.application.app_context():
+        story = Story(title='Cached Story', user_id=test_user.id)
+        db.session.add(story)
+        db.session.commit()
+
+        for url in ['/', f'/story/{story.id}', f'/author/{test_user.id}']:
+            first = client.get(url)
+            assert first.status_code == 200
+            assert first.headers['ETag'] and first.headers['Last-Modified']
+            with count_queries() as statements:
+                second = client.get(url)
+            assert statements == []
+            assert second.data == first.data
+
+            # A matching ETag is answered without touching the database
+            with count_queries() as statements:
+                response = client.get(url, headers={'If-None-Match': first.headers['ETag']})
+            assert response.status_code == 304
+            assert statements == []
+
+        assert page_cache.stats()['hits'] == hits + 6
+
+        db.session.add(Story(title='Fresh Story', user_id=test_user.id))
+        db.session.commit()
+        response = client.get('/', headers={'If-None-Match': first.headers['ETag']})
+        assert response.status_code == 200
+        assert b'Fresh Story' in response.data
+
+def test_author_page_shows_edited_bio(auth_client, test_user):
+    """Test that a cached author page is replaced when the author edits their bio."""
+    from app.page_cache import page_cache
+    page_cache.clear()
+    visitor = auth_client.application.test_client()
+    first = visitor.get(f'/author/{test_user.id}')
+    assert first.status_code == 200
+
+    # A fresh app context, so the visitor's anonymous current_user isn't reused
+    with auth_client.application.app_context():
+        assert auth_client.post('/edit_bio', data={'about_me': 'Writes about lighthouses'}).location.endswith('/profile')
+    response = visitor.get(f'/author/{test_user.id}', headers={'If-None-Match': first.headers['ETag']})
+    assert response.status_code == 200
+    assert b'Writes about lighthouses' in response.data
+
+def test_cache_metrics_need_login(client, app):
+    """Test that cache metrics aren't served to anonymous visitors."""
+    app.config['CACHE_METRICS'] = True
+    assert client.get('/metrics/cache').status_code == 302
+
+def test_page_cache_skips_logged_in_users(auth_client):
+    """Test that pages are rendered afresh for logged in users."""
+    from app.page_cache import page_cache
+    page_cache.clear()
+    auth_client.get('/')
+    with count_queries() as statements:
+        auth_client.get('/')
+    assert statements
+    assert page_cache.stats()['entries'] == 0
+
+    assert auth_client.get('/metrics/cache').status_code == 404
+    auth_client.application.config['CACHE_METRICS'] = True
+    response = auth_client.get('/metrics/cache')
+    assert response.json['pages']['entries'] == 0
+    assert 'search_plans' in response.json
+
+# Cover Tests
+@pytest.fixture
+def static_folder(app, tmp_path):
+    """Keep uploaded covers out of the real static folder."""
+    app.static_folder = str(tmp_path / 'static')
+    app.config['UPLOAD_FOLDER'] = str(tmp_path / 'static' / 'uploads')
+    app.config['COVER_INCOMING_FOLDER'] = str(tmp_path / 'incoming')
+    return tmp_path / 'static'
+
+def make_image(size, format='PNG', color=(200, 80, 40)):
+    import io
+    from PIL import Image
+    buffer = io.BytesIO()
+    Image.new('RGB', size, color).save(buffer, format)
+    buffer.seek(0)
+    return buffer
+
+def test_cover_renditions(auth_client, static_folder):
+    """Test that an uploaded cover is saved at every width, as JPEG and WebP."""
+    from PIL import Image
+    from app.cover_jobs import wait_for_cover
+    with auth_client.application.app_context():
+        auth_client.post('/write', data={
+            'title': 'Covered', 'chapter_title[]': ['One'], 'chapter_content[]': ['text'],
+            'cover': (make_image((1000, 900)), 'cover.png'),
+        }, content_type='multipart/form-data')
+        story = Story.query.filter_by(title='Covered').first()
+        assert wait_for_cover(story.id, timeout=30)
+        db.session.refresh(story)
+        assert story.cover_pending is None
+        assert story.cover_image == story.cover_renditions['full']['jpeg']
+        assert list(story.cover_renditions) == ['thumb', 'card', 'full', 'print']
+        for rendition in story.cover_renditions.values():
+            assert rendition['height'] == rendition['width'] * 800 // 512
+            for key, format in (('jpeg', 'JPEG'), ('webp', 'WEBP')):
+                if key not in rendition:
+                    continue
+                with Image.open(static_folder / rendition[key]) as img:
+                    assert img.format == format
+                    assert img.size == (rendition['width'], rendition['height'])
+
+        # Cards offer every width and let the browser pick for 128px
+        response = auth_client.get('/')
+        assert f'/static/{story.cover_renditions["thumb"]["webp"]} 128w'.encode() in response.data
+        assert b'sizes="128px"' in response.data
+
+        auth_client.post(f'/story/{story.id}/edit', data={
+            'title': 'Covered', 'chapter_title[]': ['One'], 'chapter_content[]': ['text'],
+            'remove_cover': '1',
+        })
+        db.session.refresh(story)
+        assert story.cover_image is None and story.cover_renditions is None
+        assert not list((static_folder / 'uploads').iterdir())
+
+def test_cover_processed_in_background(auth_client, static_folder, monkeypatch):
+    """Test that a story is saved before its cover is ready, and replaced covers are cleaned up."""
+    import sys
+    from app.cover_jobs import submit_cover, wait_for_cover
+    with auth_client.application.app_context():
+        # Hold the upload back to see the story before its cover is ready
+        submitted = []
+        monkeypatch.setattr(sys.modules['app.stories'], 'submit_cover', submitted.append)
+        auth_client.post('/write', data={
+            'title': 'Pending', 'chapter_title[]': ['One'], 'chapter_content[]': ['text'],
+            'cover': (make_image((600, 900)), 'cover.png'),
+        }, content_type='multipart/form-data')
+        monkeypatch.undo()
+        story = Story.query.filter_by(title='Pending').first()
+        assert story.cover_pending and story.cover_image is None
+        assert b'Processing cover' in auth_client.get('/').data
+
+        submit_cover(submitted[0])
+        assert wait_for_cover(story.id, timeout=30)
+        db.session.refresh(story)
+        first = set(story.cover_renditions['thumb'].values()) - {128, 200}
+
+        # A new cover replaces the old files once it is ready
+        auth_client.post(f'/story/{story.id}/edit', data={
+            'title': 'Pending', 'chapter_title[]': ['One'], 'chapter_content[]': ['text'],
+            'cover_image': (make_image((900, 600), 'JPEG', color=(40, 80, 200)), 'cover.jpg'),
+        }, content_type='multipart/form-data')
+        assert wait_for_cover(story.id, timeout=30)
+        db.session.refresh(story)
+        assert story.cover_pending is None
+        assert not any((static_folder / path).exists() for path in first)
+        assert (static_folder / story.cover_image).exists()
+        assert not list((static_folder.parent / 'incoming').iterdir())
+
+def test_cover_files_are_immutable(auth_client, static_folder):
+    """Test that cover files are named by content and served with long-lived caching headers."""
+    import hashlib
+    from app.cover_jobs import wait_for_cover
+    app = auth_client.application
+    with app.app_context():
+        auth_client.post('/write', data={
+            'title': 'Cached', 'chapter_title[]': ['One'], 'chapter_content[]': ['text'],
+            'cover': (make_image((600, 900)), 'cover.png'),
+        }, content_type='multipart/form-data')
+        story = Story.query.filter_by(title='Cached').first()
+        assert wait_for_cover(story.id, timeout=30)
+        db.session.refresh(story)
+        path = story.cover_renditions['thumb']['webp']
+        data = (static_folder / path).read_bytes()
+        assert hashlib.sha256(data).hexdigest()[:16] in path
+
+        response = auth_client.get(f'/static/{path}')
+        assert response.status_code == 200
+        assert response.data == data
+        assert response.cache_control.immutable
+        assert response.cache_control.max_age == 365 * 24 * 60 * 60
+        response.close()
+
+        app.config['COVER_SENDFILE'] = 'x-accel-redirect'
+        response = auth_client.get(f'/static/{path}')
+        assert response.headers['X-Accel-Redirect'] == '/protected/uploads/' + path[len('uploads/'):]
+        assert response.mimetype == 'image/webp' and not response.data
+        app.config['COVER_SENDFILE'] = 'x-sendfile'
+        response = auth_client.get(f'/static/{path}')
+        assert response.headers['X-Sendfile'] == str(static_folder / path)
+        assert auth_client.get('/static/uploads/../secret').status_code == 404
+
+def test_cover_files_removed_only_on_commit(app, test_user, static_folder):
+    """Test that a removed cover's files outlive a rolled back transaction."""
+    from app.covers import remove_cover
+    (static_folder / 'uploads').mkdir(parents=True)
+    (static_folder / 'uploads' / 'a.jpg').write_bytes(b'cover')
+    story = Story(title='Rolled back', user_id=test_user.id, cover_image='uploads/a.jpg')
+    db.session.add(story)
+    db.session.commit()
+
+    remove_cover(story)
+    db.session.rollback()
+    assert (static_folder / 'uploads' / 'a.jpg').exists()
+    remove_cover(story)
+    db.session.commit()
+    assert not (static_folder / 'uploads' / 'a.jpg').exists()
+
+def test_cover_upload_checks(app, static_folder, tmp_path):
+    """Test that covers are refused before decoding and large JPEGs are decoded downscaled."""
+    from app.covers import check_upload, open_cover, InvalidCover
+    (tmp_path / 'large.jpg').write_bytes(make_image((4096, 6400), 'JPEG').read())
+    with pytest.raises(InvalidCover):
+        check_upload(tmp_path / 'large.jpg', max_pixels=4096 * 6400 - 1)
+    check_upload(tmp_path / 'large.jpg', max_pixels=4096 * 6400)
+    (tmp_path / 'text.jpg').write_bytes(b'not an image')
+    with pytest.raises(InvalidCover):
+        check_upload(tmp_path / 'text.jpg', max_pixels=4096 * 6400)
+
+    # Decoded at 1/8 scale, which is still the full cover size
+    img = open_cover(tmp_path / 'large.jpg', (512, 800), max_pixels=4096 * 6400)
+    assert img.size == (512, 800)
+
+def test_cover_backfill(app, test_user, static_folder):
+    """Test that the backfill command adds renditions to existing covers."""
+    with app.app_context():
+        story = Story(title='Old cover', user_id=test_user.id, cover_image='uploads/1.jpg')
+        db.session.add(story)
+        db.session.commit()
+        (static_folder / 'uploads').mkdir(parents=True)
+        (static_folder / 'uploads' / '1.jpg').write_bytes(make_image((512, 800), 'JPEG').read())
+        original = (static_folder / 'uploads' / '1.jpg').read_bytes()
+        last_updated = story.last_updated
+
+        result = app.test_cli_runner().invoke(args=['covers', 'backfill', '--workers', '1'])
+        assert 'Generated renditions for 1 covers' in result.output
+        db.session.expire_all()
+        story = Story.query.get(story.id)
+        assert story.cover_renditions['full']['jpeg'] == 'uploads/1.jpg'
+        assert (static_folder / story.cover_renditions['thumb']['webp']).exists()
+        # The full JPEG isn't re-encoded and the story doesn't count as updated
+        assert (static_folder / 'uploads' / '1.jpg').read_bytes() == original
+        assert story.last_updated == last_updated
+
+# Export Tests
+@pytest.mark.parametrize('format', ['pdf', 'epub'])
+def test_download_story_is_cached(auth_client, test_user, format):
+    """Test that exports are generated once per story version and served with an ETag."""
+    from app.models import Rating
+    from app.export_cache import export_cache_stats
+    with auth_client.application.app_context():
+        add_card_stories(test_user, 1)
+        story = Story.query.first()
+        before = export_cache_stats()
+
+        first = auth_client.get(f'/story/{story.id}/download/{format}')
+        assert first.status_code == 200
+        assert first.headers['ETag']
+        second = auth_client.get(f'/story/{story.id}/download/{format}')
+        assert second.data == first.data
+        assert second.headers['ETag'] == first.headers['ETag']
+        response = auth_client.get(f'/story/{story.id}/download/{format}',
+                                   headers={'If-None-Match': first.headers['ETag']})
+        assert response.status_code == 304
+
+        stats = export_cache_stats()
+        assert stats['misses'] == before['misses'] + 1
+        assert stats['hits'] == before['hits'] + 2
+        assert stats['files'] == 1
+
+        # A new vote changes the rating shown in the export
+        db.session.add(Rating(user_id=test_user.id + 1, story_id=story.id, value=1))
+        db.session.commit()
+        response = auth_client.get(f'/story/{story.id}/download/{format}')
+        assert response.headers['ETag'] != first.headers['ETag']
+
+def test_epub_is_streamed_chapter_by_chapter(auth_client, test_user):
+    """Test that EPUBs are well-formed and produced one chapter at a time."""
+    import io
+    import zipfile
+    from xml.dom import minidom
+    import os
+    from app.exports import snapshot_story, discard_snapshot
+    from app.epub_writer import iter_epub
+    with auth_client.application.app_context():
+        story = Story(title='Fish & Chips', user_id=test_user.id)
+        db.session.add(story)
+        db.session.flush()
+        for number in (1, 2, 3):
+            db.session.add(Chapter(title=f'Part <{number}>', content='First line\n\nSecond & last',
+                                   chapter_number=number, story_id=story.id))
+        db.session.commit()
+
+        # Chapter text stays in the spool file until each chapter is written
+        snapshot = snapshot_story(story)
+        assert all('content' not in chapter._fields for chapter in snapshot.chapters)
+        chunks = list(iter_epub(snapshot))
+        discard_snapshot(snapshot)
+        assert not os.path.exists(snapshot.spool)
+        assert len(chunks) >= 4
+        book = zipfile.ZipFile(io.BytesIO(b''.join(chunks)))
+        assert book.namelist()[0] == 'mimetype'
+        assert book.getinfo('mimetype').compress_type == zipfile.ZIP_STORED
+        assert book.read('mimetype') == b'application/epub+zip'
+        for name in book.namelist():
+            if name.endswith(('.xhtml', '.opf', '.ncx', '.xml')):
+                minidom.parseString(book.read(name))
+        chapter = book.read('EPUB/chapter_2.xhtml').decode()
+        assert 'Part &lt;2&gt;' in chapter
+        assert '<p>Second &amp; last</p>' in chapter
+        assert 'chapter_3.xhtml' in book.read('EPUB/content.opf').decode()
+
+        response = auth_client.get(f'/story/{story.id}/download/epub')
+        assert response.data == b''.join(chunks)
+
+def test_pdf_is_laid_out_paragraph_by_paragraph(monkeypatch, tmp_path):
+    """Test that long chapters are split into paragraphs and laid out lazily."""
+    import io
+    from datetime import datetime
+    from app.exports import StorySnapshot, ChapterSnapshot, spool_chapters, discard_snapshot
+    from app import pdf_writer
+
+    assert list(pdf_writer.split_paragraphs('one\n\n two  three \n\nfour', chunk_words=2)) == ['one', 'two three', 'four']
+    assert list(pdf_writer.split_paragraphs('a\nb')) == ['a', 'b']
+
+    peak = []
+    class RecordingFlowables(pdf_writer.LazyFlowables):
+        def _fill(self, count):
+            super()._fill(count)
+            peak.append(list.__len__(self))
+
+    now = datetime.utcnow()
+    chapters, spool = spool_chapters([
+        ChapterSnapshot(1, 'One <b>', ' '.join(['word'] * 5000)),
+        ChapterSnapshot(2, 'Two', '\n\n'.join(['Some & more words.'] * 300)),
+    ], tmp_path)
+    story = StorySnapshot(1, 'Long', 'author', '', [], 2, 5000 + 900, 0, 0, now, now, None, None, chapters, spool)
+    monkeypatch.setattr(pdf_writer, 'LazyFlowables', RecordingFlowables)
+    out = io.BytesIO()
+    pages = pdf_writer.write_pdf(story, out)
+    discard_snapshot(story)
+    assert pages > 3
+    assert out.getvalue().startswith(b'%PDF')
+    assert b'/Outlines' in out.getvalue()
+    assert max(peak) < 50
+
+def test_pdf_embeds_print_cover(test_user, static_folder, monkeypatch):
+    """Test that PDFs embed the print-ready cover as it is and change with the cover."""
+    import io
+    from PIL import Image
+    from app import pdf_writer
+    from app.exports import snapshot_story, discard_snapshot
+    from app.export_cache import export_key
+    (static_folder / 'uploads').mkdir(parents=True)
+    (static_folder / 'uploads' / 'print.jpg').write_bytes(make_image((1056, 1650), 'JPEG').read())
+    story = Story(title='Printed', user_id=test_user.id, cover_image='uploads/full.jpg', cover_renditions={
+        'print': {'width': 1056, 'height': 1650, 'jpeg': 'uploads/print.jpg'},
+    })
+    db.session.add(story)
+    db.session.commit()
+    key = export_key(story, 'pdf')
+    snapshot = snapshot_story(story)
+
+    def no_decoding(*args, **kwargs):
+        raise AssertionError('PDF exports should not open cover images')
+    monkeypatch.setattr(Image, 'open', no_decoding)
+    out = io.BytesIO()
+    pdf_writer.write_pdf(snapshot, out)
+    discard_snapshot(snapshot)
+    assert b'/DCTDecode' in out.getvalue()
+    assert b'/Width 1056' in out.getvalue()
+
+    story.cover_renditions = {'print': {'width': 1056, 'height': 1650, 'jpeg': 'uploads/other.jpg'}}
+    assert export_key(story, 'pdf') != key
+
+def test_export_cache_eviction(auth_client, test_user):
+    """Test that the least recently served exports are evicted first."""
+    import os
+    from app.export_cache import find_export, evict, cache_folder
+    with auth_client.application.app_context():
+        add_card_stories(test_user, 3)
+        stories = Story.query.order_by(Story.id).all()
+        for story in stories:
+            auth_client.get(f'/story/{story.id}/download/epub')
+        paths = [find_export(story, 'epub')[0] for story in stories]
+        os.utime(paths[0], (0, 0))
+        os.utime(paths[1], (1, 1))
+        find_export(stories[0], 'epub')  # A hit makes it recent again
+
+        evict(cache_folder(), os.path.getsize(paths[0]) + os.path.getsize(paths[2]))
+        assert os.path.exists(paths[0])
+        assert not os.path.exists(paths[1])
+        assert os.path.exists(paths[2])
+
+def test_export_job_api(auth_client, test_user):
+    """Test queueing an export job, polling it and downloading the result."""
+    from app.export_jobs import get_job
+    with auth_client.application.app_context():
+        add_card_stories(test_user, 1)
+        story = Story.query.first()
+
+        response = auth_client.post(f'/story/{story.id}/export/pdf')
+        assert response.status_code in (200, 202)
+        job = response.json
+        assert job['status'] in ('queued', 'running', 'done')
+
+        # Asking again joins the same job
+        again = auth_client.post(f'/story/{story.id}/export/pdf')
+        assert again.json['job'] == job['job']
+
+        response = auth_client.get(job['download_url'])
+        assert response.status_code == 200
+        assert response.data.startswith(b'%PDF')
+        assert response.headers['ETag'] == f'"{job["job"]}"'
+
+        # The file can be served before the worker's result reaches this process
+        get_job(job['job']).wait(30)
+        response = auth_client.get(job['status_url'])
+        assert response.json['status'] == 'done'
+        assert auth_client.get('/exports/unknown').status_code == 404
+        assert auth_client.post(f'/story/{story.id}/export/docx').status_code == 404
+
+def test_failed_export_download(auth_client, test_user, monkeypatch):
+    """Test that a download whose export failed answers with an error and can be retried."""
+    from concurrent.futures import Future
+    from app import export_jobs
+    from app.exports import discard_snapshot
+    submitted = []
+    class FailingPool:
+        def submit(self, render, snapshot, format, path):
+            discard_snapshot(snapshot)
+            submitted.append(path)
+            future = Future()
+            future.set_exception(RuntimeError('layout failed'))
+            return future
+    monkeypatch.setattr(export_jobs, '_get_executor', FailingPool)
+    with auth_client.application.app_context():
+        add_card_stories(test_user, 1)
+        story = Story.query.first()
+        for attempt in (1, 2):
+            response = auth_client.get(f'/story/{story.id}/download/pdf')
+            assert response.status_code == 500
+            assert len(submitted) == attempt
+
+def test_export_queue_depth(auth_client, test_user):
+    """Test that exports are turned away when the queue is full."""
+    auth_client.application.config['EXPORT_QUEUE_DEPTH'] = 0
+    with auth_client.application.app_context():
+        add_card_stories(test_user, 1)
+        story = Story.query.first()
+        response = auth_client.post(f'/story/{story.id}/export/epub')
+        assert response.status_code == 503
+        assert response.headers['Retry-After']
+
+def test_download_library(auth_client, test_user):
+    """Test that the library downloads as one ZIP, reusing cached exports."""
+    import io
+    import zipfile
+    from app.export_cache import export_cache_stats
+    with auth_client.application.app_context():
+        add_card_stories(test_user, 3)
+        stories = Story.query.order_by(Story.id).all()
+        stories[1].title = stories[0].title
+        db.session.commit()
+        auth_client.get(f'/story/{stories[0].id}/download/epub')
+        before = export_cache_stats()
+
+        response = auth_client.get('/library/download/epub')
+        assert response.status_code == 200
+        assert response.mimetype == 'application/zip'
+        archive = zipfile.ZipFile(io.BytesIO(response.data))
+        names = archive.namelist()
+        assert len(names) == 3 and len(set(names)) == 3
+        assert all(name.endswith('.epub') for name in names)
+        for name in names:
+            book = zipfile.ZipFile(io.BytesIO(archive.read(name)))
+            assert book.read('mimetype') == b'application/epub+zip'
+        assert export_cache_stats()['hits'] > before['hits']
+        response.close()
+
+        # Books are deflated at level 0 rather than stored, since their
+        # sizes come after the data
+        assert all(info.compress_type == zipfile.ZIP_DEFLATED for info in archive.infolist())
+        assert all(info.compress_size >= info.file_size for info in archive.infolist())
+
+        # Just a selection
+        response = auth_client.get(f'/library/download/pdf?story_id={stories[2].id}')
+        names = zipfile.ZipFile(io.BytesIO(response.data)).namelist()
+        assert names == [f'{stories[2].title}.pdf']
+
+        # A full export pool turns the download away up front
+        auth_client.application.config['EXPORT_QUEUE_DEPTH'] = 0
+        response = auth_client.get('/library/download/epub')
+        assert response.status_code == 503
+        assert response.headers['Retry-After']
+
+def test_library_export_gives_up_on_full_pool(auth_client, test_user, monkeypatch):
+    """Test that a library download doesn't wait forever for room on the export pool."""
+    from app import library_export
+    from app.export_jobs import ExportQueueFull
+    def full(story, format):
+        raise ExportQueueFull()
+    monkeypatch.setattr(library_export, 'submit_export', full)
+    monkeypatch.setattr(library_export, 'QUEUE_RETRY_SECONDS', 0.01)
+    auth_client.application.config['LIBRARY_QUEUE_WAIT_SECONDS'] = 0.05
+    with auth_client.application.app_context():
+        add_card_stories(test_user, 3)
+        stories = Story.query.order_by(Story.id).all()
+        ready = list(library_export._ready_exports(stories, 'epub'))
+        assert [path for _, path in ready] == [None, None, None]
+
+def test_library_export_gives_up_on_hung_render(auth_client, test_user, monkeypatch):
+    """Test that a render that never finishes is left out of the library download."""
+    import io
+    import zipfile
+    from app import library_export
+    waits = []
+    class HungJob:
+        path = None
+        def wait(self, timeout=None):
+            waits.append(timeout)
+            return False
+    monkeypatch.setattr(library_export, 'submit_export', lambda story, format: HungJob())
+    auth_client.application.config['LIBRARY_RENDER_WAIT_SECONDS'] = 0.05
+    with auth_client.application.app_context():
+        add_card_stories(test_user, 2)
+        stories = Story.query.order_by(Story.id).all()
+        archive = zipfile.ZipFile(io.BytesIO(b''.join(library_export.iter_library_zip(stories, 'epub'))))
+        assert all(name.endswith('.error.txt') for name in archive.namelist())
+        assert waits == [0.05, 0.05]
+
+def test_download_library_per_user_cap(auth_client, test_user):
+    """Test that a reader can only run one library download at a time."""
+    from app import library_export
+    with auth_client.application.app_context():
+        add_card_stories(test_user, 1)
+        library_export.acquire_slot(test_user.id)
+        try:
+            response = auth_client.get('/library/download/epub')
+            assert response.status_code == 429
+        finally:
+            library_export.release_slot(test_user.id)
+        for attempt in range(2):
+            response = auth_client.get('/library/download/epub')
+            assert response.status_code == 200
+            assert response.data  # The slot is released once the ZIP is sent
+
 # Profile Tests
 def test_view_profile(auth_client):
     """Test viewing user profile."""
@@ -251,6 +1382,47 @@ def test_view_profile(auth_client):
     assert response.status_code == 200
     assert b'testuser' in response.data
 
+def test_author_stats(auth_client, test_user):
+    """Test profile statistics and their per-author cache invalidation."""
+    from app.author_stats import author_stats
+    with auth_client.application.app_context():
+        auth_client.post('/write', data={
+            'title': 'First', 'chapter_title[]': ['One'], 'chapter_content[]': ['a b c d'],
+            'tags': 'fantasy, dragons'
+        })
+        auth_client.post('/write', data={
+            'title': 'Second', 'chapter_title[]': ['One'], 'chapter_content[]': ['a b'],
+            'tags': 'fantasy'
+        })
+        story = Story.query.filter_by(title='First').first()
+        auth_client.post(f'/story/{story.id}/rate', data={'rating': 4})
+
+        stats = author_stats(test_user.id)
+        assert stats['total_stories'] == 2
+        assert stats['total_words'] == 6
+        assert stats['avg_words'] == 3
+        assert stats['avg_rating'] == 4
+        assert stats['rating_count'] == 1
+        assert stats['most_used_tag'] == {'name': 'fantasy', 'count': 2}
+
+        with count_queries() as statements:
+            assert author_stats(test_user.id) is stats
+        assert not statements
+
+        # Another author's activity leaves this author's cached stats alone
+        other = User(username='other', password_hash='x')
+        db.session.add(other)
+        db.session.commit()
+        db.session.add(Story(title='Elsewhere', user_id=other.id))
+        db.session.commit()
+        assert author_stats(test_user.id) is stats
+
+        auth_client.post(f'/story/{story.id}/rate', data={'rating': 2})
+        assert author_stats(test_user.id)['avg_rating'] == 2
+
+        response = auth_client.get('/profile')
+        assert b'fantasy' in response.data
+
 def test_edit_bio(auth_client):
     """Test editing user bio."""
     response = auth_client.post('/edit_bio', data={
@@ -103,4 +103,100 @@ def test_story_tags(app, test_user):
         saved_story = Story.query.first()
         assert len(saved_story.tags) == 2
         assert any(tag.name == 'fantasy' for tag in saved_story.tags)
-        assert any(tag.name == 'adventure' for tag in saved_story.tags) 
\ No newline at end of file
+        assert any(tag.name == 'adventure' for tag in saved_story.tags) 
+
+
+def test_chapter_word_count(app, test_user):
+    """Test that chapter and story word counts are cached on save."""
+    with app.app_context():
+        story = Story(title='Test Story', user_id=test_user.id)
+        db.session.add(story)
+        db.session.flush()
+
+        chapters = [
+            Chapter(title='One', content='one two three', chapter_number=1, story_id=story.id),
+            Chapter(title='Two', content='four  five\nsix seven', chapter_number=2, story_id=story.id),
+        ]
+        db.session.add_all(chapters)
+        story.refresh_chapter_stats(chapters)
+        db.session.commit()
+
+        saved_story = Story.query.first()
+        assert [chapter.word_count for chapter in saved_story.chapters] == [3, 4]
+        assert saved_story.word_count == 7
+        assert saved_story.chapter_count == 2
+
+        saved_story.chapters[0].content = 'just two'
+        assert saved_story.chapters[0].word_count == 2
+
+def test_compressed_chapter_text(app, test_user, tmp_path):
+    """Test that chapter text can be stored compressed and still reads back as text."""
+    from app import chapter_text
+    text = ' '.join(f'The {i % 7} ravens watched the {i % 5} travellers.' for i in range(100))
+    with app.app_context():
+        story = Story(title='Test Story', user_id=test_user.id)
+        db.session.add(story)
+        db.session.flush()
+
+        app.config['CHAPTER_COMPRESSION'] = 'zlib'
+        long_chapter = Chapter(title='Long', content=text, chapter_number=1, story_id=story.id)
+        short_chapter = Chapter(title='Short', content='too short to bother', chapter_number=2, story_id=story.id)
+        db.session.add_all([long_chapter, short_chapter])
+        db.session.commit()
+        assert long_chapter._content is None
+        assert len(long_chapter.content_compressed) < len(text) / 3
+        assert short_chapter._content == 'too short to bother'
+        assert short_chapter.content_compressed is None
+
+        db.session.expire_all()
+        long_chapter = Chapter.query.filter_by(title='Long').first()
+        assert long_chapter.content == text
+        assert long_chapter.word_count == 700
+        assert long_chapter.excerpt == text[:200]
+
+        # With a shared dictionary, which reading the chapter then needs
+        dictionary = tmp_path / 'chapters.dict'
+        dictionary.write_bytes(chapter_text.train_dictionary('zlib', [text], 4096))
+        app.config['CHAPTER_DICTIONARY'] = str(dictionary)
+        long_chapter.content = text + ' The end.'
+        db.session.commit()
+        assert chapter_text.HEADER.unpack_from(long_chapter.content_compressed)[1] == chapter_text.dictionary_id(dictionary.read_bytes())
+        db.session.expire_all()
+        assert Chapter.query.filter_by(title='Long').first().content == text + ' The end.'
+
+        app.config['CHAPTER_DICTIONARY'] = None
+        db.session.expire_all()
+        with pytest.raises(chapter_text.ChapterTextError):
+            Chapter.query.filter_by(title='Long').first().content
+
+def test_rating_histogram(app, test_user):
+    """Test that ratings keep the per-story histogram and average in step."""
+    with app.app_context():
+        story = Story(title='Test Story', user_id=test_user.id)
+        db.session.add(story)
+        db.session.commit()
+
+        voters = []
+        for i, value in enumerate([5, 5, 3, 1]):
+            voter = User(username=f'voter{i}', password_hash='testpass')
+            db.session.add(voter)
+            db.session.flush()
+            db.session.add(Rating(user_id=voter.id, story_id=story.id, value=value))
+            voters.append(voter)
+        db.session.commit()
+
+        stats = Story.query.first().rating_stats
+        assert [votes for _, votes, _ in stats.histogram] == [2, 0, 1, 0, 1]
+        assert stats.rating_count == 4
+        assert stats.average == 3.5
+
+        rating = Rating.query.filter_by(user_id=voters[3].id).first()
+        rating.value = 4
+        db.session.commit()
+        db.session.delete(Rating.query.filter_by(user_id=voters[0].id).first())
+        db.session.commit()
+
+        db.session.expire_all()
+        stats = Story.query.first().rating_stats
+        assert [votes for _, votes, _ in stats.histogram] == [1, 1, 1, 0, 0]
+        assert stats.average == 4